@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+'''
+Archive of the past jobs
+
+The details of the jobs removed by the retention are appended here,
+out of redis: one file of fixed size values per column, under
+ARCHIVE_FOLDER, so that any column can be scanned (memory-mapped)
+with numpy without reading the others
+
+    python archive.py
+
+prints a summary of the archive
+'''
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from utils import client_id
+from utils import get_setting
+
+# Column -> dtype (little endian, whatever the machine);
+# missing values are NaN (floats) or -1 (integers)
+COLUMNS = [
+    ('id', '<u8'),
+    ('time', '<f8'),
+    ('started', '<f8'),
+    ('finished', '<f8'),
+    ('status', 'u1'),
+    ('ip', '<u8'),
+    ('email', '<u8'),
+    ('multi', 'u1'),
+    ('cached', 'u1'),
+    ('disk', '<i8'),
+    ('seconds', '<f4'),
+    # From the uploads
+    ('draft_size', '<i8'),
+    ('draft_records', '<i8'),
+    ('targets', '<i4'),
+    ('targets_size', '<i8'),
+    # From result.json (finished jobs)
+    ('draft_length', '<i8'),
+    ('draft_contigs', '<i8'),
+    ('draft_N50', '<f8'),
+    ('targets_length', '<i8'),
+    ('scaffold_contigs', '<i8'),
+    ('scaffold_N50', '<f8'),
+]
+DTYPES = dict(COLUMNS)
+
+# Status codes
+STATUSES = (None, 'Job done', 'Job failed')
+
+def archive_folder():
+    folder = get_setting('ARCHIVE_FOLDER', 'archive')
+    if not os.path.isabs(folder):
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              folder)
+    return folder
+
+def column_path(name, folder=None):
+    return os.path.join(folder or archive_folder(), '%s.col' % name)
+
+def index_path(folder=None):
+    return os.path.join(folder or archive_folder(), 'id.idx')
+
+def _float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return -1
+
+def job_row(jid, job, result=None):
+    '''The archived values of a job (its redis hash, and parsed
+    result.json if any)'''
+    req_id = jid[len('medusa_'):]
+    started = _float(job.get('started'))
+    finished = _float(job.get('finished'))
+    status = job.get('status')
+
+    row = {'id': int(req_id[:16], 16),
+           'time': _float(job.get('time')),
+           'started': started,
+           'finished': finished,
+           'status': STATUSES.index(status) if status in STATUSES else 0,
+           'ip': client_id(job.get('ip') or ''),
+           'email': client_id(job.get('email') or ''),
+           # tasks.MULTI
+           'multi': int(job.get('mode') == 'multi'),
+           'cached': int('cached' in job),
+           'disk': _int(job.get('disk')),
+           'seconds': finished - started}
+
+    inputs = json.loads(job.get('inputs') or '{}')
+    draft = inputs.get(job.get('draft'))
+    targets = [i for name, i in inputs.items() if name != job.get('draft')]
+    row['draft_size'] = draft['size'] if draft else -1
+    row['draft_records'] = draft['records'] if draft else -1
+    row['targets'] = len(targets) if draft else -1
+    row['targets_size'] = sum(t['size'] for t in targets) if draft else -1
+
+    if result is None:
+        result = {}
+    d = result.get('draft', {})
+    s = result.get('scaffold') or {}
+    row['draft_length'] = d.get('length', -1)
+    row['draft_contigs'] = d.get('contigs', -1)
+    # The N50 of an even number of contigs can be a half
+    row['draft_N50'] = d.get('N50', np.nan)
+    row['targets_length'] = (sum(t['length'] for t in result['targets'])
+                             if 'targets' in result else -1)
+    row['scaffold_contigs'] = s.get('contigs', -1)
+    row['scaffold_N50'] = s.get('N50', np.nan)
+    return row
+
+def _rows(folder):
+    '''Complete rows (a crash may leave some columns longer)'''
+    n = None
+    for name, dtype in COLUMNS:
+        try:
+            size = os.path.getsize(column_path(name, folder))
+        except OSError:
+            size = 0
+        rows = size // np.dtype(dtype).itemsize
+        n = rows if n is None else min(n, rows)
+    return n
+
+# Ids appended since the sorted index was last merged, checked as they
+# are (the index is merged again past this many)
+INDEX_TAIL = 4096
+
+def _index(n, folder):
+    '''The archived ids: the sorted index of the first ones
+    (memory-mapped) and the ids appended after it
+
+    Rebuilt from the id column when it covers more than the n rows
+    (a crash between the columns and the index)
+    '''
+    path = index_path(folder)
+    try:
+        m = os.path.getsize(path) // np.dtype(DTYPES['id']).itemsize
+    except OSError:
+        m = -1
+    ids = np.zeros(0, dtype=DTYPES['id'])
+    if n:
+        ids = np.memmap(column_path('id', folder), dtype=DTYPES['id'],
+                        mode='r', shape=(n,))
+    if m < 0 or m > n:
+        _write_index(np.sort(ids), folder)
+        m = n
+    if not m:
+        return np.zeros(0, dtype=DTYPES['id']), ids
+    return (np.memmap(path, dtype=DTYPES['id'], mode='r', shape=(m,)),
+            ids[m:])
+
+def _write_index(ids, folder):
+    tmp = index_path(folder) + '.tmp'
+    ids.tofile(tmp)
+    os.rename(tmp, index_path(folder))
+
+def append(rows, folder=None):
+    '''Append rows (job_row dictionaries) to the archive
+
+    Jobs archived already are skipped (looked up in the sorted
+    index of the ids and the few ids appended since, not the whole
+    id column); returns how many were added
+    '''
+    folder = folder or archive_folder()
+    try:
+        os.makedirs(folder)
+    except OSError:
+        pass
+
+    lock = open(os.path.join(folder, 'lock'), 'w')
+    try:
+        # One writer at a time
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        n = _rows(folder)
+        for name, dtype in COLUMNS:
+            path = column_path(name, folder)
+            if os.path.exists(path):
+                # Drop the incomplete rows
+                f = open(path, 'r+b')
+                f.truncate(n * np.dtype(dtype).itemsize)
+                f.close()
+
+        index, tail = _index(n, folder)
+        ids = np.array([row['id'] for row in rows], dtype=DTYPES['id'])
+        new = ~np.in1d(ids, tail)
+        if len(index):
+            at = np.minimum(np.searchsorted(index, ids), len(index) - 1)
+            new &= index[at] != ids
+        # Only once within the rows too
+        once = np.zeros(len(ids), dtype=bool)
+        once[np.unique(ids, return_index=True)[1]] = True
+        new &= once
+        rows = [row for row, keep in zip(rows, new) if keep]
+        if not rows:
+            return 0
+
+        for name, dtype in COLUMNS:
+            f = open(column_path(name, folder), 'ab')
+            try:
+                np.array([row[name] for row in rows],
+                         dtype=dtype).tofile(f)
+            finally:
+                f.close()
+
+        if len(tail) + len(rows) >= INDEX_TAIL:
+            # Merged in (a sequential copy, the index is sorted already)
+            added = np.sort(np.concatenate([tail, ids[new]]))
+            _write_index(np.insert(index, np.searchsorted(index, added),
+                                   added), folder)
+        return len(rows)
+    finally:
+        lock.close()
+
+def load(columns=None, start=None, stop=None, folder=None):
+    '''Return {column: array} of the archived jobs submitted
+    between start and stop (timestamps)
+
+    The columns are memory-mapped, only the time column is read
+    to select a time range
+    '''
+    folder = folder or archive_folder()
+    if columns is None:
+        columns = [name for name, dtype in COLUMNS]
+
+    n = _rows(folder)
+    data = {}
+    for name in set(columns) | set(['time']):
+        if n:
+            data[name] = np.memmap(column_path(name, folder),
+                                   dtype=DTYPES[name], mode='r', shape=(n,))
+        else:
+            data[name] = np.zeros(0, dtype=DTYPES[name])
+
+    if start is not None or stop is not None:
+        t = data['time']
+        mask = np.ones(n, dtype=bool)
+        if start is not None:
+            mask &= t >= start
+        if stop is not None:
+            mask &= t < stop
+        data = dict((name, a[mask]) for name, a in data.items())
+
+    if 'time' not in columns:
+        data.pop('time')
+    return data
+
+def runtime_samples():
+    '''[features..., seconds] of the archived single Medusa runs,
+    as recorded for the runtime model'''
+    names = ['draft_length', 'draft_contigs', 'targets', 'targets_length']
+    a = load(names + ['status', 'multi', 'cached', 'seconds'])
+    mask = ((a['status'] == STATUSES.index('Job done')) &
+            (a['multi'] == 0) & (a['cached'] == 0) &
+            (a['draft_length'] >= 0) & (a['seconds'] > 0))
+    return np.column_stack([a[name][mask] for name in names] +
+                           [a['seconds'][mask]])
+
+if __name__ == "__main__":
+    a = load(['time', 'status'])
+    n = len(a['time'])
+    if not n:
+        sys.stdout.write('The archive is empty\n')
+        sys.exit(0)
+    done = (a['status'] == STATUSES.index('Job done')).sum()
+    sys.stdout.write('%d jobs (%d done, %d failed) from %s to %s, '
+                     % (n, done,
+                        (a['status'] == STATUSES.index('Job failed')).sum(),
+                        time.ctime(np.nanmin(a['time'])),
+                        time.ctime(np.nanmax(a['time']))) +
+                     '%.1f MB on disk\n'
+                     % (sum(os.path.getsize(column_path(name))
+                            for name, dtype in COLUMNS) / 1048576.0))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+# N50 definitions
+# Broad Institute: median of the list where each contig
+# is repeated as many times as its length
+BROAD = 'broad'
+# Length of the contig at which the cumulative sum of the sorted
+# (longest first) contigs reaches 50% of the assembly
+CUMULATIVE = 'cumulative'
+
+def sorted_lengths(lengths):
+    '''Return the contig lengths as a sorted (ascending) array'''
+    a = np.sort(np.asarray(lengths, dtype=np.int64))
+    if a.size == 0:
+        raise ValueError('No contigs found')
+    return a
+
+def _expanded_item(a, csum, k):
+    # Item k of the (sorted) list where each contig is repeated
+    # as many times as its length, without building it
+    return int(a[np.searchsorted(csum, k, side='right')])
+
+def Nx(lengths, x=50, definition=BROAD):
+    '''Return the Nx value (e.g. N50, N90) of a list of contig lengths
+
+    With the Broad definition (the one of the old utils.N50) the value
+    is the (100 - x) percentile of the expanded list, taking the mean
+    of the two middle items when the position falls between them;
+    with the cumulative definition it is the length of the contig
+    at which the longest contigs reach x% of the assembly.
+    '''
+    a = sorted_lengths(lengths)
+    csum = np.cumsum(a)
+    total = int(csum[-1])
+
+    if definition == BROAD:
+        pos, rem = divmod(total * (100 - x), 100)
+        if rem == 0 and pos > 0:
+            return float(_expanded_item(a, csum, pos) +
+                         _expanded_item(a, csum, pos - 1)) / 2
+        return _expanded_item(a, csum, pos)
+    elif definition == CUMULATIVE:
+        return int(a[::-1][_Lx_index(a, x)])
+    else:
+        raise ValueError('Unknown Nx definition %s' % definition)
+
+def _Lx_index(a, x):
+    csum = np.cumsum(a[::-1])
+    return int(np.searchsorted(csum * 100, int(csum[-1]) * x))
+
+def Lx(lengths, x=50):
+    '''Return the Lx value (e.g. L50, L90) of a list of contig lengths
+
+    The smallest number of contigs whose length sum makes up
+    x% of the assembly
+    '''
+    return _Lx_index(sorted_lengths(lengths), x) + 1
+
+def N50(lengths, definition=BROAD):
+    return Nx(lengths, 50, definition)
+
+def assembly_stats(lengths, definition=BROAD):
+    '''Return a dictionary of statistics on a list of contig lengths'''
+    a = sorted_lengths(lengths)
+
+    return {'length': int(a.sum()),
+            'contigs': int(a.size),
+            'min': int(a[0]),
+            'max': int(a[-1]),
+            'mean': float(a.mean()),
+            'N50': Nx(a, 50, definition),
+            'N90': Nx(a, 90, definition),
+            'L50': Lx(a, 50),
+            'L90': Lx(a, 90)}
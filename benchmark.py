@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+'''
+Benchmarks of the stats and store hot paths
+
+Synthetic genomes and a jobs history are generated from a seed
+(so that runs are comparable), then each hot path is run a few
+times in a child process, reporting its throughput, latency
+percentiles and peak memory as JSON
+
+    python benchmark.py [options] [-o results.json] [--baseline old.json]
+
+The jobs history is written to REDIS_DB_BENCHMARK (15 by default,
+it must be empty unless --flush is given), or to an in-process
+redis with --fake (needs the fakeredis package)
+'''
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import numpy as np
+import redis
+
+import store
+import tasks
+import utils
+from assembly import assembly_stats
+
+# Contig lengths distributions
+DISTRIBUTIONS = ('lognormal', 'exponential', 'uniform')
+
+# FASTA line width
+LINE_WIDTH = 60
+
+def contig_lengths(size, contigs, distribution='lognormal', seed=1):
+    '''Return contig lengths adding up (about) to size'''
+    rs = np.random.RandomState(seed)
+
+    if distribution == 'lognormal':
+        w = rs.lognormal(0, 1.2, contigs)
+    elif distribution == 'exponential':
+        w = rs.exponential(1, contigs)
+    elif distribution == 'uniform':
+        w = rs.uniform(0.1, 1, contigs)
+    else:
+        raise ValueError('Unknown distribution %s' % distribution)
+
+    lengths = np.maximum(1, (w / w.sum() * size).astype(np.int64))
+    return [int(x) for x in lengths]
+
+def write_fasta(fname, lengths, gc=0.5, gap_every=100000, gap_size=100,
+                seed=1):
+    '''Write a random genome with the given contig lengths
+
+    Roughly one gap (run of Ns) every gap_every bases
+    '''
+    rs = np.random.RandomState(seed)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+    p = [(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2]
+
+    f = open(fname, 'wb')
+    try:
+        for i, length in enumerate(lengths):
+            seq = bases[rs.choice(4, length, p=p)]
+            for start in rs.randint(0, length, length // gap_every):
+                seq[start:start+gap_size] = ord('N')
+
+            f.write(b'>contig%d length=%d\n' % (i + 1, length))
+            for start in range(0, length, LINE_WIDTH):
+                f.write(seq[start:start+LINE_WIDTH].tostring())
+                f.write(b'\n')
+    finally:
+        f.close()
+
+def seed_jobs(r, jobs, days, seed=1, batch=1000):
+    '''Write a jobs history spread over the last days
+
+    A few IPs and emails submit most of the jobs, like the real ones
+    '''
+    rs = np.random.RandomState(seed)
+    now = time.time()
+    start = now - days * 24 * 3600
+
+    times = np.sort(rs.uniform(start, now, jobs))
+    ips = rs.zipf(1.5, jobs) % max(1, jobs // 5)
+    emails = rs.zipf(1.5, jobs) % max(1, jobs // 10)
+
+    for offset in range(0, jobs, batch):
+        p = r.pipeline(transaction=False)
+        for i in range(offset, min(jobs, offset + batch)):
+            t = float(times[i])
+            jid = 'medusa_%s' % hashlib.sha256('%d:%d' % (seed, i)).hexdigest()
+            p.hmset(jid, {'ip': '10.%d.%d.%d' % (ips[i] >> 16 & 255,
+                                                 ips[i] >> 8 & 255,
+                                                 ips[i] & 255),
+                          'email': 'user%d@example.com' % emails[i],
+                          'date': time.asctime(time.localtime(t)),
+                          'time': t,
+                          'status': 'Job done'})
+            p.zadd('medusajobs', jid, t)
+        p.execute()
+
+def percentile(values, q):
+    return float(np.percentile(values, q))
+
+def _peak_rss():
+    # Kilobytes on Linux; children are the stats processes pools
+    return 1024 * max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def _measure(func, repeat, nbytes, conn):
+    try:
+        func()
+        latencies = []
+        for i in range(repeat):
+            start = time.time()
+            func()
+            latencies.append(time.time() - start)
+
+        total = sum(latencies)
+        d = {'repeat': repeat,
+             'seconds': round(total, 6),
+             'ops_per_second': round(repeat / total, 3) if total else None,
+             'p50': round(percentile(latencies, 50), 6),
+             'p90': round(percentile(latencies, 90), 6),
+             'p99': round(percentile(latencies, 99), 6),
+             'peak_rss': _peak_rss()}
+        if nbytes and total:
+            d['mb_per_second'] = round(nbytes * repeat / total / 1e6, 3)
+        conn.send(d)
+    except Exception as e:
+        conn.send({'error': '%s: %s' % (e.__class__.__name__, e)})
+    conn.close()
+
+def measure(func, repeat=5, nbytes=None):
+    '''Time func (after a warm up call) in a child process
+
+    A fresh process per hot path keeps the peak memory figures apart
+    '''
+    parent, child = multiprocessing.Pipe(duplex=False)
+    p = multiprocessing.Process(target=_measure,
+                                args=(func, repeat, nbytes, child))
+    p.start()
+    child.close()
+    d = parent.recv()
+    p.join()
+    return d
+
+def benchmarks(wdir, lengths, draft, targets):
+    '''(name, function, bytes processed per call) of each hot path'''
+    size = sum(os.path.getsize(f) for f in [draft] + targets)
+    today = date.today()
+
+    return [
+        ('utils.N50', lambda: utils.N50(lengths), None),
+        ('assembly.assembly_stats', lambda: assembly_stats(lengths), None),
+        ('tasks.single_genome_stats',
+         lambda: tasks.single_genome_stats(draft),
+         os.path.getsize(draft)),
+        ('tasks.genome_stats',
+         lambda: tasks.genome_stats(draft, targets), size),
+        ('store.backfill_stats', store.backfill_stats, None),
+        ('store.cumulative_jobs',
+         lambda: list(store.cumulative_jobs()), None),
+        ('store.unique_ips', lambda: list(store.unique_ips()), None),
+        ('store.unique_emails', lambda: list(store.unique_emails()), None),
+        ('store.cumulative_jobs_last_month',
+         lambda: list(store.cumulative_jobs(today - timedelta(days=30),
+                                            today, 1)), None),
+    ]
+
+def compare(results, baseline, tolerance=0.2):
+    '''Return the hot paths slower (p50) or bigger (peak RSS) than
+    the baseline by more than tolerance
+    '''
+    regressions = []
+    for name, d in sorted(results.items()):
+        b = baseline.get(name)
+        if b is None or 'error' in d or 'error' in b:
+            continue
+        for key in ('p50', 'peak_rss'):
+            if b[key] and d[key] > b[key] * (1 + tolerance):
+                regressions.append('%s %s: %s (baseline %s)'
+                                   % (name, key, d[key], b[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--size', type=int, default=5000000,
+                        help='Genome size (bases)')
+    parser.add_argument('--contigs', type=int, default=500)
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+                        default='lognormal',
+                        help='Contig lengths distribution')
+    parser.add_argument('--targets', type=int, default=3,
+                        help='Number of target genomes')
+    parser.add_argument('--jobs', type=int, default=20000,
+                        help='Jobs in the generated history')
+    parser.add_argument('--days', type=int, default=3 * 365,
+                        help='Days spanned by the jobs history')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', default=None,
+                        help='Only run the hot paths containing this')
+    parser.add_argument('--redis-db', type=int,
+                        default=utils.get_setting('REDIS_DB_BENCHMARK', 15))
+    parser.add_argument('--flush', action='store_true',
+                        help='Empty the benchmark redis database first')
+    parser.add_argument('--fake', action='store_true',
+                        help='Use an in-process redis (fakeredis)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Results file (default: stdout)')
+    parser.add_argument('--baseline', default=None,
+                        help='Results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Never touch the application database
+    if args.fake:
+        import fakeredis
+        store.POOL = redis.ConnectionPool(
+                        connection_class=fakeredis.FakeConnection,
+                        server=fakeredis.FakeServer())
+    else:
+        store.POOL = redis.ConnectionPool(
+                        connection_class=store.CountingConnection,
+                        host=utils.get_setting('REDIS_HOST', 'localhost'),
+                        port=utils.get_setting('REDIS_PORT', 6379),
+                        db=args.redis_db)
+    r = store.get_redis()
+    if r.dbsize():
+        if not args.flush:
+            sys.stderr.write('Redis database %d is not empty, use --flush\n'
+                             % args.redis_db)
+            sys.exit(2)
+        r.flushdb()
+
+    wdir = tempfile.mkdtemp(prefix='medusa-benchmark-')
+    try:
+        lengths = contig_lengths(args.size, args.contigs, args.distribution,
+                                 args.seed)
+        draft = os.path.join(wdir, 'draft.fasta')
+        write_fasta(draft, lengths, seed=args.seed)
+        targets = []
+        for i in range(args.targets):
+            fname = os.path.join(wdir, 'target%d.fasta' % (i + 1))
+            write_fasta(fname,
+                        contig_lengths(args.size, args.contigs // 4 or 1,
+                                       args.distribution, args.seed + i + 1),
+                        seed=args.seed + i + 1)
+            targets.append(fname)
+
+        seed_jobs(r, args.jobs, args.days, args.seed)
+        # Each hot path runs in its own process: build the rollups here
+        store.backfill_stats()
+
+        results = {}
+        for name, func, nbytes in benchmarks(wdir, lengths, draft, targets):
+            if args.only and args.only not in name:
+                continue
+            sys.stderr.write('%s... ' % name)
+            results[name] = measure(func, args.repeat, nbytes)
+            sys.stderr.write('%s\n' % results[name].get('p50',
+                                                 results[name].get('error')))
+    finally:
+        shutil.rmtree(wdir)
+        if not args.fake:
+            r.flushdb()
+
+    params = dict(vars(args))
+    for k in ('output', 'baseline', 'flush'):
+        params.pop(k)
+    out = {'params': params,
+           'python': platform.python_version(),
+           'machine': platform.node(),
+           'date': time.asctime(),
+           'results': results}
+
+    f = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(out, f, indent=2, sort_keys=True)
+    f.write('\n')
+    if args.output:
+        f.close()
+
+    if args.baseline:
+        baseline = json.load(open(args.baseline))['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            sys.stderr.write('Regression: %s\n' % line)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+'''
+Content-addressed store of the uploaded genomes
+
+Each distinct (decompressed) upload is kept once, as
+BLOBS_FOLDER/<hash[:2]>/<hash>, and hard-linked into the job
+directories, so that the jobs (and Medusa) still see plain files.
+The references of each blob are counted in redis; blobs nobody has
+referenced for BLOBS_GRACE seconds are removed by the retention
+'''
+
+import errno
+import os
+import shutil
+import tempfile
+import time
+
+from store import acquire_blob
+from store import claim_blob
+from store import release_blobs
+from store import unused_blobs
+
+from utils import get_setting
+from utils import save_upload
+
+def blobs_folder():
+    '''Where the blobs are, on the same file system as the uploads'''
+    folder = get_setting('BLOBS_FOLDER')
+    if folder is None:
+        folder = os.path.join(get_setting('UPLOAD_FOLDER', 'uploads'),
+                              'blobs')
+    if not os.path.isabs(folder):
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              folder)
+    return folder
+
+def blob_path(h):
+    return os.path.join(blobs_folder(), h[:2], h)
+
+def _link(blob, dest):
+    try:
+        os.link(blob, dest)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        # Another file system, or too many links
+        shutil.copy(blob, dest)
+        os.chmod(dest, 0o644)
+
+def save_blob(storage, dirname, filename):
+    '''Save an uploaded file through the blob store
+
+    Same as utils.save_upload, the file in dirname being a link to
+    its blob; a reference to the blob is taken (info['sha256']).
+    The upload is read once, into a temporary file that becomes the
+    blob, or is dropped if the content is stored already
+    '''
+    tmpdir = os.path.join(blobs_folder(), 'tmp')
+    try:
+        os.makedirs(tmpdir)
+    except OSError:
+        pass
+    tmp = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        name, info = save_upload(storage, tmp, filename)
+        h = info['sha256']
+        blob = blob_path(h)
+        dest = os.path.join(dirname, name)
+        acquire_blob(h)
+        try:
+            try:
+                _link(blob, dest)
+            except OSError as e:
+                # A new content (or just removed)
+                if e.errno != errno.ENOENT:
+                    raise
+                try:
+                    os.mkdir(os.path.dirname(blob))
+                except OSError:
+                    pass
+                # Read only: it is shared by the jobs
+                os.chmod(os.path.join(tmp, name), 0o444)
+                os.rename(os.path.join(tmp, name), blob)
+                _link(blob, dest)
+        except:
+            release_blobs([h])
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return name, info
+
+def link_blob(h, dest):
+    '''Link a stored blob to dest, taking a reference to it'''
+    acquire_blob(h)
+    try:
+        _link(blob_path(h), dest)
+    except:
+        release_blobs([h])
+        raise
+
+def collect_blobs(grace=None, batch=100):
+    '''Remove the blobs unused for grace seconds
+
+    Returns the number of blobs and bytes reclaimed
+    '''
+    if grace is None:
+        grace = get_setting('BLOBS_GRACE', 3600)
+
+    removed = 0
+    reclaimed = 0
+    while True:
+        hashes = unused_blobs(time.time() - grace, batch)
+        if not hashes:
+            break
+        for h in hashes:
+            if not claim_blob(h):
+                continue
+            blob = blob_path(h)
+            try:
+                st = os.stat(blob)
+                os.remove(blob)
+            except OSError:
+                continue
+            removed += 1
+            # Only what is not linked by some job anymore
+            if st.st_nlink == 1:
+                reclaimed += st.st_blocks * 512
+    return removed, reclaimed
@@ -0,0 +1,81 @@
+'''
+Shared test fixtures
+
+The tests run against fakeredis: redis.Redis is replaced before
+store (which registers its scripts at import) is imported
+'''
+
+import os
+import stat
+
+import fakeredis
+import pytest
+import redis
+
+server = fakeredis.FakeServer()
+
+class FakeRedis(fakeredis.FakeRedis):
+    def __init__(self, *args, **kwargs):
+        fakeredis.FakeRedis.__init__(self, server=server)
+
+def _load_scripts(self):
+    # The pipelines of this redis-py version use the script cache
+    # of their connection pool, there is none here
+    for s in self.scripts:
+        s.sha = self.immediate_execute_command('SCRIPT LOAD', s.script)
+
+redis.Redis = FakeRedis
+redis.StrictRedis = FakeRedis
+redis.client.BasePipeline.load_scripts = _load_scripts
+
+# Fake Medusa: copies the draft as the scaffold, after FAKE_SLEEP seconds
+JAVA = '''#!/bin/sh
+shift; shift
+if [ "$1" = "-h" ]; then echo "Medusa version 1.6"; exit 0; fi
+while [ $# -gt 0 ]; do
+  case $1 in -i) IN=$2; shift;; -o) OUT=$2; shift;; esac; shift
+done
+ls medusa_scripts >/dev/null || exit 3
+echo "running on $IN"
+sleep ${FAKE_SLEEP:-0}
+cp $IN $OUT
+'''
+
+@pytest.fixture(autouse=True)
+def r():
+    '''An empty redis for each test'''
+    client = FakeRedis()
+    client.flushall()
+    yield client
+    client.connection_pool.disconnect()
+
+def write_fasta(path, lengths, width=60):
+    '''A FASTA file with one record of each length'''
+    f = open(str(path), 'w')
+    for i, n in enumerate(lengths):
+        f.write('>contig%d\n' % (i + 1))
+        seq = ('ACGT' * (n // 4 + 1))[:n]
+        for j in range(0, n, width):
+            f.write(seq[j:j + width] + '\n')
+    f.close()
+    return str(path)
+
+@pytest.fixture
+def medusa(tmpdir, monkeypatch):
+    '''A fake Medusa bundle, and java on the PATH'''
+    import settings
+
+    bundle = tmpdir.mkdir('medusa-app')
+    bundle.join('medusa.jar').write('not a jar')
+    bundle.mkdir('medusa_scripts')
+
+    bin = tmpdir.mkdir('bin')
+    java = bin.join('java')
+    java.write(JAVA)
+    java.chmod(stat.S_IRWXU)
+
+    monkeypatch.setenv('PATH', '%s:%s' % (bin, os.environ['PATH']))
+    monkeypatch.setenv('FAKE_SLEEP', '0')
+    monkeypatch.setattr(settings, 'MEDUSA_FOLDER', str(bundle),
+                        raising=False)
+    return str(bundle)
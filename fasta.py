@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+import bz2
+import gzip
+import re
+
+import numpy as np
+
+# Bytes read at once
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Stop collecting format errors after this many
+MAX_ERRORS = 10
+
+# IUPAC nucleotide codes and gap symbols
+NUCLEOTIDES = b'ACGTURYSWKMBDHVNacgturyswkmbdhvn-.'
+GC = [ord(c) for c in 'GCgc']
+GAP = re.compile(b'[Nn]+')
+
+# Bytes of an upload fully checked before it is accepted
+# (then only its headers are)
+PREFLIGHT_PREFIX = 64 * 1024
+# Longest header line accepted
+MAX_HEADER = 64 * 1024
+
+# Amino acids one letter codes (beyond the nucleotide ones)
+PROTEIN = b'EFILPQXZJOefilpqxzjo*'
+
+class FormatError(Exception):
+    pass
+
+def open_fasta(fname):
+    '''Open a plain, gzip or bzip2 compressed file for reading
+
+    The compression is detected from the file content
+    '''
+    f = open(fname, 'rb')
+    magic = f.read(3)
+    f.close()
+
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(fname, 'rb')
+    elif magic == b'BZh':
+        return bz2.BZ2File(fname, 'rb')
+    return open(fname, 'rb')
+
+class FastaScanner(object):
+    '''Single pass statistics of a FASTA stream
+
+    Feed it with chunks of any size, then call close(); it keeps
+    only the contig lengths and a few counters, never the sequences
+    '''
+    def __init__(self):
+        self.lengths = []
+        self.gc = 0
+        self.n = 0
+        self.gaps = 0
+        self.errors = []
+
+        # Length of the current record (None before the first header)
+        self._length = None
+        self._name = None
+        self._invalid = False
+        self._in_gap = False
+        # True when the next byte starts a new line
+        self._bol = True
+        # An incomplete header line, waiting for the next chunk
+        self._carry = b''
+
+    def error(self, msg):
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append(msg)
+
+    def feed(self, data):
+        data = self._carry + data
+        self._carry = b''
+
+        pos = 0
+        size = len(data)
+        while pos < size:
+            if self._bol and data[pos:pos+1] == b'>':
+                end = data.find(b'\n', pos)
+                if end < 0:
+                    self._carry = data[pos:]
+                    return
+                self._header(data[pos+1:end])
+                pos = end + 1
+                continue
+
+            # Everything up to the next header is sequence
+            end = data.find(b'\n>', pos)
+            if end < 0:
+                end = size
+            else:
+                end += 1
+            self._sequence(data[pos:end])
+            self._bol = data[end-1:end] == b'\n'
+            pos = end
+
+    def close(self):
+        if self._carry:
+            self._header(self._carry)
+            self._carry = b''
+        self._end_record()
+
+        if not self.lengths and not self.errors:
+            self.error('No FASTA records found')
+
+    def gc_content(self):
+        '''GC percentage, ignoring Ns'''
+        bases = sum(self.lengths) - self.n
+        if bases <= 0:
+            return 0.0
+        return round(self.gc * 100.0 / bases, 2)
+
+    def _header(self, line):
+        self._end_record()
+
+        line = line.strip()
+        if not line:
+            self.error('Empty header line')
+        self._name = line.split()[0] if line else ''
+        self._length = 0
+        self._invalid = False
+        self._in_gap = False
+
+    def _end_record(self):
+        if self._length is None:
+            return
+        if self._length == 0:
+            self.error('Empty sequence for record "%s"' % self._name)
+        self.lengths.append(self._length)
+        self._length = None
+
+    def _sequence(self, data):
+        seq = data.replace(b'\n', b'')
+        if b'\r' in seq or b' ' in seq or b'\t' in seq:
+            seq = seq.translate(None, b'\r \t')
+        if not seq:
+            return
+
+        if self._length is None:
+            if not self._invalid:
+                self._invalid = True
+                self.error('Sequence data found before the first header' +
+                           ' (is this a FASTA file?)')
+            return
+
+        self._length += len(seq)
+        # Vectorized comparisons are way faster than str.count
+        a = np.frombuffer(seq, dtype=np.uint8)
+        for c in GC:
+            self.gc += int(np.count_nonzero(a == c))
+
+        if not self._invalid and seq.translate(None, NUCLEOTIDES):
+            self._invalid = True
+            self.error('Invalid characters in record "%s"' % self._name)
+
+        # Gaps (runs of Ns), which may span chunks;
+        # jump straight to each of them
+        if not (np.count_nonzero(a == 78) or np.count_nonzero(a == 110)):
+            self._in_gap = False
+            return
+        pos = self._next_gap(seq, 0)
+        while pos >= 0:
+            end = GAP.match(seq, pos).end()
+            if not (pos == 0 and self._in_gap):
+                self.gaps += 1
+            self.n += end - pos
+            pos = self._next_gap(seq, end)
+        self._in_gap = seq[-1:] in (b'N', b'n')
+
+    @staticmethod
+    def _next_gap(seq, start):
+        upper = seq.find(b'N', start)
+        lower = seq.find(b'n', start)
+        if upper < 0 or 0 <= lower < upper:
+            return lower
+        return upper
+
+class Preflight(object):
+    '''Quick checks of an upload, fed with its chunks as it is saved
+
+    The first PREFLIGHT_PREFIX bytes are checked as a whole (format,
+    characters), then only the record headers (empty records, empty
+    or duplicated ids). A FormatError is raised on the first problem
+    '''
+    def __init__(self, prefix=PREFLIGHT_PREFIX):
+        self.size = 0
+        self.records = 0
+        self.ids = set()
+
+        self._prefix = b''
+        self._prefix_size = prefix
+        self._checked = False
+        self._carry = b''
+        self._bol = True
+        self._last = None
+        self._after_header = False
+
+    def feed(self, data):
+        self.size += len(data)
+        if not self._checked:
+            self._prefix += data[:self._prefix_size - len(self._prefix)]
+            if len(self._prefix) >= self._prefix_size:
+                self._check_prefix(complete=False)
+        self._headers(data)
+
+    def close(self):
+        if not self._checked:
+            self._check_prefix(complete=True)
+        if self._carry:
+            self._header(self._carry[1:].rstrip(b'\r'))
+            self._carry = b''
+        if not self.records:
+            raise FormatError('No FASTA records found')
+
+    def _check_prefix(self, complete):
+        prefix = self._prefix
+        self._prefix = b''
+        self._checked = True
+
+        if not prefix.strip():
+            raise FormatError('The file is empty')
+        if b'\0' in prefix:
+            raise FormatError('This is a binary file, not a FASTA one ' +
+                              '(only gzip and bzip2 compression is supported)')
+        first = prefix.lstrip()[:5]
+        if first.startswith(b'LOCUS'):
+            raise FormatError('This looks like a GenBank file, ' +
+                              'please convert it to FASTA')
+        if first.startswith(b'ID '):
+            raise FormatError('This looks like an EMBL file, ' +
+                              'please convert it to FASTA')
+        if first.startswith(b'@'):
+            raise FormatError('This looks like a FASTQ file (reads), ' +
+                              'an assembly in FASTA format is needed')
+
+        scanner = FastaScanner()
+        scanner.feed(prefix)
+        if complete:
+            scanner.close()
+        if not scanner.errors:
+            return
+        if scanner.errors[0].startswith('Invalid characters'):
+            seq = b''.join(line for line in prefix.split(b'\n')
+                           if not line.startswith(b'>'))
+            odd = seq.translate(None, NUCLEOTIDES + b' \t\r')
+            if odd and not odd.translate(None, PROTEIN):
+                raise FormatError('This looks like protein sequences, ' +
+                                  'nucleotide ones are needed')
+        raise FormatError(scanner.errors[0])
+
+    def _headers(self, data):
+        buf = self._carry + data
+        self._carry = b''
+        if not buf:
+            return
+
+        # A header line right at the end of the previous chunk
+        after_header = self._after_header
+        self._after_header = False
+        if self._bol and buf[:1] == b'>':
+            if after_header:
+                raise FormatError('Empty sequence for record "%s"'
+                                  % self._last)
+            start = 0
+        else:
+            start = buf.find(b'\n>')
+            start = start + 1 if start >= 0 else -1
+        while start >= 0:
+            end = buf.find(b'\n', start)
+            if end < 0:
+                if len(buf) - start > MAX_HEADER:
+                    raise FormatError('Header line too long')
+                self._carry = buf[start:]
+                self._bol = True
+                return
+            self._header(buf[start+1:end].rstrip(b'\r'))
+            if end == len(buf) - 1:
+                self._after_header = True
+            start = buf.find(b'\n>', end)
+            if start == end:
+                raise FormatError('Empty sequence for record "%s"'
+                                  % self._last)
+            start = start + 1 if start >= 0 else -1
+        self._bol = buf[-1:] == b'\n'
+
+    def _header(self, line):
+        fields = line.split(None, 1)
+        if not fields:
+            raise FormatError('Empty header line')
+        if fields[0] in self.ids:
+            raise FormatError('Duplicate record id "%s"' % fields[0])
+        self.ids.add(fields[0])
+        self._last = fields[0]
+        self.records += 1
+
+def scan_fasta(fname, chunk_size=CHUNK_SIZE):
+    '''Return a FastaScanner fed with the whole content of a file'''
+    scanner = FastaScanner()
+
+    f = open_fasta(fname)
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            scanner.feed(chunk)
+    finally:
+        f.close()
+    scanner.close()
+
+    return scanner
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+'''
+Load test of the web app
+
+Drives the real routes over HTTP with a growing number of concurrent
+clients, reporting the throughput and tail latency of each route at
+each step:
+
+    submitters     upload genomes to /run, then follow their job
+                   (/results, then /status polling) until it is over
+    waiting users  poll the status of the submitted jobs
+    stats readers  load /stats and its data endpoints
+
+    python loadtest.py [--clients 1,2,4,8,16] [--duration 30] [-o report.json]
+
+By default the app is served here (threaded werkzeug server) on the
+REDIS_DB_BENCHMARK redis database, with worker slots running a fake
+Medusa that sleeps and writes a scaffold made of the draft contigs.
+--url drives a deployed server instead (its jobs and stats included)
+'''
+
+import argparse
+import Cookie
+import httplib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import uuid
+
+import numpy as np
+import redis
+
+import store
+import tasks
+from benchmark import contig_lengths
+from benchmark import write_fasta
+from utils import get_setting
+
+# Client kinds
+SUBMIT = 'submit'
+WAIT = 'wait'
+STATS = 'stats'
+
+STATS_PAGES = ['/stats', '/stats/jobs', '/stats/ips', '/stats/emails']
+
+# Stand-in for "java -jar medusa.jar": sleeps, then joins the draft
+# contigs five at a time with gaps
+FAKE_JAVA = '''#!%(python)s
+import os, sys, time
+args = sys.argv[1:]
+if '-h' in args:
+    print 'Medusa version loadtest'
+    sys.exit(0)
+draft = args[args.index('-i') + 1]
+out = args[args.index('-o') + 1]
+time.sleep(%(sleep)f + %(sleep_mb)f * os.path.getsize(draft) / 1e6)
+seqs = [s.split('\\n', 1)[1].replace('\\n', '')
+        for s in open(draft).read().split('>')[1:]]
+f = open(out, 'w')
+for i in range(0, len(seqs), 5):
+    seq = ('N' * 100).join(seqs[i:i+5])
+    f.write('>Scaffold_%%d\\n' %% (i // 5 + 1))
+    for j in range(0, len(seq), 60):
+        f.write(seq[j:j+60] + '\\n')
+f.close()
+print 'Scaffolding done'
+'''
+
+def route(path):
+    '''Route of a path, to group the timings'''
+    parts = path.split('?')[0].split('/')
+    if len(parts) > 2 and parts[1] in ('results', 'status', 'events',
+                                        'log', 'err', 'scaffold'):
+        return '/%s/<req_id>' % parts[1]
+    return '/'.join(parts)
+
+def multipart(fields, files):
+    '''Body and content type of a multipart/form-data request
+
+    files is a list of (field, path) pairs
+    '''
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"'
+                     '\r\n\r\n%s\r\n' % (boundary, name, value))
+    for name, path in files:
+        parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                     'filename="%s"\r\nContent-Type: application/octet-stream'
+                     '\r\n\r\n' % (boundary, name, os.path.basename(path)))
+        parts.append(open(path, 'rb').read())
+        parts.append('\r\n')
+    parts.append('--%s--\r\n' % boundary)
+    return ''.join(parts), 'multipart/form-data; boundary=%s' % boundary
+
+class Recorder(object):
+    '''Latencies and errors of each route, shared by the clients'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, path, seconds, ok):
+        r = route(path)
+        with self.lock:
+            self.latencies.setdefault(r, []).append(seconds)
+            if not ok:
+                self.errors[r] = self.errors.get(r, 0) + 1
+
+    def report(self, duration):
+        d = {}
+        for r, latencies in sorted(self.latencies.items()):
+            a = np.array(latencies)
+            d[r] = {'requests': len(a),
+                    'errors': self.errors.get(r, 0),
+                    'rps': round(len(a) / duration, 3),
+                    'p50': round(float(np.percentile(a, 50)), 4),
+                    'p95': round(float(np.percentile(a, 95)), 4),
+                    'p99': round(float(np.percentile(a, 99)), 4),
+                    'max': round(float(a.max()), 4)}
+        return d
+
+class Client(threading.Thread):
+    '''A browser: one request at a time, keeping the session cookie'''
+    def __init__(self, kind, base, recorder, jobs, args, stop):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.kind = kind
+        self.base = urlparse.urlparse(base)
+        self.recorder = recorder
+        self.jobs = jobs
+        self.args = args
+        self.stop = stop
+        self.cookie = None
+
+    def request(self, method, path, body=None, headers=None, cookie=None):
+        headers = dict(headers or {})
+        cookie = cookie or self.cookie
+        if cookie:
+            headers['Cookie'] = cookie
+
+        start = time.time()
+        try:
+            conn = httplib.HTTPConnection(self.base.hostname,
+                                          self.base.port or 80,
+                                          timeout=self.args.timeout)
+            conn.request(method, self.base.path.rstrip('/') + path,
+                         body, headers)
+            response = conn.getresponse()
+            response.body = response.read()
+            conn.close()
+        except Exception:
+            self.recorder.add(path, time.time() - start, False)
+            return None
+        self.recorder.add(path, time.time() - start,
+                          response.status < 400)
+
+        if response.getheader('set-cookie'):
+            c = Cookie.SimpleCookie(response.getheader('set-cookie'))
+            if 'session' in c:
+                self.cookie = 'session=%s' % c['session'].value
+        return response
+
+    def think(self):
+        self.stop.wait(random.expovariate(1.0 / self.args.think)
+                       if self.args.think else 0)
+
+    def run(self):
+        while not self.stop.is_set():
+            if self.kind == SUBMIT:
+                self.submit()
+            elif self.kind == WAIT:
+                self.wait()
+            else:
+                self.request('GET', random.choice(STATS_PAGES))
+                self.think()
+
+    def submit(self):
+        draft, targets = random.choice(self.args.genomes)
+        fields = {'email': 'loadtest@example.com', 'passphrase': ''}
+        if not self.args.cache:
+            fields['nocache'] = '1'
+        body, ctype = multipart(fields, [('draft', draft)] +
+                                        [('genomes', t) for t in targets])
+
+        self.cookie = None
+        response = self.request('POST', '/run', body,
+                                {'Content-Type': ctype})
+        if response is None or response.status != 302:
+            self.think()
+            return
+        location = urlparse.urlparse(response.getheader('location')).path
+        location = location[len(self.base.path.rstrip('/')):]
+        if not location.startswith('/results/'):
+            self.think()
+            return
+        req_id = location.rsplit('/', 1)[-1]
+        self.jobs.append((req_id, self.cookie))
+
+        # The waiting page, then its polling
+        self.request('GET', '/results/%s' % req_id)
+        self.follow(req_id, self.cookie)
+        self.request('GET', '/results/%s' % req_id)
+        self.think()
+
+    def follow(self, req_id, cookie):
+        while not self.stop.is_set():
+            response = self.request('GET', '/status/%s' % req_id,
+                                    cookie=cookie)
+            if response is None or response.status >= 400:
+                return
+            if json.loads(response.body)['status'] in ('Job done',
+                                                       'Job failed'):
+                return
+            self.stop.wait(self.args.poll)
+
+    def wait(self):
+        if not self.jobs:
+            self.request('GET', '/')
+            self.think()
+            return
+        req_id, cookie = random.choice(self.jobs[-50:])
+        self.request('GET', '/status/%s' % req_id, cookie=cookie)
+        self.stop.wait(self.args.poll)
+
+def clients_kinds(n, mix):
+    '''Kinds of n clients, following the submit:wait:stats mix'''
+    pattern = []
+    for kind, weight in zip((SUBMIT, WAIT, STATS), mix):
+        pattern.extend([kind] * weight)
+    return [pattern[i % len(pattern)] for i in range(n)]
+
+def run_level(base, n, args, jobs):
+    recorder = Recorder()
+    stop = threading.Event()
+    clients = [Client(kind, base, recorder, jobs, args, stop)
+               for kind in clients_kinds(n, args.mix)]
+    start = time.time()
+    for c in clients:
+        c.start()
+    stop.wait(args.duration)
+    stop.set()
+    for c in clients:
+        c.join(args.timeout)
+    return recorder.report(time.time() - start)
+
+def fake_medusa(wdir, args):
+    '''A bundle and a java command (first in PATH) faking Medusa'''
+    bundle = os.path.join(wdir, 'medusa-app')
+    os.makedirs(os.path.join(bundle, 'medusa_scripts'))
+    open(os.path.join(bundle, 'medusa.jar'), 'w').close()
+
+    bindir = os.path.join(wdir, 'bin')
+    os.mkdir(bindir)
+    java = os.path.join(bindir, 'java')
+    f = open(java, 'w')
+    f.write(FAKE_JAVA % {'python': sys.executable,
+                         'sleep': args.medusa_sleep,
+                         'sleep_mb': args.medusa_sleep_mb})
+    f.close()
+    os.chmod(java, os.stat(java).st_mode | stat.S_IXUSR)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ.get('PATH', '')
+
+    return bundle
+
+def serve(wdir, args):
+    '''Serve the app here, with worker slots, return its URL'''
+    from werkzeug.serving import make_server
+    import medusa
+    import worker
+
+    bundle = fake_medusa(wdir, args)
+    tasks.medusa_bundle = lambda: bundle
+
+    medusa.app.config['UPLOAD_FOLDER'] = os.path.join(wdir, 'uploads')
+    os.mkdir(medusa.app.config['UPLOAD_FOLDER'])
+    # All the clients come from here: no rate limits, no queue limit
+    medusa.app.config['SUBMISSIONS_PER_HOUR'] = None
+    medusa.app.config['QUEUE_MAX_LENGTH'] = None
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    slots = [multiprocessing.Process(target=worker.run_slot)
+             for i in range(args.slots)]
+    for p in slots:
+        p.start()
+
+    server = make_server('127.0.0.1', 0, medusa.app, threaded=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    return 'http://127.0.0.1:%d' % server.server_port, slots
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--clients', default='1,2,4,8,16',
+                        help='Concurrent clients at each step')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds spent at each step')
+    parser.add_argument('--mix', default='1:4:2',
+                        help='Submitters, waiting users and stats readers')
+    parser.add_argument('--upload-size', type=int, default=1000000,
+                        help='Draft genome size (bases)')
+    parser.add_argument('--targets', type=int, default=2,
+                        help='Target genomes per submission')
+    parser.add_argument('--uploads', type=int, default=4,
+                        help='Different submissions to choose from')
+    parser.add_argument('--cache', action='store_true',
+                        help='Let identical submissions hit the cache')
+    parser.add_argument('--poll', type=float, default=2,
+                        help='Seconds between status requests')
+    parser.add_argument('--think', type=float, default=1,
+                        help='Mean seconds between other requests')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--slots', type=int, default=2,
+                        help='Worker slots (local server only)')
+    parser.add_argument('--medusa-sleep', type=float, default=5,
+                        help='Seconds taken by the fake Medusa...')
+    parser.add_argument('--medusa-sleep-mb', type=float, default=1,
+                        help='...plus these per draft MB')
+    parser.add_argument('--url', default=None,
+                        help='Drive this server instead of a local one')
+    parser.add_argument('--flush', action='store_true',
+                        help='Empty the scratch redis database first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('-o', '--output', default=None,
+                        help='Report file (default: stdout)')
+    args = parser.parse_args()
+    args.mix = [int(x) for x in args.mix.split(':')]
+    random.seed(args.seed)
+
+    wdir = tempfile.mkdtemp(prefix='medusa-loadtest-')
+    slots = []
+    r = None
+    try:
+        args.genomes = []
+        for i in range(args.uploads):
+            seed = args.seed + i * (args.targets + 1)
+            draft = os.path.join(wdir, 'draft%d.fasta' % (i + 1))
+            write_fasta(draft, contig_lengths(args.upload_size, 100,
+                                              seed=seed), seed=seed)
+            targets = []
+            for j in range(args.targets):
+                target = os.path.join(wdir, 'target%d_%d.fasta' % (i + 1,
+                                                                    j + 1))
+                write_fasta(target, contig_lengths(args.upload_size, 20,
+                                                   seed=seed + j + 1),
+                            seed=seed + j + 1)
+                targets.append(target)
+            args.genomes.append((draft, targets))
+
+        if args.url is None:
+            # Never touch the application database
+            store.POOL = redis.ConnectionPool(
+                            connection_class=store.CountingConnection,
+                            host=get_setting('REDIS_HOST', 'localhost'),
+                            port=get_setting('REDIS_PORT', 6379),
+                            db=get_setting('REDIS_DB_BENCHMARK', 15))
+            r = store.get_redis()
+            if r.dbsize():
+                if not args.flush:
+                    sys.stderr.write('Redis database %d is not empty, '
+                                     'use --flush\n'
+                                     % get_setting('REDIS_DB_BENCHMARK', 15))
+                    sys.exit(2)
+                r.flushdb()
+            base, slots = serve(wdir, args)
+        else:
+            base = args.url
+
+        jobs = []
+        levels = []
+        for n in [int(x) for x in args.clients.split(',')]:
+            sys.stderr.write('%d clients...\n' % n)
+            routes = run_level(base, n, args, jobs)
+            levels.append({'clients': n, 'routes': routes})
+            for name, d in sorted(routes.items()):
+                sys.stderr.write('  %-20s %6d req %8.2f rps  p50 %.3fs  '
+                                 'p95 %.3fs  p99 %.3fs  %d errors\n'
+                                 % (name, d['requests'], d['rps'], d['p50'],
+                                    d['p95'], d['p99'], d['errors']))
+    finally:
+        for p in slots:
+            p.terminate()
+            p.join()
+        if r is not None:
+            r.flushdb()
+        shutil.rmtree(wdir)
+
+    params = dict(vars(args))
+    for k in ('output', 'flush', 'genomes'):
+        params.pop(k)
+    out = {'params': params,
+           'date': time.asctime(),
+           'levels': levels}
+
+    f = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(out, f, indent=2, sort_keys=True)
+    f.write('\n')
+    if args.output:
+        f.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,78 @@
 #!/usr/bin/env python
 
 import os
-import sys
 import json
-import subprocess
+import gzip
+import hashlib
+import math
+import shutil
 import time
+from datetime import date, datetime
 from flask import Flask, request, session, g, redirect, url_for, abort, \
-     render_template, flash, escape, Response, send_from_directory
+     render_template, flash, escape, Response, send_from_directory, \
+     send_file, make_response
 from werkzeug.utils import secure_filename
 
 from utils import generate_hash
 from utils import generate_time_hash
+from utils import read_file
+from utils import tail_offset
+from utils import disk_usage
+from utils import LRUCache
+from utils import tar_stream
+from utils import free_space
 
 from store import add_job
 from store import retrieve_job
+from store import update_job_fields
+from store import get_cached_result
+from store import cache_result
+from store import enqueue_job
+from store import queue_position
+from store import job_progress
+from store import subscribe_job
+from store import release_blobs
+from store import release_job_blobs
+from store import add_batch
+from store import retrieve_batch
+from store import retrieve_jobs
+from store import jobs_status
+from store import admit
+from store import count_rejection
+from store import rejection_counters
+
+from blobs import save_blob
+from blobs import link_blob
+
+from fasta import FormatError
+
+from tasks import job_fingerprint
+from tasks import medusa_runs
+from tasks import multi_waves
+from tasks import MULTI
+from runtime import features_from_inputs
+from runtime import job_limits
+from runtime import DEFAULT_LATE
+from runtime import DEFAULT_TIMEOUT
+from tasks import reuse_results
+from tasks import artifacts_manifest
 from store import cumulative_jobs
 from store import unique_ips
 from store import unique_emails
+from store import first_stats_day
+from store import reset_roundtrips
+from store import roundtrips
+from store import redis_seconds
+from store import get_redis
+from store import queue_length
+from store import running_jobs
+from store import stats_cache_counters
+from store import disk_counters
+from store import set_job_disk
+
+from metrics import labels
+from metrics import observe
+from metrics import exposition
 
 import settings
 
@@ -47,43 +103,302 @@ try:
 except ImportError:
     pass
 
+# Pollers and static files are not timed: a redis write
+# for each would be most of the work of serving them
+UNTIMED = set(['status', 'events', 'batch_status', 'static'])
+
+@app.before_request
+def count_roundtrips():
+    g.start = time.time()
+    reset_roundtrips()
+
+@app.after_request
+def report_roundtrips(response):
+    # Redis round-trips needed to serve this request
+    count = roundtrips()
+    response.headers['X-Redis-Roundtrips'] = str(count)
+
+    # Latency histograms, per route
+    # (streamed responses are timed until their headers are ready)
+    if request.endpoint in UNTIMED:
+        return response
+    rule = request.url_rule.rule if request.url_rule else 'unknown'
+    l = labels(route=rule)
+    try:
+        p = get_redis().pipeline(transaction=False)
+        observe(p, 'medusa_request_seconds', time.time() - g.start, l)
+        observe(p, 'medusa_request_redis_seconds', redis_seconds(), l)
+        observe(p, 'medusa_request_redis_roundtrips', count, l)
+        p.execute()
+    except Exception as e:
+        app.logger.warning('Could not record the request metrics: %s' % e)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    counters = stats_cache_counters()
+    disk = disk_counters()
+    text = exposition(get_redis(),
+        gauges={'medusa_queue_length': ('Jobs waiting in the queue',
+                                        queue_length()),
+                'medusa_running_jobs': ('Jobs being run by the workers',
+                                        running_jobs()),
+                'medusa_uploads_bytes': ('Disk space taken by the ' +
+                                         'finished jobs', disk['used'])},
+        counters={'medusa_stats_cache_hits_total':
+                      ('Genome statistics found in the cache',
+                       counters['hits']),
+                  'medusa_stats_cache_misses_total':
+                      ('Genome statistics not found in the cache',
+                       counters['misses']),
+                  'medusa_reclaimed_bytes_total':
+                      ('Disk space reclaimed by the retention',
+                       disk['reclaimed']),
+                  'medusa_rejected_submissions_total':
+                      ('Submissions turned away, per reason',
+                       dict((labels(reason=k), v) for k, v in
+                            rejection_counters().items()))})
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def turn_away(reason, status, retry_after, message):
+    '''A submission refused before its inputs are saved'''
+    count_rejection(reason)
+    flash(message, 'danger')
+    template = 'batch.html' if request.endpoint == 'batch' else 'index.html'
+    response = make_response(render_template(template,
+                                 max_drafts=app.config['BATCH_MAX_DRAFTS']),
+                             status)
+    response.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    return response
+
+def submissions_rate():
+    '''Submissions per second allowed to each client (None: no limit)'''
+    per_hour = app.config['SUBMISSIONS_PER_HOUR']
+    return per_hour / 3600.0 if per_hour else None
+
+def admission():
+    '''Turn a submission away, before its body is even read, when the
+    uploads disk or the queue are full, or its client over its rate
+    '''
+    retry = app.config['ADMISSION_RETRY_AFTER']
+    try:
+        # Room for the upload, and then some
+        min_free = app.config['UPLOADS_MIN_FREE']
+        if (min_free is not None and
+            free_space(app.config['UPLOAD_FOLDER']) <
+                (request.content_length or 0) + min_free):
+            return turn_away('disk', 503, retry,
+                             u'The server is running out of disk space, ' +
+                             u'please try again later')
+
+        wait = admit('ip_%s' % generate_hash(request.remote_addr),
+                     submissions_rate(), app.config['SUBMISSIONS_BURST'],
+                     max_queue=app.config['QUEUE_MAX_LENGTH'])
+    except Exception as e:
+        # Better to let it in than to stop all the submissions
+        app.logger.warning('Could not check the submission: %s' % e)
+        return None
+    if wait < 0:
+        return turn_away('queue', 503, retry,
+                         u'The server is too busy right now, ' +
+                         u'please try again later')
+    if wait > 0:
+        return turn_away('ip', 429, wait,
+                         u'Too many submissions from your address, ' +
+                         u'please try again in %d minutes'
+                         % math.ceil(wait / 60))
+    return None
+
+def email_admission(hemail, cost=1):
+    '''Turn a submission away when its email is over its rate
+
+    The email is a form field: by now the body has been read
+    (spooled), only the job directory and queue are spared
+    '''
+    try:
+        wait = admit('email_%s' % hemail, submissions_rate(),
+                     app.config['SUBMISSIONS_BURST'], cost)
+    except Exception as e:
+        app.logger.warning('Could not check the submission: %s' % e)
+        return None
+    if wait > 0:
+        return turn_away('email', 429, wait,
+                         u'Too many submissions from your email, ' +
+                         u'please try again in %d minutes'
+                         % math.ceil(wait / 60))
+    return None
+
+def new_job_dir(key):
+    '''A new job id, and its (empty) working directory'''
+    # First things first, compute user hash
+    req_id = generate_time_hash(key)
+
+    # To avoid slow-downs in the running directory
+    # create subdirs w/ the first 2 chars of the hash
+    h2c = req_id[:2]
+    try:
+        os.mkdir(os.path.join(app.config['UPLOAD_FOLDER'],
+                              h2c))
+    except:
+        pass
+
+    # Prepare the working directory
+    # Our hash scheme ensures that it should be unique
+    wdir = os.path.join(app.config['UPLOAD_FOLDER'],
+                        h2c, req_id)
+    wdir = os.path.abspath(wdir)
+    os.mkdir(wdir)
+
+    return req_id, wdir
+
+def submit_job(req_id, wdir, dname, genomes, hashes, inputs, blobs,
+               hemail, hpass, cost=None, **extra):
+    '''Record a job whose inputs are saved, and queue it (or reuse
+    the results of an identical one)
+
+    Returns False, after flashing why, if it could not be submitted
+    '''
+    # Same inputs and Medusa, same results
+    fields = {'draft': dname,
+              'hashes': json.dumps(hashes),
+              'inputs': json.dumps(inputs),
+              'blobs': ' '.join(blobs)}
+    fields.update(extra)
+    options = None
+    waves = 1
+    if request.form.get('multi'):
+        # Many Medusa runs, keeping the best scaffold
+        fields['mode'] = MULTI
+        options = medusa_runs()
+        waves = multi_waves(options)
+    try:
+        fingerprint = job_fingerprint(hashes[dname],
+                                      [hashes[g] for g in genomes],
+                                      options)
+        fields['fingerprint'] = fingerprint
+    except Exception as e:
+        app.logger.error('Could not fingerprint the job: %s' % e)
+        fingerprint = None
+    # How long it should take
+    fields.update(job_limits(features_from_inputs(inputs, dname), waves))
+
+    try:
+        # Send details to redis
+        add_job(req_id, request.remote_addr, hemail, hpass, **fields)
+    except Exception as e:
+        release_blobs(blobs)
+        shutil.rmtree(wdir, ignore_errors=True)
+        flash(u'Could not save your job details (%s)' % e, 'danger')
+        return False
+
+    # Has this very job been run already?
+    if (fingerprint is not None and app.config['RESULTS_CACHE'] and
+        not request.form.get('nocache')):
+        src_id = get_cached_result(fingerprint)
+        if src_id is not None:
+            src_wdir = os.path.abspath(os.path.join(
+                                          app.config['UPLOAD_FOLDER'],
+                                          src_id[:2], src_id))
+            src_hashes = json.loads(retrieve_job(src_id).get('hashes',
+                                                             '{}'))
+            if reuse_results(src_wdir, wdir, src_hashes, hashes):
+                os.remove(os.path.join(wdir, dname))
+                shutil.rmtree(os.path.join(wdir, 'drafts'))
+                release_job_blobs(req_id)
+                update_job_fields(req_id, {'status': 'Job done',
+                                           'cached': src_id,
+                                           'manifest': json.dumps(
+                                            artifacts_manifest(wdir))})
+                cache_result(fingerprint, req_id)
+                set_job_disk(req_id, disk_usage(wdir))
+                return True
+
+    # Submit the job
+    try:
+        if cost is None:
+            # Its expected run time (none until there is a
+            # runtime model: first come, first served)
+            cost = fields.get('predicted', 0)
+        update_job_fields(req_id, {'wdir': wdir,
+                                   'draft': dname,
+                                   'targets': json.dumps(list(genomes))})
+        enqueue_job(req_id, cost)
+    except Exception as e:
+        # Nothing to keep
+        shutil.rmtree(wdir, ignore_errors=True)
+        release_job_blobs(req_id)
+        update_job_fields(req_id, {'status': 'Job failed',
+                                   'error': str(e)})
+        flash(u'Could not submit your job "%s"' % e,
+              'danger')
+        return False
+
+    return True
+
 @app.route('/run', methods=['GET', 'POST'])
 def run():
     # Here handle submissions and run the analysis
     # Send emails on failures, success
     # Use redis to store user stats (hashed for privacy)
     if request.method == 'POST':
-        # First things first, compute user hash
-        req_id = generate_time_hash(request.remote_addr)
+        # Can we take it?
+        denied = admission()
+        if denied is not None:
+            return denied
 
-        # To avoid slow-downs in the running directory
-        # create subdirs w/ the first 2 chars of the hash
-        h2c = req_id[:2]
-        try:
-            os.mkdir(os.path.join(app.config['UPLOAD_FOLDER'],
-                                  h2c))
-        except:
-            pass
+        # Check email, hash it
+        email = request.form['email']
+        if email:
+            hemail = generate_hash(email)
+        else:
+            flash(u'Something went wrong with your email', 'danger')
+            return redirect(url_for('index'))
+        denied = email_admission(hemail)
+        if denied is not None:
+            return denied
+        
+        # Secure my results?
+        passphrase = request.form['passphrase']
+        if passphrase:
+            hpass = generate_hash(passphrase)
+        else:
+            hpass = None
 
-        # Prepare the working directory
-        # Our hash scheme ensures that it should be unique
-        wdir = os.path.join(app.config['UPLOAD_FOLDER'],
-                            h2c, req_id)
-        wdir = os.path.abspath(wdir)
-        os.mkdir(wdir)
+        req_id, wdir = new_job_dir(request.remote_addr)
+
+        # Save input files, straight to where Medusa wants them
+        # (compressed files are expanded, the content hashed and
+        # kept once in the blobs store, the jobs get links)
+        hashes = {}
+        inputs = {}
+        blobs = []
+
+        def discard():
+            release_blobs(blobs)
+            shutil.rmtree(wdir, ignore_errors=True)
 
-        # Save input files
         draft = request.files['draft']
         #if draft and allowed_file(draft.filename):
-        if draft:
-            filename = secure_filename(draft.filename)
-            draft.save(os.path.join(wdir, filename))
-            dname = filename
-        else:
+        try:
+            if not draft:
+                raise Exception('no draft genome')
+            dname, info = save_blob(draft, wdir,
+                                    secure_filename(draft.filename))
+            hashes[dname] = info.pop('sha256')
+            blobs.append(hashes[dname])
+            inputs[dname] = info
+        except FormatError as e:
+            # Caught before it gets queued
+            discard()
+            flash(u'There is a problem with your draft genome (%s)' % e,
+                  'danger')
+            return redirect(url_for('index'))
+        except:
+            discard()
             flash(u'Something went wrong with your draft genome',
                   'danger')
             return redirect(url_for('index'))
@@ -91,64 +406,34 @@ def run():
         # Save the genomes files
         genomes = set()
         try:
+            os.mkdir(os.path.join(wdir, 'drafts'))
             for genome in request.files.getlist('genomes'):
-                filename = secure_filename(genome.filename)
-                genome.save(os.path.join(wdir, filename))
+                filename, info = save_blob(genome,
+                                           os.path.join(wdir, 'drafts'),
+                                           secure_filename(genome.filename))
+                hashes[filename] = info.pop('sha256')
+                blobs.append(hashes[filename])
+                inputs[filename] = info
                 genomes.add(filename)
+        except FormatError as e:
+            discard()
+            flash(u'There is a problem with your target genomes (%s)' % e,
+                  'danger')
+            return redirect(url_for('index'))
         except:
+            discard()
             flash(u'Something went wrong with your target genomes',
                  'danger')
             return redirect(url_for('index'))
                 
-        # Check email, hash it
-        email = request.form['email']
-        if email:
-            hemail = generate_hash(email)
-        else:
-            flash(u'Something went wrong with your email', 'danger')
-            return redirect(url_for('index'))
-        
-        # Secure my results?
-        passphrase = request.form['passphrase']
-        if passphrase:
-            hpass = generate_hash(passphrase)
-        else:
-            hpass = None
         # In case of a passphrase, don't bother the current submitter
         session['req_id'] = req_id       
 
-        # Submit the job
-        # Then redirect to the waiting page
-        try:
-            cmd = 'python tasks.py %s %s %s %s' % (req_id,
-                                                   wdir,
-                                                   dname,
-                                                   ' '.join(genomes))
-            f = open(os.path.join(wdir, 'cmd.sh'), 'w')
-            f.write(cmd + '\n')
-            f.close()
-            cmd = 'at -q b -M now -f %s' % os.path.join(wdir, 'cmd.sh')
-            proc = subprocess.Popen(cmd,
-                                    shell=(sys.platform!="win32"),
-				    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-				    stderr=subprocess.PIPE)
-	    out = proc.communicate()
-	    
-	    return_code = proc.returncode
-	    if return_code != 0:
-		raise Exception('%s'%str(out[1]))
-        except Exception as e:
-            flash(u'Could not submit your job "%s"' % e,
-                  'danger')
+        if not submit_job(req_id, wdir, dname, genomes, hashes, inputs,
+                          blobs, hemail, hpass):
             return redirect(url_for('index'))
-            
-        try:
-            # Send details to redis
-            add_job(req_id, request.remote_addr, hemail, hpass)
-        except Exception as e:
-            flash(u'Could not save your job details (%s)' % e, 'danger')
-            return redirect(url_for('index')) 
+
+        # Then redirect to the waiting page
 
         return redirect(url_for('results',
                         req_id=req_id))
@@ -158,47 +443,77 @@ def run():
           'warning')
     return redirect(url_for('index'))
 
-@app.route('/log/<req_id>')
-def log(req_id):
-    # Get details from redis
-    j = retrieve_job(req_id)
+# Parsed result.json files, keyed by (req_id, mtime)
+RESULTS = LRUCache(app.config.get('RESULTS_LRU_SIZE', 256))
 
-    # TODO: avoid access to redirect to results
-    # Check passphrase
-    if 'req_id' not in session:
-        # bother the user
-        return redirect(url_for('access',
-                        req_id=req_id))
-    if 'req_id' in session and req_id != escape(session['req_id']):
-        # clean the session, then bother the user
-        session.pop('req_id', None)
-        return redirect(url_for('access',
-                        req_id=req_id))
-    
-    # Return the log, if present
-    h2c = req_id[:2]
-    if not os.path.exists(os.path.join(
-                              app.config['UPLOAD_FOLDER'],
-                              h2c, req_id)):
-        flash('Could not retrieve the log: is your job older than one week?', 'danger')
-        return render_template('index.html') 
-    if 'log.txt' not in os.listdir(os.path.join(
-                                      app.config['UPLOAD_FOLDER'],
-                                      h2c, req_id)):
-        flash('Could not retrieve the log.txt file', 'danger')
-        return render_template('error.html', req_id=req_id)
+class Job(object):
+    '''A job details and artifacts, as seen by the web app
 
-    path = os.path.join(app.config['UPLOAD_FOLDER'],
-                        h2c, req_id, 'log.txt')
-    return Response(''.join(open(path).readlines()),
-                    mimetype='text/plain')
+    The artifacts are looked up in the manifest written by the worker,
+    the files are only probed for the jobs that do not have one yet
+    (running, or from before the manifests)
+    '''
+    def __init__(self, req_id, fields):
+        self.req_id = req_id
+        self.fields = fields
+        self.wdir = os.path.join(app.config['UPLOAD_FOLDER'],
+                                 req_id[:2], req_id)
+        manifest = fields.get('manifest')
+        self.manifest = json.loads(manifest) if manifest else None
 
-@app.route('/err/<req_id>')
-def err(req_id):
-    # Get details from redis
-    j = retrieve_job(req_id)
+    def path(self, name):
+        return os.path.join(self.wdir, name)
+
+    def exists(self):
+        '''Whether the job files are still there'''
+        if self.fields.get('status') == 'Job expired':
+            return False
+        if self.manifest is not None:
+            return True
+        return os.path.exists(self.wdir)
+
+    def has(self, name):
+        if not self.exists():
+            return False
+        if self.manifest is not None:
+            return name in self.manifest
+        return os.path.exists(self.path(name))
+
+    def result(self):
+        '''The parsed result.json (cached)'''
+        if self.manifest is not None and 'result.json' in self.manifest:
+            mtime = self.manifest['result.json'][1]
+        else:
+            mtime = os.stat(self.path('result.json')).st_mtime
+        key = (self.req_id, mtime)
+        result = RESULTS.get(key)
+        if result is None:
+            f = open(self.path('result.json'))
+            try:
+                result = json.load(f)
+            finally:
+                f.close()
+            RESULTS.put(key, result)
+        return result
 
+def load_job(req_id):
+    '''The job, fetched from redis once per request (None if unknown)'''
+    if 'jobs' not in g:
+        g.jobs = {}
+    if req_id not in g.jobs:
+        fields = retrieve_job(req_id)
+        g.jobs[req_id] = Job(req_id, fields) if fields else None
+    return g.jobs[req_id]
+
+def access_denied(req_id):
+    '''Redirect to the passphrase page, unless the session owns the job'''
     # TODO: avoid access to redirect to results
+    job = load_job(req_id)
+    if (job is not None and 'batch_id' in session and
+        job.fields.get('batch') == session['batch_id']):
+        # One of the jobs of a batch we own
+        session['req_id'] = req_id
+        return None
     # Check passphrase
     if 'req_id' not in session:
         # bother the user
@@ -209,60 +524,134 @@ def err(req_id):
         session.pop('req_id', None)
         return redirect(url_for('access',
                         req_id=req_id))
-    
+    return None
+
+def send_range(path, mimetype, headers=None):
+    '''Stream a file, honoring a single HTTP Range and If-None-Match'''
+    st = os.stat(path)
+    size = st.st_size
+    start, stop = 0, size
+    status = 200
+    if headers is None:
+        headers = {}
+    headers['Accept-Ranges'] = 'bytes'
+
+    if request.range is not None and request.range.units == 'bytes':
+        rng = request.range.range_for_length(size)
+        if rng is None:
+            return Response(status=416,
+                            headers={'Content-Range': 'bytes */%d' % size})
+        start, stop = rng
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1,
+                                                       size)
+
+    headers['Content-Length'] = str(stop - start)
+    response = Response(read_file(path, start, stop), status=status,
+                        headers=headers, mimetype=mimetype,
+                        direct_passthrough=True)
+    response.set_etag(hashlib.sha1('%s-%s-%s' % (st.st_ino, st.st_mtime,
+                                                 size)).hexdigest())
+    return response.make_conditional(request)
+
+def send_log(path):
+    '''Stream a (possibly growing) log file
+
+    Supports a single HTTP Range, ?tail=N (last N lines) and
+    ?since=offset (from a byte offset on, to follow a running job);
+    the X-Log-Size header tells where to continue from
+    '''
+    size = os.path.getsize(path)
+    headers = {'X-Log-Size': str(size)}
+
+    tail = request.args.get('tail', type=int)
+    since = request.args.get('since', type=int)
+    if tail is None and since is None:
+        return send_range(path, 'text/plain', headers)
+
+    if tail is not None:
+        start = tail_offset(path, max(tail, 0))
+    else:
+        start = min(max(since, 0), size)
+
+    headers['Content-Length'] = str(size - start)
+    return Response(read_file(path, start, size), headers=headers,
+                    mimetype='text/plain', direct_passthrough=True)
+
+def job_log(req_id, name):
+    job = load_job(req_id)
+    if job is None:
+        abort(404)
+    denied = access_denied(req_id)
+    if denied is not None:
+        return denied
+
     # Return the log, if present
-    h2c = req_id[:2]
-    if not os.path.exists(os.path.join(
-                              app.config['UPLOAD_FOLDER'],
-                              h2c, req_id)):
+    if not job.exists():
         flash('Could not retrieve the log: is your job older than one week?', 'danger')
         return render_template('index.html')
-    if 'log.err' not in os.listdir(os.path.join(
-                                      app.config['UPLOAD_FOLDER'],
-                                      h2c, req_id)):
-        flash('Could not retrieve the log.err file', 'danger')
+    if not job.has(name):
+        flash('Could not retrieve the %s file' % name, 'danger')
         return render_template('error.html', req_id=req_id)
 
-    path = os.path.join(app.config['UPLOAD_FOLDER'],
-                        h2c, req_id, 'log.err')
-    return Response(''.join(open(path).readlines()),
-                    mimetype='text/plain')
+    return send_log(job.path(name))
+
+@app.route('/log/<req_id>')
+def log(req_id):
+    return job_log(req_id, 'log.txt')
+
+@app.route('/err/<req_id>')
+def err(req_id):
+    return job_log(req_id, 'log.err')
 
 @app.route('/scaffold/<req_id>')
 def scaffold(req_id):
-    # Get details from redis
-    j = retrieve_job(req_id)
+    job = load_job(req_id)
+    if job is None:
+        abort(404)
+    denied = access_denied(req_id)
+    if denied is not None:
+        return denied
 
-    # TODO: avoid access to redirect to results
-    # Check passphrase
-    if 'req_id' not in session:
-        # bother the user
-        return redirect(url_for('access',
-                        req_id=req_id))
-    if 'req_id' in session and req_id != escape(session['req_id']):
-        # clean the session, then bother the user
-        session.pop('req_id', None)
-        return redirect(url_for('access',
-                        req_id=req_id))
-    
-    # Return the log, if present
-    h2c = req_id[:2]
-    if not os.path.exists(os.path.join(
-                              app.config['UPLOAD_FOLDER'],
-                              h2c, req_id)):
+    # Return the scaffold, if present
+    if not job.exists():
         flash('Could not retrieve the scaffold: is your job older than one week?', 'danger')
         return render_template('index.html')
-    if 'scaffold.fasta' not in os.listdir(os.path.join(
-                                      app.config['UPLOAD_FOLDER'],
-                                      h2c, req_id)):
-        flash('Could not retrieve the scaffold file', 'danger')
-        return render_template('error.html', req_id=req_id)
+    gzpath = job.path('scaffold.fasta.gz')
+    if not job.has('scaffold.fasta.gz'):
+        # Jobs from before the compressed artifacts
+        if not job.has('scaffold.fasta'):
+            flash('Could not retrieve the scaffold file', 'danger')
+            return render_template('error.html', req_id=req_id)
+        return send_from_directory(job.wdir,
+                                   'scaffold.fasta',
+                                   as_attachment=True)
 
-    path = os.path.join(app.config['UPLOAD_FOLDER'],
-                        h2c, req_id)
-    return send_from_directory(path,
-                               'scaffold.fasta',
-                               as_attachment=True)
+    headers = {'Content-Disposition':
+                    'attachment; filename=scaffold.fasta',
+               'Vary': 'Accept-Encoding'}
+
+    if not request.accept_encodings['gzip']:
+        # Decompress on the fly
+        def stream():
+            f = gzip.open(gzpath, 'rb')
+            try:
+                for chunk in iter(lambda: f.read(64 * 1024), b''):
+                    yield chunk
+            finally:
+                f.close()
+        return Response(stream(), headers=headers,
+                        mimetype='application/octet-stream')
+
+    # The stored bytes are sent as they are
+    headers['Content-Encoding'] = 'gzip'
+    if app.use_x_sendfile:
+        # Let the front-end server do the work
+        response = send_file(gzpath, mimetype='application/octet-stream',
+                             conditional=True)
+        response.headers.extend(headers)
+        return response
+    return send_range(gzpath, 'application/octet-stream', headers)
 
 @app.route('/results/<req_id>')
 def results(req_id):
@@ -270,26 +659,20 @@ def results(req_id):
     # Get the right job using the session or the hash key, a la contiguator
     
     # Get details from redis
-    j = retrieve_job(req_id)
+    job = load_job(req_id)
+    if job is None:
+        abort(404)
+    j = job.fields
 
-    # Check passphrase
-    if 'req_id' not in session:
-        # bother the user
-        return redirect(url_for('access',
-                        req_id=req_id))
-    if 'req_id' in session and req_id != escape(session['req_id']):
-        # clean the session, then bother the user
-        session.pop('req_id', None)
-        return redirect(url_for('access',
-                        req_id=req_id))
+    denied = access_denied(req_id)
+    if denied is not None:
+        return denied
 
-    h2c = req_id[:2]
     status = j['status']
     if status == 'Job done':
         # run results logics
         try:
-            result = json.load(open(os.path.join(app.config['UPLOAD_FOLDER'],
-                                                 h2c, req_id, 'result.json')))
+            result = job.result()
         except Exception as e:
             app.logger.error('Internal server error: %s\nRequest ID: %s' % (e, req_id))
             flash(u'Internal server error: %s'%e, 'danger')
@@ -303,22 +686,105 @@ def results(req_id):
         flash(u'Internal server error: %s' % error_msg,
                'danger')
         return render_template('error.html', req_id=req_id)
+    elif status == 'Job expired':
+        flash(u'The results of this job have been removed, ' +
+              u'would you like to submit it again?', 'warning')
+        return redirect(url_for('index'))
     else:
         # If too much time has passed, it means that the job has either failed
-        # or anything like that
-        cur_time = time.time()
-        start_time = float(j['time'])
-        delta_time = cur_time - start_time
-        if (60 * 15) < delta_time < (60 * 30):
-            flash(u'Your job exceeded 15 minutes, something might have gone wrong!' +
-                  u'Will try 15 more minutes before giving up',
+        # or anything like that; the limits come from the runtime predicted
+        # for its inputs, and count from when it left the queue
+        position = queue_position(req_id)
+        start_time = j.get('started')
+        if start_time is None and position is None:
+            start_time = j['time']
+        delta_time = time.time() - float(start_time) if start_time else 0
+        late = int(j.get('late') or DEFAULT_LATE)
+        timeout = int(j.get('timeout') or DEFAULT_TIMEOUT)
+        if late < delta_time < timeout:
+            flash(u'Your job exceeded %d minutes, something might have gone wrong! '
+                  % (late // 60) +
+                  u'Will try %d more minutes before giving up'
+                  % ((timeout - late) // 60),
                   'danger')
-        elif delta_time > (60 * 30):
-            flash(u'Your job exceeded 30 minutes, something must have gone wrong!' +
+        elif delta_time > timeout:
+            flash(u'Your job exceeded %d minutes, something must have gone wrong! '
+                  % (timeout // 60) +
                   u'If your genomes are many (and big) you might want to run Medusa locally',
                   'danger')
             return render_template('error.html', req_id=req_id)
-        return render_template('waiting.html', status=status)
+        predicted = int(j['predicted']) if j.get('predicted') else None
+        eta = None
+        if predicted and j.get('started'):
+            eta = int(float(j['started'])) + predicted
+        return render_template('waiting.html', status=status,
+                               position=position,
+                               predicted=predicted,
+                               eta=eta,
+                               req_id=req_id,
+                               sse=app.config['SSE_ENABLED'])
+
+# Job states after which nothing changes anymore
+FINAL_STATES = ('Job done', 'Job failed', 'Job expired')
+
+def session_allowed(req_id):
+    # Same check of the pages, without redirects
+    return 'req_id' in session and req_id == escape(session['req_id'])
+
+@app.route('/status/<req_id>')
+def status(req_id):
+    # Lightweight job progress, for polling clients
+    if not session_allowed(req_id):
+        abort(403)
+
+    d = job_progress(req_id)
+    if d['status'] is None:
+        abort(404)
+
+    data = json.dumps(d)
+    response = Response(data, mimetype='application/json')
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/events/<req_id>')
+def events(req_id):
+    # Job progress pushed through Server-Sent Events
+    if not app.config['SSE_ENABLED']:
+        abort(404)
+    if not session_allowed(req_id):
+        abort(403)
+
+    timeout = app.config['SSE_TIMEOUT']
+
+    def stream():
+        pubsub = subscribe_job(req_id)
+        try:
+            yield 'retry: 5000\n\n'
+
+            d = job_progress(req_id)
+            yield 'data: %s\n\n' % json.dumps(d)
+
+            stop = time.time() + timeout
+            while d['status'] not in FINAL_STATES and time.time() < stop:
+                msg = pubsub.get_message(timeout=max(0, min(15,
+                                                     stop - time.time())))
+                if msg is None:
+                    # Keep the connection alive
+                    yield ': ping\n\n'
+                    continue
+                if msg['type'] != 'message':
+                    continue
+                new = job_progress(req_id)
+                if new != d:
+                    d = new
+                    yield 'data: %s\n\n' % json.dumps(d)
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 @app.route('/access/<req_id>', methods=['GET', 'POST'])
 def access(req_id):
@@ -329,6 +795,8 @@ def access(req_id):
     
     # Get details from redis
     j = retrieve_job(req_id)
+    if not j:
+        abort(404)
 
     # If no passphrase, no need to bother, just redirect
     if 'passphrase' not in j:
@@ -359,27 +827,318 @@ def access(req_id):
     # Redirect to password form
     flash('This job is protected by a passphrase', 'info')
     return render_template('access.html', req_id=req_id)
-    
+
+@app.route('/batch', methods=['GET', 'POST'])
+def batch():
+    # Many drafts against the same targets: one job per draft,
+    # the targets are stored once (their stats computed by the
+    # first job, the others find them in the cache)
+    if request.method != 'POST':
+        return render_template('batch.html',
+                               max_drafts=app.config['BATCH_MAX_DRAFTS'])
+
+    # Can we take it?
+    denied = admission()
+    if denied is not None:
+        return denied
+
+    drafts = [d for d in request.files.getlist('drafts') if d]
+    if not drafts:
+        flash(u'Something went wrong with your draft genomes', 'danger')
+        return redirect(url_for('batch'))
+    if len(drafts) > app.config['BATCH_MAX_DRAFTS']:
+        flash(u'Too many draft genomes (at most %d per batch)'
+              % app.config['BATCH_MAX_DRAFTS'], 'danger')
+        return redirect(url_for('batch'))
+
+    email = request.form['email']
+    if not email:
+        flash(u'Something went wrong with your email', 'danger')
+        return redirect(url_for('batch'))
+    hemail = generate_hash(email)
+    # Each draft counts as a submission
+    denied = email_admission(hemail, len(drafts))
+    if denied is not None:
+        return denied
+    passphrase = request.form['passphrase']
+    hpass = generate_hash(passphrase) if passphrase else None
+
+    batch_id = generate_time_hash('%s:batch' % request.remote_addr)
+    jobs = [new_job_dir('%s:%d' % (request.remote_addr, i))
+            for i in range(len(drafts))]
+    blobs = [[] for i in jobs]
+
+    def discard():
+        for (req_id, wdir), b in zip(jobs, blobs):
+            release_blobs(b)
+            shutil.rmtree(wdir, ignore_errors=True)
+
+    # Save the targets once, in the first job
+    targets = []
+    thashes = {}
+    tinputs = {}
+    first = os.path.join(jobs[0][1], 'drafts')
+    try:
+        os.mkdir(first)
+        for genome in request.files.getlist('genomes'):
+            filename, info = save_blob(genome, first,
+                                       secure_filename(genome.filename))
+            thashes[filename] = info.pop('sha256')
+            blobs[0].append(thashes[filename])
+            tinputs[filename] = info
+            targets.append(filename)
+        if not targets:
+            raise Exception('no target genomes')
+    except Exception as e:
+        discard()
+        flash(u'Something went wrong with your target genomes (%s)' % e,
+              'danger')
+        return redirect(url_for('batch'))
+
+    # Save each draft, the other jobs link the targets
+    names = []
+    try:
+        for i, (draft, (req_id, wdir)) in enumerate(zip(drafts, jobs)):
+            dname, info = save_blob(draft, wdir,
+                                    secure_filename(draft.filename))
+            blobs[i].append(info['sha256'])
+            names.append((dname, info))
+            if i == 0:
+                continue
+            os.mkdir(os.path.join(wdir, 'drafts'))
+            for t in targets:
+                link_blob(thashes[t], os.path.join(wdir, 'drafts', t))
+                blobs[i].append(thashes[t])
+    except FormatError as e:
+        discard()
+        flash(u'There is a problem with your draft genomes (%s)' % e,
+              'danger')
+        return redirect(url_for('batch'))
+    except:
+        discard()
+        flash(u'Something went wrong with your draft genomes', 'danger')
+        return redirect(url_for('batch'))
+
+    try:
+        add_batch(batch_id, request.remote_addr, hemail,
+                  [req_id for req_id, wdir in jobs], hpass,
+                  drafts=json.dumps([n[0] for n in names]),
+                  targets=json.dumps(targets))
+    except Exception as e:
+        discard()
+        flash(u'Could not save your batch details (%s)' % e, 'danger')
+        return redirect(url_for('batch'))
+    # In case of a passphrase, don't bother the current submitter
+    session['batch_id'] = batch_id
+
+    for i, ((req_id, wdir), (dname, info), b) in enumerate(zip(jobs, names,
+                                                               blobs)):
+        hashes = dict(thashes)
+        hashes[dname] = info.pop('sha256')
+        inputs = dict(tinputs)
+        inputs[dname] = info
+        # The first job computes the targets stats for the whole
+        # batch: it goes first (failures are shown on the batch page)
+        submit_job(req_id, wdir, dname, targets, hashes, inputs, b,
+                   hemail, hpass, 0 if i == 0 else None, batch=batch_id)
+
+    return redirect(url_for('batch_results', batch_id=batch_id))
+
+def load_batch(batch_id):
+    '''The batch and its jobs, fetched from redis in two round-trips'''
+    b = retrieve_batch(batch_id)
+    if not b:
+        return None, None
+    req_ids = json.loads(b['jobs'])
+    if 'jobs' not in g:
+        g.jobs = {}
+    for req_id, fields in zip(req_ids, retrieve_jobs(req_ids)):
+        g.jobs[req_id] = Job(req_id, fields) if fields else None
+    return b, req_ids
+
+def batch_denied(batch_id):
+    '''Redirect to the passphrase page, unless the session owns the batch'''
+    if session.get('batch_id') != batch_id:
+        session.pop('batch_id', None)
+        return redirect(url_for('batch_access', batch_id=batch_id))
+    return None
+
+@app.route('/batch/<batch_id>')
+def batch_results(batch_id):
+    b, req_ids = load_batch(batch_id)
+    if b is None:
+        abort(404)
+    denied = batch_denied(batch_id)
+    if denied is not None:
+        return denied
+
+    rows = []
+    for req_id, dname in zip(req_ids, json.loads(b['drafts'])):
+        job = load_job(req_id)
+        row = {'req_id': req_id, 'draft': dname, 'data': None,
+               'status': job.fields['status'] if job else 'Not submitted'}
+        if row['status'] == 'Job done':
+            try:
+                row['data'] = job.result()
+            except Exception as e:
+                app.logger.error('Internal server error: %s\nRequest ID: %s'
+                                 % (e, req_id))
+        rows.append(row)
+
+    done = all(row['status'] in FINAL_STATES + ('Not submitted',)
+               for row in rows)
+    # The targets stats, once a job has computed them
+    targets = [{'name': name} for name in json.loads(b['targets'])]
+    for row in rows:
+        if row['data'] and 'targets' in row['data']:
+            targets = row['data']['targets']
+            break
+    return render_template('batch_result.html', batch_id=batch_id,
+                           targets=targets,
+                           rows=rows, done=done,
+                           statuses=json.dumps([row['status']
+                                                for row in rows]))
+
+@app.route('/batch/<batch_id>/status')
+def batch_status(batch_id):
+    # The status of all the jobs, for polling clients
+    if session.get('batch_id') != batch_id:
+        abort(403)
+    b = retrieve_batch(batch_id)
+    if not b:
+        abort(404)
+
+    data = json.dumps([s or 'Not submitted'
+                       for s in jobs_status(json.loads(b['jobs']))])
+    response = Response(data, mimetype='application/json')
+    response.set_etag(hashlib.sha1(data).hexdigest())
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+@app.route('/batch/<batch_id>/scaffolds')
+def batch_scaffolds(batch_id):
+    # All the scaffolds of a batch, in a single tar archive
+    b, req_ids = load_batch(batch_id)
+    if b is None:
+        abort(404)
+    denied = batch_denied(batch_id)
+    if denied is not None:
+        return denied
+
+    folder = 'medusa_%s' % batch_id[:8]
+    files = []
+    names = set()
+    for i, (req_id, dname) in enumerate(zip(req_ids,
+                                           json.loads(b['drafts']))):
+        job = load_job(req_id)
+        if job is None:
+            continue
+        for fname in ('scaffold.fasta.gz', 'scaffold.fasta'):
+            if job.has(fname):
+                break
+        else:
+            continue
+        name = '%s.%s' % (os.path.splitext(dname)[0], fname)
+        if name in names:
+            name = '%d_%s' % (i + 1, name)
+        names.add(name)
+        files.append(('%s/%s' % (folder, name), job.path(fname)))
+
+    if not files:
+        flash(u'None of the scaffolds of this batch are available',
+              'danger')
+        return redirect(url_for('batch_results', batch_id=batch_id))
+
+    size, stream = tar_stream(files)
+    return Response(stream, mimetype='application/x-tar',
+                    headers={'Content-Disposition':
+                                 'attachment; filename=%s.tar' % folder,
+                             'Content-Length': str(size)},
+                    direct_passthrough=True)
+
+@app.route('/access/batch/<batch_id>', methods=['GET', 'POST'])
+def batch_access(batch_id):
+    # Same as for a single job
+    b = retrieve_batch(batch_id)
+    if not b:
+        abort(404)
+
+    if 'passphrase' not in b:
+        session['batch_id'] = batch_id
+        return redirect(url_for('batch_results', batch_id=batch_id))
+
+    if request.method == 'POST':
+        passphrase = request.form['passphrase']
+        if not passphrase:
+            flash(u'Error handling your passphrase', 'danger')
+            return render_template('access.html', req_id=batch_id)
+        if generate_hash(passphrase) == b['passphrase']:
+            session['batch_id'] = batch_id
+            return redirect(url_for('batch_results', batch_id=batch_id))
+        flash(u'Passphrase does not match', 'danger')
+        session.pop('batch_id', None)
+        return render_template('access.html', req_id=batch_id)
+
+    flash('This batch is protected by a passphrase', 'info')
+    return render_template('access.html', req_id=batch_id)
+
 @app.route('/stats')
 def stats():
     return render_template('stats.html')
 
+def stats_range():
+    """Parse the from/to/bucket query parameters of the stats endpoints
+
+    The range is kept between the first recorded day and today,
+    longer ones than STATS_MAX_DAYS are refused
+    """
+    try:
+        start = request.args.get('from')
+        if start:
+            start = datetime.strptime(start, '%Y-%m-%d').date()
+        stop = request.args.get('to')
+        if stop:
+            stop = datetime.strptime(stop, '%Y-%m-%d').date()
+        bucket = request.args.get('bucket', type=int)
+        if bucket is not None and bucket < 1:
+            raise ValueError('bucket should be at least one day')
+    except ValueError:
+        abort(400)
+
+    first = first_stats_day()
+    if start and first and start < first:
+        start = first
+    today = date.today()
+    if not stop or stop > today:
+        stop = today
+    start = start or first or today
+    if start > stop:
+        abort(400)
+    if (stop - start).days >= app.config['STATS_MAX_DAYS']:
+        abort(400)
+    return {'start': start,
+            'stop': stop,
+            'bucket': bucket}
+
 @app.route('/stats/jobs')
 def jobs():
     return Response(json.dumps([{'date':x[1],
-                                 'jobs':x[0]} for x in cumulative_jobs()]),
+                                 'jobs':x[0]}
+                                for x in cumulative_jobs(**stats_range())]),
                     mimetype='text/plain')
 
 @app.route('/stats/ips')
 def ips():
     return Response(json.dumps([{'date':x[1],
-                                 'ips':x[0]} for x in unique_ips()]),
+                                 'ips':x[0]}
+                                for x in unique_ips(**stats_range())]),
                     mimetype='text/plain')
 
 @app.route('/stats/emails')
 def emails():
     return Response(json.dumps([{'date':x[1],
-                                 'emails':x[0]} for x in unique_emails()]),
+                                 'emails':x[0]}
+                                for x in unique_emails(**stats_range())]),
                     mimetype='text/plain')
 
 @app.route('/admin')
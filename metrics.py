@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+'''
+Timing and resource instrumentation
+
+Histograms are kept in redis (so that the web app and all the
+workers share them) and exposed in the Prometheus text format
+'''
+
+import resource
+import time
+
+# Histogram upper bounds
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+BYTES = tuple(2 ** i * 1024 * 1024 for i in range(4, 16))
+
+# name -> (help, buckets)
+HISTOGRAMS = {
+    'medusa_request_seconds': ('Requests latency, per route',
+                               SECONDS),
+    'medusa_request_redis_seconds': ('Time spent talking to redis ' +
+                                     'per request, per route',
+                                     SECONDS),
+    'medusa_request_redis_roundtrips': ('Redis round-trips per request, ' +
+                                        'per route',
+                                        (1, 2, 3, 4, 5, 10, 20, 50, 100)),
+    'medusa_stage_seconds': ('Jobs wall time, per stage', SECONDS),
+    'medusa_stage_cpu_seconds': ('Jobs CPU time (including child ' +
+                                 'processes), per stage', SECONDS),
+    'medusa_stage_rss_bytes': ('Jobs peak resident memory (including ' +
+                               'child processes), per stage', BYTES),
+    'medusa_job_seconds': ('Jobs wall time', SECONDS),
+}
+
+# Redis hash holding each histogram
+# (labels|upper bound -> count, labels|sum, labels|count)
+HISTOGRAM_KEY = 'medusametrics_%s'
+
+def labels(**kwargs):
+    '''Prometheus labels string'''
+    return ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                    for k, v in sorted(kwargs.items()))
+
+def observe(r, name, value, labels=''):
+    '''Add a value to a histogram (r can be a pipeline)'''
+    key = HISTOGRAM_KEY % name
+    for le in HISTOGRAMS[name][1]:
+        if value <= le:
+            break
+    else:
+        le = '+Inf'
+    r.hincrby(key, '%s|%s' % (labels, le), 1)
+    r.hincrbyfloat(key, '%s|sum' % labels, value)
+    r.hincrby(key, '%s|count' % labels, 1)
+
+def _cpu(usage):
+    return usage.ru_utime + usage.ru_stime
+
+def _maxrss(usage):
+    # Kilobytes on Linux
+    return usage.ru_maxrss * 1024
+
+def _reset_peak():
+    '''Measure the peak RSS of this process afresh (Linux only)'''
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+def _peak():
+    '''Peak RSS of this process since the last reset'''
+    for line in open('/proc/self/status'):
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1]) * 1024
+    return 0
+
+class Stages(object):
+    '''Wall time, CPU time and peak RSS of the stages of a job
+
+    CPU time includes the child processes that have been waited for;
+    the peak RSS is the largest of the processes that ran the stage:
+    the children reported through child(), the other children waited
+    for during the stage (when bigger than the earlier ones, getrusage
+    only keeps the largest) and this long-lived process, since the
+    start of the stage, where its peak can be reset
+    '''
+    def __init__(self):
+        self.stages = []
+        self._name = None
+        self._child_rss = 0
+        self._children_rss = 0
+        self._own_rss = False
+
+    def _usage(self):
+        return (time.time(),
+                _cpu(resource.getrusage(resource.RUSAGE_SELF)) +
+                _cpu(resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+    def start(self, name):
+        self.stop()
+        self._name = name
+        self._start = self._usage()
+        self._child_rss = 0
+        self._children_rss = _maxrss(
+            resource.getrusage(resource.RUSAGE_CHILDREN))
+        self._own_rss = _reset_peak()
+
+    def child(self, usage):
+        '''Account for a child process (rusage from os.wait4)'''
+        self._child_rss = max(self._child_rss, _maxrss(usage))
+
+    def stop(self):
+        if self._name is None:
+            return
+        wall, cpu = self._usage()
+        rss = self._child_rss
+        children = _maxrss(resource.getrusage(resource.RUSAGE_CHILDREN))
+        if children > self._children_rss:
+            rss = max(rss, children)
+        if self._own_rss:
+            rss = max(rss, _peak())
+        self.stages.append((self._name,
+                            round(wall - self._start[0], 3),
+                            round(cpu - self._start[1], 3),
+                            rss))
+        self._name = None
+
+    def compact(self):
+        '''[[stage, wall, cpu, rss], ...], to be stored with the job'''
+        return [list(s) for s in self.stages]
+
+    def total(self):
+        return sum(s[1] for s in self.stages)
+
+    def observe(self, r):
+        for name, wall, cpu, rss in self.stages:
+            l = labels(stage=name)
+            observe(r, 'medusa_stage_seconds', wall, l)
+            observe(r, 'medusa_stage_cpu_seconds', cpu, l)
+            observe(r, 'medusa_stage_rss_bytes', rss, l)
+        observe(r, 'medusa_job_seconds', self.total())
+
+def _fmt(v):
+    if isinstance(v, float) and v == int(v):
+        return str(int(v))
+    return str(v)
+
+def exposition(r, gauges=None, counters=None):
+    '''Return all the metrics in the Prometheus text format
+
+    gauges and counters are {name: (help, value)} dictionaries,
+    value being a {labels: value} dictionary for labelled series
+    '''
+    lines = []
+
+    for kind, metrics in (('gauge', gauges or {}),
+                          ('counter', counters or {})):
+        for name in sorted(metrics):
+            help, value = metrics[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if not isinstance(value, dict):
+                value = {'': value}
+            for l in sorted(value):
+                braces = '{%s}' % l if l else ''
+                lines.append('%s%s %s' % (name, braces, _fmt(value[l])))
+
+    p = r.pipeline(transaction=False)
+    names = sorted(HISTOGRAMS)
+    for name in names:
+        p.hgetall(HISTOGRAM_KEY % name)
+    for name, data in zip(names, p.execute()):
+        help, buckets = HISTOGRAMS[name]
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s histogram' % name)
+
+        series = set(k.rsplit('|', 1)[0] for k in data)
+        for l in sorted(series):
+            sep = ',' if l else ''
+            cumulative = 0
+            for le in list(buckets) + ['+Inf']:
+                cumulative += int(data.get('%s|%s' % (l, le), 0))
+                lines.append('%s_bucket{%s%sle="%s"} %d' % (name, l, sep,
+                                                           _fmt(le),
+                                                           cumulative))
+            braces = '{%s}' % l if l else ''
+            lines.append('%s_sum%s %s' % (name, braces,
+                                          data.get('%s|sum' % l, 0)))
+            lines.append('%s_count%s %s' % (name, braces,
+                                            data.get('%s|count' % l, 0)))
+
+    return '\n'.join(lines) + '\n'
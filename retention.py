@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+'''
+Uploads retention
+
+Removes the files of the finished jobs, the earliest finished first,
+once they finished more than UPLOADS_RETENTION ago or while all the
+jobs take more than UPLOADS_DISK_BUDGET (and of the jobs never queued,
+once submitted more than UPLOADS_RETENTION ago); the jobs are then
+marked as expired, and their details kept in redis for JOBS_RETENTION,
+and in the archive for good.
+
+The jobs indexes drive it (no scan of the uploads directory), in small
+batches with a pause in between; queued and running jobs are never
+touched. The uploaded genomes no job links anymore are then removed
+from the blobs store. Meant to be run every now and then (e.g. hourly,
+from cron)
+
+    python retention.py [--dry-run]
+
+Jobs finished before an upgrade have no disk usage recorded (or are
+not in the finished jobs index), record it once with
+
+    python retention.py reindex
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+
+from store import disk_counters
+from store import expire_job
+from store import oldest_jobs
+from store import release_job_blobs
+from store import retrieve_job
+from store import set_job_disk
+
+import archive
+from blobs import collect_blobs
+
+from utils import disk_usage
+from utils import get_setting
+
+# Jobs that can be removed (no status: details gone already)
+FINISHED = ('Job done', 'Job failed', None)
+# Jobs whose submission failed half-way, removed once old enough
+NOT_STARTED = 'Job not started'
+
+def job_dir(jid, job):
+    '''Working directory of a job'''
+    if job.get('wdir'):
+        return job['wdir']
+
+    uploads = get_setting('UPLOAD_FOLDER', 'uploads')
+    if not os.path.isabs(uploads):
+        uploads = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               uploads)
+    req_id = jid[len('medusa_'):]
+    return os.path.join(uploads, req_id[:2], req_id)
+
+def read_result(wdir):
+    '''The parsed result.json of a job, if any'''
+    try:
+        return json.load(open(os.path.join(wdir, 'result.json')))
+    except (IOError, ValueError):
+        return None
+
+def remove_job(jid, job, finished, dry_run=False):
+    '''Archive a job and remove its files
+
+    Returns the disk space reclaimed, or None if the job
+    changed in the meantime
+    '''
+    wdir = job_dir(jid, job)
+    disk = int(job['disk'] or 0)
+    if dry_run:
+        return disk or disk_usage(wdir)
+
+    if job['disk'] is None:
+        disk = disk_usage(wdir)
+        if job['status'] is not None:
+            # Account for it as for the newer jobs
+            set_job_disk(jid[len('medusa_'):], disk, finished)
+    # Archived first, the archive skips the jobs it has already
+    details = retrieve_job(jid[len('medusa_'):])
+    if details:
+        archive.append([archive.job_row(jid, details, read_result(wdir))])
+    if expire_job(jid, job['fingerprint']) is None:
+        return None
+
+    shutil.rmtree(wdir, ignore_errors=True)
+    # Failed jobs still hold their inputs
+    release_job_blobs(jid[len('medusa_'):])
+    return disk
+
+def collect(dry_run=False, batch=None, pause=None, now=None):
+    '''Remove the old jobs, returns the number of jobs and bytes reclaimed'''
+    if batch is None:
+        batch = get_setting('RETENTION_BATCH', 50)
+    if pause is None:
+        pause = get_setting('RETENTION_PAUSE', 0.5)
+    if now is None:
+        now = time.time()
+    cutoff = now - get_setting('UPLOADS_RETENTION', 7 * 24 * 3600)
+    budget = get_setting('UPLOADS_DISK_BUDGET')
+
+    used = disk_counters()['used']
+    removed = 0
+    reclaimed = 0
+
+    # The finished jobs, the earliest finished first; removed jobs
+    # leave the index, the ones kept are skipped
+    offset = 0
+    done = False
+    while not done:
+        jobs = oldest_jobs(offset, batch, finished=True)
+        if not jobs:
+            break
+
+        for jid, finished, job in jobs:
+            if finished >= cutoff and not (budget is not None and
+                                           used > budget):
+                # All the next ones finished later
+                done = True
+                break
+            if job['status'] not in FINISHED:
+                offset += 1
+                continue
+
+            disk = remove_job(jid, job, finished, dry_run)
+            if disk is None or dry_run:
+                offset += 1
+            if disk is not None:
+                removed += 1
+                reclaimed += disk
+                used -= int(job['disk'] or 0)
+
+        time.sleep(pause)
+
+    # Then, by submission time, the jobs never queued and the ones
+    # finished before the finished jobs were indexed
+    offset = 0
+    while True:
+        jobs = oldest_jobs(offset, batch)
+        if not jobs:
+            break
+
+        for jid, t, job in jobs:
+            over = budget is not None and used > budget
+            if t >= cutoff and not over:
+                # All the next ones are younger
+                return removed, reclaimed
+
+            finished = float(job['finished'] or t)
+            if job['indexed']:
+                offset += 1
+                continue
+            if job['status'] == NOT_STARTED:
+                # (not by the disk budget: it may be being submitted)
+                if t >= cutoff:
+                    offset += 1
+                    continue
+            elif (job['status'] not in FINISHED or
+                  (finished >= cutoff and not over)):
+                offset += 1
+                continue
+
+            disk = remove_job(jid, job, finished, dry_run)
+            if disk is None or dry_run:
+                offset += 1
+            if disk is not None:
+                removed += 1
+                reclaimed += disk
+                used -= int(job['disk'] or 0)
+
+        time.sleep(pause)
+
+    return removed, reclaimed
+
+def reindex(batch=None, pause=None):
+    '''Record the disk usage (and index the finish time) of the jobs
+    finished before the upgrade'''
+    if batch is None:
+        batch = get_setting('RETENTION_BATCH', 50)
+    if pause is None:
+        pause = get_setting('RETENTION_PAUSE', 0.5)
+
+    n = 0
+    offset = 0
+    while True:
+        jobs = oldest_jobs(offset, batch)
+        if not jobs:
+            break
+        offset += len(jobs)
+
+        for jid, t, job in jobs:
+            if not job['indexed'] and job['status'] in FINISHED[:-1]:
+                disk = job['disk']
+                if disk is None:
+                    disk = disk_usage(job_dir(jid, job))
+                set_job_disk(jid[len('medusa_'):], int(disk),
+                             float(job['finished'] or t))
+                n += 1
+        time.sleep(pause)
+
+    return n
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Uploads retention')
+    parser.add_argument('command', nargs='?', choices=['reindex'])
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only report what would be removed')
+    args = parser.parse_args()
+
+    if args.command == 'reindex':
+        n = reindex()
+        sys.stdout.write('Disk usage recorded for %d jobs\n' % n)
+    else:
+        removed, reclaimed = collect(args.dry_run)
+        sys.stdout.write('%s %d jobs, %.1f MB %s\n'
+                         % ('Would remove' if args.dry_run else 'Removed',
+                            removed, reclaimed / 1048576.0,
+                            'to reclaim' if args.dry_run else 'reclaimed'))
+        if not args.dry_run:
+            removed, reclaimed = collect_blobs()
+            sys.stdout.write('Removed %d unused blobs, %.1f MB reclaimed\n'
+                             % (removed, reclaimed / 1048576.0))
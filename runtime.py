@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+'''
+Jobs runtime prediction
+
+A log-linear model of the jobs wall time, fitted on the past jobs:
+
+    log(time) = a + b log(draft length) + c log(draft contigs)
+                  + d log(targets) + e log(targets length)
+
+The model (a few numbers) is kept in redis and fitted again every
+RUNTIME_REFIT_EVERY finished jobs; the spread of its errors gives
+the time after which a job is late, then hung
+
+    python runtime.py fit [--archive]
+
+--archive fits it on all the archived jobs instead (and the recent
+ones), e.g. for a first model after an upgrade
+'''
+
+import math
+import sys
+import time
+
+import numpy as np
+
+import archive
+from store import add_runtime_sample
+from store import get_runtime_model
+from store import runtime_samples
+from store import set_runtime_model
+
+from utils import get_setting
+
+# Without a model (or for the inputs it has not seen): the
+# old fixed limits, late after 15 minutes, hung after 30
+DEFAULT_LATE = 15 * 60
+DEFAULT_TIMEOUT = 30 * 60
+
+def features(draft, targets):
+    '''Model inputs, from the genome_stats of the draft and targets'''
+    return [draft['length'], draft['contigs'], len(targets),
+            sum(t['length'] for t in targets)]
+
+def features_from_inputs(inputs, draft_name):
+    '''Model inputs, from the uploads details (size ~ length)'''
+    draft = inputs[draft_name]
+    targets = [i for name, i in inputs.items() if name != draft_name]
+    return [draft['size'], draft['records'], len(targets),
+            sum(t['size'] for t in targets)]
+
+def _design(x):
+    x = np.log1p(np.asarray(x, dtype=np.float64).reshape(-1, 4))
+    return np.hstack([np.ones((x.shape[0], 1)), x])
+
+def fit(samples):
+    '''Fit the model on [features..., seconds] samples'''
+    a = np.asarray(samples, dtype=np.float64)
+    X = _design(a[:, :4])
+    y = np.log(np.maximum(a[:, 4], 1))
+
+    coef = np.linalg.lstsq(X, y, rcond=-1)[0]
+    residuals = y - X.dot(coef)
+    # Degrees of freedom: the coefficients
+    dof = max(1, len(y) - len(coef))
+
+    return {'coef': [round(float(c), 6) for c in coef],
+            'sigma': round(float(math.sqrt((residuals ** 2).sum() / dof)),
+                           6),
+            'n': len(y),
+            'time': int(time.time())}
+
+def predict(model, x):
+    '''Expected wall time (seconds) of a job'''
+    return float(math.exp(_design(x).dot(model['coef'])[0]))
+
+def limits(model, x):
+    '''Expected wall time, time after which the job is late
+    and time after which it is considered hung (seconds)
+
+    The limits are upper quantiles of the model errors, never below
+    RUNTIME_TIMEOUT_MIN; without a model only the fixed limits
+    '''
+    if model is None:
+        return None, DEFAULT_LATE, DEFAULT_TIMEOUT
+
+    expected = predict(model, x)
+    minimum = get_setting('RUNTIME_TIMEOUT_MIN', 10 * 60)
+    late = expected * math.exp(2 * model['sigma'])
+    timeout = expected * math.exp(get_setting('RUNTIME_TIMEOUT_SIGMAS', 3) *
+                                  model['sigma'])
+    return (int(expected), int(max(minimum / 2, late)),
+            int(max(minimum, timeout)))
+
+def job_limits(x, waves=1):
+    '''Expected, late and timeout job fields from the model inputs
+
+    The model predicts a single Medusa run: waves is the number of
+    runs a job makes one after the other (the multiple runs mode
+    runs as many at once as it has cores)
+    '''
+    try:
+        expected, late, timeout = limits(get_runtime_model(), x)
+    except Exception:
+        expected, late, timeout = None, DEFAULT_LATE, DEFAULT_TIMEOUT
+
+    d = {'late': late * waves, 'timeout': timeout * waves}
+    if expected is not None:
+        d['predicted'] = expected * waves
+    return d
+
+def refit(from_archive=False):
+    '''Fit the model on the recorded samples, returns it'''
+    samples = runtime_samples()
+    if from_archive:
+        samples = np.vstack([np.asarray(samples,
+                                        dtype=np.float64).reshape(-1, 5),
+                             archive.runtime_samples()])
+    if len(samples) < get_setting('RUNTIME_MIN_SAMPLES', 20):
+        return None
+    model = fit(samples)
+    set_runtime_model(model)
+    return model
+
+def record(x, seconds):
+    '''Add a finished job to the samples, refit when it is time'''
+    n = add_runtime_sample(list(x) + [round(seconds, 3)],
+                           get_setting('RUNTIME_SAMPLES', 5000))
+    every = get_setting('RUNTIME_REFIT_EVERY', 20)
+    if n % every == 0 or (n >= get_setting('RUNTIME_MIN_SAMPLES', 20) and
+                          get_runtime_model() is None):
+        return refit()
+
+if __name__ == "__main__":
+    if (len(sys.argv) < 2 or sys.argv[1] != 'fit' or
+        sys.argv[2:] not in ([], ['--archive'])):
+        sys.stderr.write('Usage: python runtime.py fit [--archive]\n')
+        sys.exit(1)
+
+    model = refit(sys.argv[2:] == ['--archive'])
+    if model is None:
+        sys.stderr.write('Not enough finished jobs to fit the model\n')
+        sys.exit(1)
+    sys.stdout.write('Model fitted on %d jobs (error factor %.2f): %s\n'
+                     % (model['n'], math.exp(model['sigma']),
+                        model['coef']))
@@ -4,3 +4,99 @@ DEBUG=True
 SECRET_KEY='development key'
 UPLOAD_FOLDER = 'uploads'
 MAX_CONTENT_LENGTH = 1024 * 1024 * 1024
+
+# Redis connection, shared by the web app and the task workers
+REDIS_HOST = 'localhost'
+REDIS_PORT = 6379
+REDIS_DB = 0
+REDIS_MAX_CONNECTIONS = None
+# Scratch database of benchmark.py and loadtest.py (emptied after each run)
+REDIS_DB_BENCHMARK = 15
+
+# Processes used to compute the input genomes statistics
+# (None: as many as the available cores)
+STATS_PROCESSES = None
+
+# Genomes whose stats are kept in the cache
+STATS_CACHE_SIZE = 10000
+
+# Longest range (days) asked to the stats endpoints
+STATS_MAX_DAYS = 10 * 366
+
+# Medusa bundle (medusa.jar and medusa_scripts), shared by all jobs
+# relative paths start from the web app directory
+MEDUSA_FOLDER = 'medusa-app'
+
+# Medusa command line options
+MEDUSA_OPTIONS = '-random 5'
+# Options of each run when the best of many runs is asked for,
+# and how many of them run at once (None: the cores of a worker slot)
+MEDUSA_MULTI_OPTIONS = ['-random 5', '-random 5', '-random 10', '-random 10']
+MEDUSA_MULTI_CORES = None
+
+# Jobs finished longer ago than this (seconds) are removed from the uploads
+UPLOADS_RETENTION = 7 * 24 * 3600
+# The earliest finished also go while the uploads take more than this
+# (bytes, None for no limit)
+UPLOADS_DISK_BUDGET = None
+# Details of the removed jobs are kept this long (seconds)
+JOBS_RETENTION = 30 * 24 * 3600
+# Jobs looked at in each retention batch, pause between batches (seconds)
+RETENTION_BATCH = 50
+RETENTION_PAUSE = 0.5
+# The details of the removed jobs are archived there, for the stats
+# and the runtime model; the redis records then expire
+ARCHIVE_FOLDER = 'archive'
+# Each distinct uploaded genome is stored once there (None: a blobs
+# folder in the uploads), it must be on the uploads file system
+BLOBS_FOLDER = None
+# Unused blobs are removed by the retention after this long (seconds)
+BLOBS_GRACE = 3600
+
+# Submissions admission, checked before the uploads are read:
+# submissions allowed to each IP and each email, per hour on average
+# and in a row (None: no limit), queued jobs and free space on the
+# uploads disk (bytes, on top of the upload) needed to take a new one
+SUBMISSIONS_PER_HOUR = 30
+SUBMISSIONS_BURST = 10
+QUEUE_MAX_LENGTH = 200
+UPLOADS_MIN_FREE = 2 * 1024 * 1024 * 1024
+# Seconds the submissions turned away for lack of room should wait
+ADMISSION_RETRY_AFTER = 300
+
+# Draft genomes accepted in a single batch submission
+BATCH_MAX_DRAFTS = 50
+
+# Serve the results of an identical past job instead of running Medusa
+RESULTS_CACHE = True
+# Parsed results kept in memory by each web server process
+RESULTS_LRU_SIZE = 256
+
+# Jobs run concurrently by each worker (python worker.py)
+WORKER_SLOTS = 2
+# Seconds between the heartbeats of the worker slots
+WORKER_HEARTBEAT = 10
+# How many times a job is requeued when its worker dies
+WORKER_RETRIES = 1
+# Queue priority penalty (seconds) for each second a job is expected
+# to run (runtime model): at 1.0 a job expected to run for an hour
+# waits behind the jobs submitted up to an hour after it
+QUEUE_COST_WEIGHT = 1.0
+
+# Push the job progress to the waiting page (Server-Sent Events);
+# each open stream keeps a web server thread busy for up to
+# SSE_TIMEOUT seconds, after which the browser reconnects.
+# Off by default: the waiting pages poll /status instead. Only turn
+# it on when /events is served outside the mod_wsgi threads pool
+SSE_ENABLED = False
+SSE_TIMEOUT = 60
+
+# Jobs runtime model (python runtime.py fit): samples kept, fitted
+# again every RUNTIME_REFIT_EVERY jobs once there are enough of them
+RUNTIME_SAMPLES = 5000
+RUNTIME_MIN_SAMPLES = 20
+RUNTIME_REFIT_EVERY = 20
+# Jobs are stopped when slower than the prediction by this many standard
+# errors (but never before RUNTIME_TIMEOUT_MIN seconds)
+RUNTIME_TIMEOUT_SIGMAS = 3
+RUNTIME_TIMEOUT_MIN = 10 * 60
@@ -1,91 +1,981 @@
 #!/usr/bin/env python
 
+import errno
+import json
+import os
 import redis
+import signal
+import socket
+import sys
+import threading
 import time
+from datetime import date, datetime, timedelta
 
-def add_job(req_id, ip, email, passphrase=None):
-    r = redis.Redis()
-    
-    jid = 'medusa_%s'%req_id
+import numpy as np
+
+import archive
+from utils import client_id
+from utils import get_setting
+
+# Round-trips to the redis server and time spent on them, per thread
+_roundtrips = threading.local()
+
+def _spent(start):
+    _roundtrips.seconds = (getattr(_roundtrips, 'seconds', 0.0) +
+                           time.time() - start)
+
+class CountingConnection(redis.Connection):
+    '''Connection keeping track of the round-trips to the server
+
+    Each command (or each whole pipeline) is sent with a single
+    packed write, so that is what gets counted; the time spent
+    writing the commands and waiting for the replies is added up
+    '''
+    def send_packed_command(self, command):
+        _roundtrips.count = getattr(_roundtrips, 'count', 0) + 1
+        start = time.time()
+        try:
+            return redis.Connection.send_packed_command(self, command)
+        finally:
+            _spent(start)
+
+    def read_response(self):
+        start = time.time()
+        try:
+            return redis.Connection.read_response(self)
+        finally:
+            _spent(start)
+
+def reset_roundtrips():
+    _roundtrips.count = 0
+    _roundtrips.seconds = 0.0
+
+def roundtrips():
+    return getattr(_roundtrips, 'count', 0)
+
+def redis_seconds():
+    return getattr(_roundtrips, 'seconds', 0.0)
+
+# One pool per process, shared by all threads
+POOL = redis.ConnectionPool(connection_class=CountingConnection,
+                    host=get_setting('REDIS_HOST', 'localhost'),
+                    port=get_setting('REDIS_PORT', 6379),
+                    db=get_setting('REDIS_DB', 0),
+                    max_connections=get_setting('REDIS_MAX_CONNECTIONS'))
+
+def get_redis():
+    return redis.Redis(connection_pool=POOL)
+
+# All the jobs (job key -> submission time)
+JOBS = 'medusajobs'
+# The finished jobs (job key -> finish time)
+FINISHED_JOBS = 'medusajobs_finished'
+
+# Stats rollups, kept up to date by add_job
+# Jobs per day (day -> count)
+STATS_JOBS = 'medusastats_jobs'
+# HyperLogLog of all the IPs/emails seen so far
+STATS_IPS = 'medusastats_ips'
+STATS_EMAILS = 'medusastats_emails'
+# Unique IPs/emails seen up to each day (day -> count)
+STATS_IPS_DAILY = 'medusastats_ips_daily'
+STATS_EMAILS_DAILY = 'medusastats_emails_daily'
+
+# Per-genome stats cache, keyed by the file content hash
+# (hash -> stats, hash -> last access time, hits/misses counters)
+CACHE_STATS = 'medusacache_stats'
+CACHE_STATS_LRU = 'medusacache_stats_lru'
+CACHE_STATS_COUNTERS = 'medusacache_stats_counters'
+
+# Finished jobs, keyed by their inputs fingerprint (-> req_id)
+CACHE_RESULT = 'medusacache_result_%s'
+
+# Job status changes are published here
+EVENTS = 'medusaevents_%s'
+# Published when a job leaves the queue (positions change)
+EVENTS_QUEUE = 'medusaevents_queue'
+
+# Medusa versions (jar content hash -> version)
+MEDUSA_VERSIONS = 'medusaversions'
+
+# Jobs queue (req_id -> priority, lowest first),
+# its wake-up list, jobs being run (req_id -> slot)
+# the slots heartbeats and the slots of each host
+QUEUE = 'medusaqueue'
+QUEUE_WAKEUP = 'medusaqueue_wakeup'
+RUNNING = 'medusarunning'
+SLOT = 'medusaslot_%s'
+HOST_SLOTS = 'medusaslots_%s'
+
+# Runtime model samples (latest first), their total count
+# and the model fitted on them
+RUNTIME_SAMPLES = 'medusaruntime_samples'
+RUNTIME_SAMPLES_COUNT = 'medusaruntime_samples_count'
+RUNTIME_MODEL = 'medusaruntime_model'
+
+# Uploads blob store: references to each blob (content hash -> count)
+# and the blobs nobody references anymore (content hash -> since)
+BLOBS = 'medusablobs'
+BLOBS_UNUSED = 'medusablobs_unused'
+
+# Batches of jobs (many drafts, the same targets)
+BATCH = 'medusabatch_%s'
 
-    r.zadd('medusajobs', jid, time.time())
+# Submissions rate limits (token buckets, per hashed IP/email)
+# and submissions turned away so far (reason -> count)
+RATE_LIMIT = 'medusaratelimit_%s'
+REJECTIONS = 'medusarejections'
 
-    r.hset(jid, 'ip', ip)
-    r.hset(jid, 'email', email)
-    r.hset(jid, 'date', time.asctime())
-    r.hset(jid, 'time', time.time())
-    r.hset(jid, 'status', 'Job not started')
+# Disk space taken by the finished jobs files,
+# and reclaimed by the retention so far (bytes)
+DISK_USED = 'medusadisk_used'
+DISK_RECLAIMED = 'medusadisk_reclaimed'
 
+# Pop the first queued job and mark it as running on a slot
+DEQUEUE_SCRIPT = '''
+local job = redis.call('zrange', KEYS[1], 0, 0)[1]
+if not job then
+    return nil
+end
+redis.call('zrem', KEYS[1], job)
+redis.call('hset', KEYS[2], job, ARGV[1])
+return job
+'''
+dequeue = get_redis().register_script(DEQUEUE_SCRIPT)
+
+# Update all the rollups for a single job in one (atomic) call
+ROLLUP_SCRIPT = '''
+redis.call('hincrby', KEYS[1], ARGV[1], 1)
+redis.call('pfadd', KEYS[2], ARGV[2])
+redis.call('hset', KEYS[3], ARGV[1], redis.call('pfcount', KEYS[2]))
+redis.call('pfadd', KEYS[4], ARGV[3])
+redis.call('hset', KEYS[5], ARGV[1], redis.call('pfcount', KEYS[4]))
+'''
+rollup = get_redis().register_script(ROLLUP_SCRIPT)
+
+# Record the disk space taken by a finished job
+# (and index it by its finish time)
+DISK_SCRIPT = '''
+local old = tonumber(redis.call('hget', KEYS[1], 'disk') or 0)
+redis.call('hmset', KEYS[1], 'disk', ARGV[1], 'finished', ARGV[2])
+redis.call('incrby', KEYS[2], tonumber(ARGV[1]) - old)
+redis.call('zadd', KEYS[3], ARGV[2], KEYS[1])
+'''
+set_disk = get_redis().register_script(DISK_SCRIPT)
+
+# Mark a finished (or never queued) job as expired (only once, and
+# never a queued or running one), dropping it from the jobs indexes and
+# the results cache; returns the disk space it took, or -1
+EXPIRE_SCRIPT = '''
+local status = redis.call('hget', KEYS[1], 'status')
+if status and status ~= 'Job done' and status ~= 'Job failed' and
+   status ~= 'Job not started' then
+    return -1
+end
+local disk = tonumber(redis.call('hget', KEYS[1], 'disk') or 0)
+if status then
+    redis.call('hmset', KEYS[1], 'status', 'Job expired', 'expired', ARGV[2])
+    redis.call('expire', KEYS[1], ARGV[3])
+end
+redis.call('zrem', KEYS[2], KEYS[1])
+redis.call('zrem', KEYS[6], KEYS[1])
+redis.call('decrby', KEYS[3], disk)
+redis.call('incrby', KEYS[4], disk)
+if redis.call('get', KEYS[5]) == ARGV[1] then
+    redis.call('del', KEYS[5])
+end
+return disk
+'''
+expire = get_redis().register_script(EXPIRE_SCRIPT)
+
+# Drop blob references: the ones held by a job (KEYS[3], only once)
+# or the given ones (ARGV[2]), space separated
+RELEASE_SCRIPT = '''
+local blobs = ARGV[2]
+if KEYS[3] then
+    blobs = redis.call('hget', KEYS[3], 'blobs')
+    if not blobs then
+        return 0
+    end
+    redis.call('hdel', KEYS[3], 'blobs')
+end
+for h in string.gmatch(blobs, '%S+') do
+    if redis.call('hincrby', KEYS[1], h, -1) <= 0 then
+        redis.call('hdel', KEYS[1], h)
+        redis.call('zadd', KEYS[2], ARGV[1], h)
+    end
+end
+return 1
+'''
+release = get_redis().register_script(RELEASE_SCRIPT)
+
+# Take an unused blob out of the store, unless referenced again
+CLAIM_SCRIPT = '''
+redis.call('zrem', KEYS[2], ARGV[1])
+if tonumber(redis.call('hget', KEYS[1], ARGV[1]) or 0) > 0 then
+    return 0
+end
+return 1
+'''
+claim = get_redis().register_script(CLAIM_SCRIPT)
+
+# Take ARGV[4] tokens from a bucket refilled at ARGV[2] tokens per
+# second, up to ARGV[3] (no limit if 0), unless the queue (KEYS[2])
+# has ARGV[5] jobs already; returns -1 when the queue is full, the
+# seconds to wait for the tokens, or 0 once they are taken
+TOKENS_SCRIPT = '''
+local max_queue = tonumber(ARGV[5])
+if max_queue > 0 and redis.call('zcard', KEYS[2]) >= max_queue then
+    return '-1'
+end
+local rate = tonumber(ARGV[2])
+if rate <= 0 then
+    return '0'
+end
+local now = tonumber(ARGV[1])
+local burst = tonumber(ARGV[3])
+local cost = math.min(tonumber(ARGV[4]), burst)
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'time')
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+if tokens < cost then
+    return tostring((cost - tokens) / rate)
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens - cost),
+           'time', ARGV[1])
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+return '0'
+'''
+take_tokens = get_redis().register_script(TOKENS_SCRIPT)
+
+# Add a process group (ARGV[1]) to the space separated ones of a job
+PROCESS_SCRIPT = '''
+local pgids = redis.call('hget', KEYS[1], 'pgids')
+if pgids then
+    pgids = pgids .. ' ' .. ARGV[1]
+else
+    pgids = ARGV[1]
+end
+redis.call('hset', KEYS[1], 'pgids', pgids)
+'''
+add_process = get_redis().register_script(PROCESS_SCRIPT)
+
+def day_bucket(t):
+    '''Return the day bucket (YYYYMMDD) of a timestamp'''
+    return time.strftime('%Y%m%d', time.localtime(t))
+
+def rollup_job(r, t, ip, email):
+    '''Add a single job to the stats rollups
+
+    IPs and emails are counted by their ids, as in the archive
+    '''
+    keys = [STATS_JOBS,
+            STATS_IPS, STATS_IPS_DAILY,
+            STATS_EMAILS, STATS_EMAILS_DAILY]
+    args = [day_bucket(t), client_id(ip), client_id(email)]
+    if isinstance(r, redis.client.BasePipeline):
+        # Not through the script object: in a pipeline it first
+        # checks that the server has the script, another round-trip
+        r.evalsha(rollup.sha, len(keys), *(keys + args))
+    else:
+        rollup(keys=keys, args=args, client=r)
+
+def add_job(req_id, ip, email, passphrase=None, **fields):
+    r = get_redis()
+
+    jid = 'medusa_%s'%req_id
+
+    now = time.time()
+
+    job = {'ip': ip,
+           'email': email,
+           'date': time.asctime(time.localtime(now)),
+           'time': now,
+           'status': 'Job not started'}
     if passphrase is not None:
-        r.hset(jid, 'passphrase', passphrase)
+        job['passphrase'] = passphrase
+    job.update(fields)
+
+    # Everything in a single atomic round-trip
+    p = r.pipeline()
+    p.zadd(JOBS, jid, now)
+    p.hmset(jid, job)
+    rollup_job(p, now, ip, email)
+    try:
+        p.execute()
+    except redis.exceptions.NoScriptError:
+        # The server does not have the script yet (or anymore):
+        # the job is saved, the rollup loads it
+        rollup_job(r, now, ip, email)
 
 def update_job(req_id, key, value):
-    r = redis.Redis()
-    
+    update_job_fields(req_id, {key: value})
+
+def update_job_fields(req_id, fields):
+    """Update many job fields at once
+
+    Status changes are published to the job events channel
+    """
+    r = get_redis()
+
     jid = 'medusa_%s'%req_id
 
-    r.hset(jid, key, value)
+    p = r.pipeline()
+    p.hmset(jid, fields)
+    publish_status(p, req_id, fields)
+    p.execute()
+
+def publish_status(r, req_id, fields):
+    if 'status' in fields:
+        r.publish(EVENTS % req_id, json.dumps({'status': fields['status']}))
+
+def job_progress(req_id):
+    """Status, error and queue position of a job, in one round-trip"""
+    r = get_redis()
+
+    p = r.pipeline(transaction=False)
+    p.hmget('medusa_%s'%req_id, 'status', 'error', 'predicted', 'started')
+    p.zrank(QUEUE, req_id)
+    (status, error, predicted, started), rank = p.execute()
+
+    d = {'status': status}
+    if error:
+        d['error'] = error
+    if rank is not None:
+        d['position'] = rank + 1
+    if predicted:
+        d['predicted'] = int(predicted)
+        if started:
+            # Expected end of the job (timestamp)
+            d['eta'] = int(float(started)) + int(predicted)
+    return d
+
+def subscribe_job(req_id):
+    """Return a pubsub listening to the events of a job"""
+    r = get_redis()
+
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(EVENTS % req_id, EVENTS_QUEUE)
+    return pubsub
 
 def retrieve_job(req_id):
-    r = redis.Redis()
+    r = get_redis()
 
     return r.hgetall('medusa_%s'%req_id)
 
-def slice_it(li, cols=10):
-    start = 0
-    for i in xrange(cols):
-        stop = start + len(li[i::cols])
-        yield li[start:stop]
-        start = stop
+def record_stages(req_id, stages):
+    '''Keep the stages of a job with it and add them to the metrics'''
+    r = get_redis()
 
-def cumulative_jobs(size=100):
-    r = redis.Redis()
+    p = r.pipeline(transaction=False)
+    p.hset('medusa_%s'%req_id, 'stages', json.dumps(stages.compact()))
+    stages.observe(p)
+    p.execute()
 
-    i = 0
+def add_batch(batch_id, ip, email, req_ids, passphrase=None, ttl=None,
+              **fields):
+    '''Record a batch of jobs
+
+    It is kept as long as the details of its jobs
+    '''
+    r = get_redis()
+
+    if ttl is None:
+        ttl = (get_setting('UPLOADS_RETENTION', 7 * 24 * 3600) +
+               get_setting('JOBS_RETENTION', 30 * 24 * 3600))
+
+    now = time.time()
+
+    batch = {'ip': ip,
+             'email': email,
+             'date': time.asctime(time.localtime(now)),
+             'time': now,
+             'jobs': json.dumps(req_ids)}
+    if passphrase is not None:
+        batch['passphrase'] = passphrase
+    batch.update(fields)
+
+    p = r.pipeline()
+    p.hmset(BATCH % batch_id, batch)
+    p.expire(BATCH % batch_id, int(ttl))
+    p.execute()
+
+def retrieve_batch(batch_id):
+    r = get_redis()
+
+    return r.hgetall(BATCH % batch_id)
+
+def retrieve_jobs(req_ids):
+    '''The details of many jobs, in one round-trip'''
+    r = get_redis()
+
+    p = r.pipeline(transaction=False)
+    for req_id in req_ids:
+        p.hgetall('medusa_%s'%req_id)
+    return p.execute()
+
+def jobs_status(req_ids):
+    '''The status of many jobs, in one round-trip'''
+    r = get_redis()
+
+    p = r.pipeline(transaction=False)
+    for req_id in req_ids:
+        p.hget('medusa_%s'%req_id, 'status')
+    return p.execute()
+
+def enqueue_job(req_id, cost=0, priority=None):
+    '''Queue a job for the workers
+
+    Jobs are run in priority order: by default the submission time
+    plus a penalty proportional to the estimated cost (expected run
+    time, seconds), so that short jobs can overtake long ones, but
+    not forever
+    '''
+    r = get_redis()
+
+    if priority is None:
+        priority = time.time() + cost * get_setting('QUEUE_COST_WEIGHT', 1.0)
+
+    fields = {'status': 'Job queued',
+              'priority': priority}
+
+    p = r.pipeline()
+    p.hmset('medusa_%s'%req_id, fields)
+    publish_status(p, req_id, fields)
+    p.zadd(QUEUE, req_id, priority)
+    p.lpush(QUEUE_WAKEUP, req_id)
+    p.ltrim(QUEUE_WAKEUP, 0, 99)
+    p.execute()
+
+def dequeue_job(slot, timeout=5):
+    '''Return the next job to be run by a slot (or None)
+
+    Waits at most timeout seconds for a new job
+    '''
+    r = get_redis()
+
+    req_id = dequeue(keys=[QUEUE, RUNNING], args=[slot])
+    if req_id is None:
+        r.brpop(QUEUE_WAKEUP, timeout)
+        req_id = dequeue(keys=[QUEUE, RUNNING], args=[slot])
+    if req_id is not None:
+        r.publish(EVENTS_QUEUE, req_id)
+    return req_id
+
+def finish_job(req_id):
+    r = get_redis()
+
+    r.hdel(RUNNING, req_id)
+
+def heartbeat(slot, ttl=None):
+    '''Tell the other workers that this slot is alive'''
+    r = get_redis()
+
+    if ttl is None:
+        ttl = get_setting('WORKER_HEARTBEAT', 10) * 6
+
+    p = r.pipeline()
+    p.set(SLOT % slot, time.time(), ex=int(ttl))
+    p.sadd(HOST_SLOTS % slot.rsplit(':', 1)[0], slot)
+    p.execute()
+
+def host_alive(host):
+    '''Whether any slot of a host is alive
+
+    The slots that stopped beating are forgotten
+    '''
+    r = get_redis()
+
+    slots = list(r.smembers(HOST_SLOTS % host))
+    if not slots:
+        return False
+    alive = r.mget([SLOT % s for s in slots])
+    dead = [s for s, a in zip(slots, alive) if a is None]
+    if dead:
+        r.srem(HOST_SLOTS % host, *dead)
+    return len(dead) < len(slots)
+
+def add_job_process(req_id, pgid):
+    '''Record the process group of a command run by a job'''
+    r = get_redis()
+
+    add_process(keys=['medusa_%s'%req_id], args=[pgid], client=r)
+
+def stop_job_processes(req_id):
+    '''Kill the process groups of the commands run by a job
+    (on this host) and forget them'''
+    r = get_redis()
+
+    jid = 'medusa_%s'%req_id
+    for pgid in (r.hget(jid, 'pgids') or '').split():
+        try:
+            os.killpg(int(pgid), signal.SIGKILL)
+        except OSError as e:
+            # Gone already
+            if e.errno != errno.ESRCH:
+                raise
+    r.hdel(jid, 'pgids')
+
+def requeue_dead_jobs(retries=None):
+    '''Put back in the queue the jobs of the slots that died
+
+    The commands the dead slot left running are killed first, so the
+    jobs of a dead slot are requeued from its own host, or by anyone
+    once no slot is alive there (the whole worker is gone).
+    After too many deaths the job is marked as failed;
+    returns the requeued jobs
+    '''
+    r = get_redis()
+
+    if retries is None:
+        retries = get_setting('WORKER_RETRIES', 1)
+
+    running = r.hgetall(RUNNING)
+    if not running:
+        return []
+
+    jobs = list(running)
+    alive = r.mget([SLOT % running[j] for j in jobs])
 
-    res = []
+    host = socket.gethostname()
+    hosts = {}
+    requeued = []
+    for req_id, a in zip(jobs, alive):
+        if a is not None:
+            continue
+        slot_host = running[req_id].rsplit(':', 1)[0]
+        if slot_host != host:
+            if slot_host not in hosts:
+                hosts[slot_host] = host_alive(slot_host)
+            if hosts[slot_host]:
+                continue
+        # Only one worker gets to requeue each job
+        if not r.hdel(RUNNING, req_id):
+            continue
 
-    for j in r.zrange('medusajobs', 0, -1):
+        jid = 'medusa_%s'%req_id
+        if slot_host == host:
+            stop_job_processes(req_id)
+        else:
+            # They died with their host
+            r.hdel(jid, 'pgids')
+        if r.hincrby(jid, 'deaths', 1) > retries:
+            update_job_fields(req_id, {'status': 'Job failed',
+                                       'error': 'The worker running ' +
+                                                'the job died'})
+            continue
+
+        # Back in the queue with its old priority
+        priority = r.hget(jid, 'priority')
+        enqueue_job(req_id,
+                    priority=float(priority) if priority else None)
+        requeued.append(req_id)
+
+    return requeued
+
+def queue_position(req_id):
+    '''Return the 1-based position of a job in the queue (or None)'''
+    r = get_redis()
+
+    rank = r.zrank(QUEUE, req_id)
+    if rank is None:
+        return None
+    return rank + 1
+
+def add_runtime_sample(sample, keep=5000):
+    '''Keep a runtime sample (only the latest ones), returns the count'''
+    r = get_redis()
+
+    p = r.pipeline()
+    p.lpush(RUNTIME_SAMPLES, json.dumps(sample))
+    p.ltrim(RUNTIME_SAMPLES, 0, keep - 1)
+    p.incr(RUNTIME_SAMPLES_COUNT)
+    return p.execute()[-1]
+
+def runtime_samples():
+    r = get_redis()
+
+    return [json.loads(s) for s in r.lrange(RUNTIME_SAMPLES, 0, -1)]
+
+def get_runtime_model():
+    r = get_redis()
+
+    model = r.get(RUNTIME_MODEL)
+    if model is not None:
+        return json.loads(model)
+
+def set_runtime_model(model):
+    r = get_redis()
+
+    r.set(RUNTIME_MODEL, json.dumps(model))
+
+def acquire_blob(h):
+    '''Add a reference to a blob'''
+    r = get_redis()
+
+    p = r.pipeline()
+    p.hincrby(BLOBS, h, 1)
+    p.zrem(BLOBS_UNUSED, h)
+    p.execute()
+
+def release_blobs(hashes):
+    '''Drop references to blobs (not held by a job yet)'''
+    r = get_redis()
+
+    release(keys=[BLOBS, BLOBS_UNUSED],
+            args=[time.time(), ' '.join(hashes)],
+            client=r)
+
+def release_job_blobs(req_id):
+    '''Drop the blob references of a job, if it still holds them'''
+    r = get_redis()
+
+    return bool(release(keys=[BLOBS, BLOBS_UNUSED, 'medusa_%s'%req_id],
+                        args=[time.time(), ''],
+                        client=r))
+
+def unused_blobs(before, count=100):
+    '''Return the blobs nobody references since before'''
+    r = get_redis()
+
+    return r.zrangebyscore(BLOBS_UNUSED, '-inf', before, start=0, num=count)
+
+def claim_blob(h):
+    '''Whether an unused blob can be removed (only once)'''
+    r = get_redis()
+
+    return bool(claim(keys=[BLOBS, BLOBS_UNUSED], args=[h], client=r))
+
+def set_job_disk(req_id, nbytes, finished=None):
+    '''Record the disk space taken by a finished job'''
+    r = get_redis()
+
+    if finished is None:
+        finished = time.time()
+
+    set_disk(keys=['medusa_%s'%req_id, DISK_USED, FINISHED_JOBS],
+             args=[int(nbytes), finished],
+             client=r)
+
+def disk_counters():
+    '''Return the disk space used by the jobs and reclaimed so far'''
+    r = get_redis()
+
+    used, reclaimed = r.mget(DISK_USED, DISK_RECLAIMED)
+    return {'used': int(used or 0), 'reclaimed': int(reclaimed or 0)}
+
+def oldest_jobs(offset=0, count=100, finished=False):
+    '''Return the (job key, submission time, details) of the oldest jobs
+
+    If finished, the finished jobs with their finish time instead,
+    the earliest finished first. Details are the fields needed by the
+    retention, and whether the job is in the finished jobs index;
+    a single round-trip for the index, one for the details
+    '''
+    r = get_redis()
+
+    jobs = r.zrange(FINISHED_JOBS if finished else JOBS,
+                    offset, offset + count - 1, withscores=True)
+
+    fields = ('status', 'finished', 'disk', 'wdir', 'fingerprint')
+    p = r.pipeline(transaction=False)
+    for jid, t in jobs:
+        p.hmget(jid, *fields)
+        p.zscore(FINISHED_JOBS, jid)
+    values = p.execute()
+    return [(jid, t, dict(zip(fields, values[2 * i]),
+                          indexed=values[2 * i + 1] is not None))
+            for i, (jid, t) in enumerate(jobs)]
+
+def expire_job(jid, fingerprint=None, ttl=None):
+    '''Mark a finished job as expired, keeping its details for ttl
+
+    Returns the disk space recorded for it, or None if the job
+    is not finished (or has been expired already)
+    '''
+    r = get_redis()
+
+    if ttl is None:
+        ttl = get_setting('JOBS_RETENTION', 30 * 24 * 3600)
+
+    req_id = jid[len('medusa_'):]
+    disk = expire(keys=[jid, JOBS, DISK_USED, DISK_RECLAIMED,
+                        CACHE_RESULT % fingerprint, FINISHED_JOBS],
+                  args=[req_id, time.time(), int(ttl)],
+                  client=r)
+    if disk < 0:
+        return None
+    return disk
+
+def admit(bucket, rate=None, burst=1, cost=1, max_queue=None):
+    '''Take cost submissions from a rate limit bucket
+
+    rate is in submissions per second (None for no limit); nothing
+    is taken if the queue has max_queue jobs already. Returns -1 if
+    the queue is full, the seconds to wait, or 0 once taken
+    '''
+    r = get_redis()
+
+    return float(take_tokens(keys=[RATE_LIMIT % bucket, QUEUE],
+                             args=[time.time(), rate or 0, burst, cost,
+                                   max_queue or 0],
+                             client=r))
+
+def count_rejection(reason):
+    r = get_redis()
+
+    r.hincrby(REJECTIONS, reason, 1)
+
+def rejection_counters():
+    '''Submissions turned away so far, per reason'''
+    r = get_redis()
+
+    return dict((k, int(v)) for k, v in r.hgetall(REJECTIONS).items())
+
+def queue_length():
+    r = get_redis()
+
+    return r.zcard(QUEUE)
+
+def running_jobs():
+    r = get_redis()
+
+    return r.hlen(RUNNING)
+
+def get_medusa_version(jar_hash):
+    r = get_redis()
+
+    return r.hget(MEDUSA_VERSIONS, jar_hash)
+
+def set_medusa_version(jar_hash, version):
+    r = get_redis()
+
+    r.hset(MEDUSA_VERSIONS, jar_hash, version)
+
+def get_cached_stats(hashes):
+    '''Return the cached stats (or None) for each content hash
+
+    A single round-trip for all the hashes, hits/misses are counted
+    '''
+    r = get_redis()
+
+    hashes = [h for h in hashes if h is not None]
+    if not hashes:
+        return {}
+
+    stats = dict(zip(hashes, r.hmget(CACHE_STATS, hashes)))
+    hits = [h for h in hashes if stats[h] is not None]
+
+    p = r.pipeline(transaction=False)
+    now = time.time()
+    for h in hits:
+        p.zadd(CACHE_STATS_LRU, h, now)
+    p.hincrby(CACHE_STATS_COUNTERS, 'hits', len(hits))
+    p.hincrby(CACHE_STATS_COUNTERS, 'misses', len(hashes) - len(hits))
+    p.execute()
+
+    return dict((h, json.loads(stats[h])) for h in hits)
+
+def cache_stats(stats, size=None):
+    '''Add the stats of some genomes to the cache (hash -> stats)
+
+    The least recently used entries are evicted to keep
+    at most "size" genomes
+    '''
+    r = get_redis()
+
+    if size is None:
+        size = get_setting('STATS_CACHE_SIZE', 10000)
+
+    if not stats:
+        return
+
+    now = time.time()
+    p = r.pipeline()
+    p.hmset(CACHE_STATS, dict((h, json.dumps(d))
+                              for h, d in stats.items()))
+    for h in stats:
+        p.zadd(CACHE_STATS_LRU, h, now)
+    p.execute()
+
+    excess = r.zcard(CACHE_STATS_LRU) - size
+    if excess > 0:
+        old = r.zrange(CACHE_STATS_LRU, 0, excess - 1)
+        p = r.pipeline()
+        p.zrem(CACHE_STATS_LRU, *old)
+        p.hdel(CACHE_STATS, *old)
+        p.execute()
+
+def stats_cache_counters():
+    '''Return the stats cache hits and misses'''
+    r = get_redis()
+
+    counters = r.hgetall(CACHE_STATS_COUNTERS)
+    return dict((k, int(counters.get(k, 0))) for k in ('hits', 'misses'))
+
+def get_cached_result(fingerprint):
+    '''Return the req_id of a finished job with the same fingerprint'''
+    r = get_redis()
+
+    return r.get(CACHE_RESULT % fingerprint)
+
+def cache_result(fingerprint, req_id, ttl=None):
+    '''Remember a finished job for as long as its files are kept'''
+    r = get_redis()
+
+    if ttl is None:
+        ttl = get_setting('UPLOADS_RETENTION', 7 * 24 * 3600)
+
+    r.set(CACHE_RESULT % fingerprint, req_id, ex=int(ttl))
+
+def _series(key, start=None, stop=None, bucket=None, size=100,
+            cumulative=True):
+    '''Return the (value, date) points of a daily rollup
+
+    start and stop are datetime.date objects (defaults to the first
+    recorded day and today), bucket is the bucket size in days
+    (defaults to the smallest size giving at most "size" buckets).
+    If cumulative the daily values are summed, otherwise the last
+    recorded value is carried over (running maximum)
+    '''
+    r = get_redis()
+
+    daily = {}
+    for k, v in r.hgetall(key).items():
+        daily[datetime.strptime(k, '%Y%m%d').date()] = int(v)
+    if not daily:
+        return
+
+    if start is None:
+        start = min(daily)
+    if stop is None:
+        stop = date.today()
+    if stop < start:
+        return
+
+    ndays = (stop - start).days + 1
+    if bucket is None:
+        bucket = max(1, -(-ndays // size))
+
+    # Whatever happened before the requested interval
+    value = 0
+    for d in daily:
+        if d < start:
+            if cumulative:
+                value += daily[d]
+            else:
+                value = max(value, daily[d])
+
+    day = start
+    i = 0
+    while day <= stop:
+        v = daily.get(day, 0)
+        if cumulative:
+            value += v
+        else:
+            value = max(value, v)
         i += 1
-        date = r.hget(j, 'date')
-        res.append( (i, date) )
+        if i % bucket == 0 or day == stop:
+            yield (value, time.asctime(day.timetuple()))
+        day += timedelta(days=1)
+
+def cumulative_jobs(start=None, stop=None, bucket=None, size=100):
+    return _series(STATS_JOBS, start, stop, bucket, size)
+
+def unique_emails(start=None, stop=None, bucket=None, size=100):
+    return _series(STATS_EMAILS_DAILY, start, stop, bucket, size,
+                   cumulative=False)
+
+def unique_ips(start=None, stop=None, bucket=None, size=100):
+    return _series(STATS_IPS_DAILY, start, stop, bucket, size,
+                   cumulative=False)
+
+def first_stats_day():
+    '''Return the first day with recorded jobs (or None)'''
+    r = get_redis()
+
+    days = r.hkeys(STATS_JOBS)
+    if not days:
+        return None
+    return datetime.strptime(min(days), '%Y%m%d').date()
+
+def day_buckets(times):
+    '''Return the day buckets of many timestamps'''
+    # Local days are made of whole quarters of an hour,
+    # whatever the time zone
+    quarters, inverse = np.unique(np.floor_divide(times, 900),
+                                  return_inverse=True)
+    return np.array([day_bucket(q * 900) for q in quarters])[inverse]
+
+def backfill_stats(batch=1000):
+    '''Rebuild the stats rollups from the whole jobs history,
+    the archive and the jobs still in redis
+
+    Meant to be run once (e.g. after an upgrade), better while
+    no new jobs are being submitted
+    '''
+    r = get_redis()
+
+    old = archive.load(['time', 'ip', 'email'])
+    times = [np.asarray(old['time'])]
+    ips = [np.asarray(old['ip'])]
+    emails = [np.asarray(old['email'])]
 
-    for s in slice_it(res, cols=size):
-        if len(s) > 0:
-            yield s[-1]
+    total = r.zcard(JOBS)
+    for offset in xrange(0, total, batch):
+        jobs = r.zrange(JOBS, offset, offset + batch - 1,
+                        withscores=True)
 
-def unique_emails(size=100):
-    r = redis.Redis()
+        p = r.pipeline(transaction=False)
+        for jid, t in jobs:
+            p.hmget(jid, 'ip', 'email')
+        details = p.execute()
 
-    ip = set()
+        times.append(np.array([t for jid, t in jobs], dtype=np.float64))
+        ips.append(np.array([client_id(ip or '') for ip, email in details],
+                            dtype=np.uint64))
+        emails.append(np.array([client_id(email or '')
+                                for ip, email in details],
+                               dtype=np.uint64))
 
-    res = []
+    times = np.concatenate(times)
+    order = np.argsort(times, kind='mergesort')
+    days = day_buckets(times[order])
+    ips = np.concatenate(ips)[order]
+    emails = np.concatenate(emails)[order]
 
-    for j in r.zrange('medusajobs', 0, -1):
-        i = r.hget(j, 'email')
-        date = r.hget(j, 'date')
-        if i not in ip:
-            ip.add(i)
-            res.append( (len(ip), date) )
+    r.delete(STATS_JOBS, STATS_IPS, STATS_IPS_DAILY,
+             STATS_EMAILS, STATS_EMAILS_DAILY)
+    if not len(days):
+        return 0
 
-    for s in slice_it(res, cols=size):
-        if len(s) > 0:
-            yield s[-1] 
+    # The days are sorted: one slice of jobs per day
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    stops = np.r_[starts[1:], len(days)]
+    r.hmset(STATS_JOBS, dict(zip(days[starts],
+                                 (stops - starts).tolist())))
 
-def unique_ips(size=100):
-    r = redis.Redis()
+    # Unique IPs/emails up to each day, a few days at a time
+    for i in xrange(0, len(starts), 100):
+        p = r.pipeline(transaction=False)
+        for start, stop in zip(starts[i:i+100], stops[i:i+100]):
+            p.pfadd(STATS_IPS, *ips[start:stop].tolist())
+            p.pfcount(STATS_IPS)
+            p.pfadd(STATS_EMAILS, *emails[start:stop].tolist())
+            p.pfcount(STATS_EMAILS)
+        counts = p.execute()
 
-    ip = set()
+        day = days[starts[i:i+100]]
+        r.hmset(STATS_IPS_DAILY, dict(zip(day, counts[1::4])))
+        r.hmset(STATS_EMAILS_DAILY, dict(zip(day, counts[3::4])))
 
-    res = []
+    return len(days)
 
-    for j in r.zrange('medusajobs', 0, -1):
-        i = r.hget(j, 'ip')
-        date = r.hget(j, 'date')
-        if i not in ip:
-            ip.add(i)
-            res.append( (len(ip), date) )
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'backfill':
+        sys.stderr.write('Usage: python store.py backfill\n')
+        sys.exit(1)
 
-    for s in slice_it(res, cols=size):
-        if len(s) > 0:
-            yield s[-1]
+    n = backfill_stats()
+    sys.stdout.write('Stats rollups rebuilt from %d jobs\n' % n)
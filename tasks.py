@@ -5,38 +5,164 @@ import shutil
 import subprocess
 import sys
 import json
+import gzip
+import hashlib
+import math
+import multiprocessing
+import multiprocessing.pool
+import signal
+import time
 
-from Bio import SeqIO
+from assembly import assembly_stats
+from fasta import scan_fasta
+from metrics import Stages
+from runtime import features
+from runtime import job_limits
+from runtime import record
 
-from utils import N50
+from utils import get_setting
+from utils import disk_usage
 
 from store import update_job
+from store import update_job_fields
+from store import add_job_process
+from store import retrieve_job
+from store import record_stages
+from store import set_job_disk
+from store import release_job_blobs
+from store import get_cached_stats
+from store import cache_stats
+from store import cache_result
+from store import get_medusa_version
+from store import set_medusa_version
 
-def run_cmd(cmd, ignore_error=False):
+# Jobs mode running Medusa many times, keeping the best scaffold
+MULTI = 'multi'
+
+# Files that make up the results of a job
+RESULT_FILES = ['scaffold.fasta.gz', 'scaffold.fasta',
+                'result.json', 'log.txt', 'log.err']
+
+def run_cmd(cmd, ignore_error=False, stages=None, timeout=None, cwd=None,
+            req_id=None):
     """
     Run a command line command
     Returns True or False based on the exit code
-    """
-    proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
-                    stdin=subprocess.PIPE,stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-    out = proc.communicate()
-    return_code = proc.returncode
 
-    t = open('log.txt', 'w')
-    e = open('log.err', 'w')
+    The output goes to log.txt and log.err (in cwd) while the
+    command runs, so that running jobs can be followed;
+    the resources used by the command go to stages.
+    The command is killed after timeout seconds, and its process
+    group is recorded with the job req_id (if any), to be killed
+    if the worker dies
+    """
+    t = open(os.path.join(cwd or '', 'log.txt'), 'w')
+    e = open(os.path.join(cwd or '', 'log.err'), 'w')
+    try:
+        # In its own process group, to kill the whole command line
+        proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
+                        stdin=subprocess.PIPE,stdout=t,
+                        stderr=e, preexec_fn=os.setsid, cwd=cwd)
+        proc.stdin.close()
+        if req_id is not None:
+            add_job_process(req_id, proc.pid)
+        # Like proc.wait(), also getting the resource usage
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            pid, status, usage = os.wait4(proc.pid,
+                                          os.WNOHANG if deadline else 0)
+            if pid:
+                break
+            if time.time() < deadline:
+                time.sleep(1)
+                continue
+            e.write('\nCommand (%s) timed out after %d seconds\n'
+                    % (cmd, timeout))
+            os.killpg(proc.pid, signal.SIGKILL)
+            deadline = None
+        if os.WIFEXITED(status):
+            return_code = os.WEXITSTATUS(status)
+        else:
+            return_code = -os.WTERMSIG(status)
+        proc.returncode = return_code
+        if stages is not None:
+            stages.child(usage)
 
-    t.write('%s\n'%str(out[0]))
-    if return_code != 0 and not ignore_error:
-        e.write('Command (%s) failed w/ error %d\n'
-                        %(cmd, return_code))
-        e.write('%s\n'%str(out[1]))
-        e.write('\n')
+        if return_code != 0 and not ignore_error:
+            e.write('\nCommand (%s) failed w/ error %d\n'
+                            %(cmd, return_code))
+    finally:
+        t.close()
+        e.close()
 
     return bool(not return_code)
 
-def medusa_version():
-    cmd = 'java -jar medusa.jar -h'
+def artifacts_manifest(wdir):
+    """
+    The result files of a job ({name: [size, mtime]}), kept with
+    the job so that the web app does not need to look for them
+    """
+    manifest = {}
+    for f in RESULT_FILES:
+        try:
+            st = os.stat(os.path.join(wdir, f))
+        except OSError:
+            continue
+        manifest[f] = [st.st_size, st.st_mtime]
+    return manifest
+
+def compress_file(fname):
+    """
+    Replace a file with its gzip compressed version
+    """
+    f = open(fname, 'rb')
+    out = gzip.open(fname + '.gz', 'wb')
+    shutil.copyfileobj(f, out, 1024 * 1024)
+    out.close()
+    f.close()
+    os.remove(fname)
+
+def medusa_bundle():
+    """
+    Directory with medusa.jar and the medusa_scripts folder
+    Symlinks are resolved, so that a bundle can be replaced atomically
+    (ln -sfn) while the running jobs stick to the old one
+    """
+    bundle = get_setting('MEDUSA_FOLDER', 'medusa-app')
+    if not os.path.isabs(bundle):
+        bundle = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              bundle)
+    return os.path.realpath(bundle)
+
+def medusa_jar(bundle=None):
+    if bundle is None:
+        bundle = medusa_bundle()
+    return os.path.join(bundle, 'medusa.jar')
+
+def _jar_key(jar):
+    st = os.stat(jar)
+    return (jar, st.st_mtime, st.st_size, st.st_ino)
+
+_jar_hash = {}
+def medusa_jar_hash(bundle=None):
+    """
+    Content hash of the Medusa jar file
+    Computed again only when the jar changes
+    """
+    jar = medusa_jar(bundle)
+    key = _jar_key(jar)
+    if key not in _jar_hash:
+        h = hashlib.sha256()
+        f = open(jar, 'rb')
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+        f.close()
+        _jar_hash.clear()
+        _jar_hash[key] = h.hexdigest()
+    return _jar_hash[key]
+
+def probe_medusa_version(jar):
+    cmd = 'java -jar %s -h' % jar
     proc = subprocess.Popen(cmd,shell=(sys.platform!="win32"),
                     stdin=subprocess.PIPE,stdout=subprocess.PIPE,
                     stderr=subprocess.PIPE)
@@ -47,114 +173,419 @@ def medusa_version():
     except:
         return None
 
+_version = {}
+def medusa_version(bundle=None):
+    """
+    Medusa version string
+    The JVM is started only once per jar (keyed by its content hash)
+    and the result shared with the other workers through redis
+    """
+    jar = medusa_jar(bundle)
+    key = _jar_key(jar)
+    if key not in _version:
+        jar_hash = medusa_jar_hash(bundle)
+        version = get_medusa_version(jar_hash)
+        if version is None:
+            version = probe_medusa_version(jar)
+            if version is not None:
+                set_medusa_version(jar_hash, version)
+        _version.clear()
+        _version[key] = version
+    return _version[key]
+
+def job_fingerprint(draft_hash, target_hashes, options=None):
+    """
+    Fingerprint of a job: identical inputs, Medusa version
+    and options give the very same results
+    """
+    if options is None:
+        options = get_setting('MEDUSA_OPTIONS', '-random 5')
+    data = json.dumps([draft_hash,
+                       sorted(target_hashes),
+                       medusa_jar_hash(),
+                       options])
+    return hashlib.sha256(data).hexdigest()
+
+def reuse_results(src_wdir, wdir, src_hashes, hashes):
+    """
+    Copy (or link) the results of a past job with identical inputs
+    The input files names in result.json are updated to the new ones
+    Returns False if the past results are not available anymore
+    """
+    if not os.path.exists(os.path.join(src_wdir, 'result.json')):
+        return False
+
+    names = dict((h, n) for n, h in hashes.items())
+    result = json.load(open(os.path.join(src_wdir, 'result.json')))
+    for d in [result['draft']] + result['targets']:
+        h = src_hashes.get(d['name'])
+        if h in names:
+            d['name'] = names[h]
+
+    for f in RESULT_FILES:
+        if f == 'result.json' or not os.path.exists(os.path.join(src_wdir, f)):
+            continue
+        try:
+            os.link(os.path.join(src_wdir, f), os.path.join(wdir, f))
+        except OSError:
+            shutil.copy(os.path.join(src_wdir, f), os.path.join(wdir, f))
+    json.dump(result, open(os.path.join(wdir, 'result.json'), 'w'))
+
+    return True
+
 def single_genome_stats(fname):
     d = {}
 
-    lseqs = []
-    for s in SeqIO.parse(fname, 'fasta'):
-        lseqs.append(len(s))
+    name = os.path.split(fname)[-1]
+
+    scan = scan_fasta(fname)
+    if scan.errors:
+        raise Exception('%s: %s' % (name, '; '.join(scan.errors)))
+
+    d['name'] = name
+    d.update(assembly_stats(scan.lengths))
+    d['GC'] = scan.gc_content()
+    d['gaps'] = scan.gaps
+    d['N'] = scan.n
 
-    d['name'] = os.path.split(fname)[-1]
-    d['length'] = sum(lseqs)
-    d['contigs'] = len(lseqs)
-    d['N50'] = N50(lseqs)
-    
     return d
 
-def genome_stats(draft, genomes):
+def job_cores():
+    """
+    Cores available to a job: the worker cores
+    are shared by its slots
+    """
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = multiprocessing.cpu_count()
+    return max(1, n // get_setting('WORKER_SLOTS', 1))
+
+def stats_processes(nfiles):
+    """
+    Number of processes used to compute the genome stats
+    Defaults to the cores available to this job's worker slot
+    """
+    n = get_setting('STATS_PROCESSES') or job_cores()
+    return max(1, min(n, nfiles))
+
+def files_stats(files, hashes=None, processes=None):
+    """
+    Calculate the stats of many genome files, in order
+
+    hashes maps file names to their content hash: the stats
+    of already seen genomes are taken from the cache, the
+    others are computed (by processes processes) and cached
+    """
+    if hashes is None:
+        hashes = {}
+    fhashes = [hashes.get(os.path.split(f)[-1]) for f in files]
+    cached = get_cached_stats(fhashes)
+
+    missing = [f for f, h in zip(files, fhashes) if h not in cached]
+
+    nproc = processes or stats_processes(len(missing))
+    if nproc == 1:
+        stats = [single_genome_stats(f) for f in missing]
+    else:
+        pool = multiprocessing.Pool(nproc)
+        try:
+            # imap keeps the input order, so the first
+            # broken file is reported, as in the serial case
+            stats = list(pool.imap(single_genome_stats, missing))
+        finally:
+            pool.terminate()
+            pool.join()
+    computed = dict(zip(missing, stats))
+
+    stats = []
+    new = {}
+    for f, h in zip(files, fhashes):
+        if f in computed:
+            stats.append(computed[f])
+            if h is not None:
+                new[h] = dict((k, v) for k, v in computed[f].items()
+                              if k != 'name')
+        else:
+            s = dict(cached[h])
+            s['name'] = os.path.split(f)[-1]
+            stats.append(s)
+    cache_stats(new)
+
+    return stats
+
+def genome_stats(draft, genomes, hashes=None):
     """
     Calculate general stats on the input genomes
     The data is returned back as a serializible dictionary
+
+    hashes maps file names to their content hash: the stats
+    of already seen genomes are taken from the cache
     """
     d = {}
-    
-    d['draft'] = single_genome_stats(draft)
-    
-    d['targets'] = []
-    for g in genomes:
-        d['targets'].append( single_genome_stats(g) )
+
+    stats = files_stats([draft] + list(genomes), hashes)
+
+    d['draft'] = stats[0]
+    d['targets'] = stats[1:]
 
     return d
 
-def run_medusa(req_id, wdir, draft, targets):
+def medusa_cmd(bundle, draft, options):
+    return 'java -jar %s -i %s %s -f drafts -o %s'%(medusa_jar(bundle),
+                                  draft,
+                                  options,
+                                  'scaffold.fasta')
+
+def medusa_runs():
+    """
+    Medusa options of each run of the multiple runs mode
+    (each run also draws its own random numbers)
+    """
+    return get_setting('MEDUSA_MULTI_OPTIONS',
+                       [get_setting('MEDUSA_OPTIONS', '-random 5')] * 4)
+
+def multi_cores(runs):
+    """
+    Medusa runs made at once in the multiple runs mode
+    """
+    cores = get_setting('MEDUSA_MULTI_CORES') or job_cores()
+    return max(1, min(cores, len(runs)))
+
+def multi_waves(runs):
+    """
+    Medusa runs made one after the other in the multiple runs mode
+    """
+    return int(math.ceil(len(runs) / float(multi_cores(runs))))
+
+def run_medusa_many(bundle, draft, runs, stages=None, deadline=None,
+                    req_id=None):
+    """
+    Run Medusa once for each of the options, concurrently within
+    the job cores, each run in its own subdirectory (run1, run2, ...)
+    Returns whether each run succeeded
+    """
+    dirs = []
+    for i in range(len(runs)):
+        rdir = 'run%d' % (i + 1)
+        # Left over by a previous attempt
+        if os.path.lexists(rdir):
+            shutil.rmtree(rdir)
+        os.mkdir(rdir)
+        for f in ('medusa_scripts', 'drafts', draft):
+            os.symlink(os.path.join('..', f), os.path.join(rdir, f))
+        dirs.append(rdir)
+
+    def run(i):
+        return run_cmd(medusa_cmd(bundle, draft, runs[i]), stages=stages,
+                       timeout=deadline and max(1, deadline - time.time()),
+                       cwd=dirs[i], req_id=req_id)
+
+    pool = multiprocessing.pool.ThreadPool(multi_cores(runs))
+    try:
+        return pool.map(run, range(len(runs)))
+    finally:
+        pool.close()
+        pool.join()
+
+def keep_best_run(runs, oks):
+    """
+    Score the scaffolds of the runs (highest N50, then fewest
+    contigs) and keep the best one as scaffold.fasta
+    The logs of all the runs go to log.txt and log.err
+    Returns the runs summary and the best scaffold stats (or None)
+    """
+    summary = []
+    best = None
+    for i, (options, ok) in enumerate(zip(runs, oks)):
+        rdir = 'run%d' % (i + 1)
+        s = {'run': i + 1, 'options': options, 'ok': ok}
+        if ok:
+            try:
+                stats = single_genome_stats(os.path.join(rdir,
+                                                         'scaffold.fasta'))
+                s.update((k, stats[k]) for k in ('N50', 'contigs', 'length'))
+                if best is None or ((stats['N50'], -stats['contigs']) >
+                                    (best[1]['N50'], -best[1]['contigs'])):
+                    best = (s, stats)
+            except Exception as e:
+                s['ok'] = False
+                s['error'] = str(e)
+        summary.append(s)
+
+    for log in ('log.txt', 'log.err'):
+        out = open(log, 'w')
+        for s in summary:
+            out.write('### Run %d (%s)\n' % (s['run'], s['options']))
+            fname = os.path.join('run%d' % s['run'], log)
+            if os.path.exists(fname):
+                shutil.copyfileobj(open(fname), out)
+            out.write('\n')
+        out.close()
+
+    if best is None:
+        return summary, None
+    best[0]['best'] = True
+    os.rename(os.path.join('run%d' % best[0]['run'], 'scaffold.fasta'),
+              'scaffold.fasta')
+    for s in summary:
+        shutil.rmtree('run%d' % s['run'], ignore_errors=True)
+
+    return summary, best[1]
+
+def run_medusa(req_id, wdir, draft, targets, stages=None):
     sdir = os.getcwd()
+    start = time.time()
+    if stages is None:
+        stages = Stages()
+
+    def stage(name):
+        update_job(req_id, 'status', name)
+        stages.start(name)
 
-    update_job(req_id, 'status', 'Copying Medusa files')
-    # Move all the medusa files
-    shutil.copy(os.path.join(sdir, 'medusa-app', 'medusa.jar'), wdir)
-    os.mkdir(os.path.join(wdir, 'medusa_scripts'))
-    for f in os.listdir(os.path.join(sdir, 'medusa-app', 'medusa_scripts')):
-        shutil.copy(os.path.join(sdir, 'medusa-app', 'medusa_scripts', f),
-                    os.path.join(wdir, 'medusa_scripts'))
+    stage('Linking Medusa files')
+    # Medusa looks for its scripts in the working directory:
+    # link the shared bundle there, the jar is run from its place
+    bundle = medusa_bundle()
+    link = os.path.join(wdir, 'medusa_scripts')
+    # A job requeued after its worker died starts over
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.join(bundle, 'medusa_scripts'), link)
 
-    # Before moving the genomes, calculte some stats
+    # The targets have been saved in the drafts directory already
+    # Before running Medusa, calculte some stats
     # Length
     # Number of molecules
     # N50
     
-    update_job(req_id, 'status', 'Computing initial statistics')
+    stage('Computing initial statistics')
+    job = retrieve_job(req_id)
+    hashes = json.loads(job.get('hashes', '{}'))
     # Catch errors, may be due to incorrect format
     try:
         d = genome_stats(os.path.join(wdir,draft),
-                         [os.path.join(wdir, x) for x in targets])
+                         [os.path.join(wdir, 'drafts', x) for x in targets],
+                         hashes)
     except Exception as e:
         raise Exception('Something is wrong with the input files (%s)' % e)
 
-    update_job(req_id, 'status', 'Copying genome files')
-    # Create he drafts directory, move the genomes there
-    try:
-        os.mkdir(os.path.join(wdir, 'drafts'))
-    except:pass
-   
-    # Rename the target genomes
-    for g in targets:
-        shutil.move(os.path.join(wdir, g),
-                    os.path.join(wdir, 'drafts', g))
- 
+    # A better runtime prediction, now that the inputs are known
+    waves = 1
+    if job.get('mode') == MULTI:
+        waves = multi_waves(medusa_runs())
+    limits = job_limits(features(d['draft'], d['targets']), waves)
+    update_job_fields(req_id, limits)
+
     # Move to working directory
     os.chdir(wdir)
     
-    update_job(req_id, 'status', 'Getting Medusa version')
-    d['version'] = medusa_version()
-
-    update_job(req_id, 'status', 'Running Medusa')
-    # Run Medusa
-    cmd = 'java -jar medusa.jar -i %s -random 5 -f drafts -o %s'%(draft,
-                                                          'scaffold.fasta')
-    if not run_cmd(cmd):
+    stage('Getting Medusa version')
+    d['version'] = medusa_version(bundle)
+
+    stage('Running Medusa')
+    # Hung jobs are stopped, once there is a model to tell them
+    deadline = None
+    if 'predicted' in limits:
+        deadline = start + limits['timeout']
+    if job.get('mode') == MULTI:
+        # Many runs, the best scaffold is kept
+        runs = medusa_runs()
+        oks = run_medusa_many(bundle, draft, runs, stages, deadline, req_id)
+        stage('Choosing the best scaffold')
+        d['runs'], d['scaffold'] = keep_best_run(runs, oks)
+        ok = d['scaffold'] is not None
+    else:
+        ok = run_cmd(medusa_cmd(bundle, draft,
+                                get_setting('MEDUSA_OPTIONS', '-random 5')),
+                     stages=stages,
+                     timeout=deadline and max(1, deadline - time.time()),
+                     req_id=req_id)
+    if not ok:
+        if deadline is not None and time.time() >= deadline:
+            raise Exception('Medusa took too long (more than %d minutes)'
+                            % (limits['timeout'] // 60) +
+                            ' and has been halted!')
         raise Exception('Medusa execution halted!')
 
-    update_job(req_id, 'status', 'Computing final statistics')
-    # Compute results
-    d['scaffold'] = single_genome_stats('scaffold.fasta')
+    if d.get('scaffold') is None:
+        stage('Computing final statistics')
+        # Compute results
+        d['scaffold'] = single_genome_stats('scaffold.fasta')
     
-    update_job(req_id, 'status', 'Cleaning up')
+    stage('Cleaning up')
+    # Keep the scaffold compressed
+    compress_file('scaffold.fasta')
+
     try:
         # Be kind, remove the original files...
         shutil.rmtree('drafts')
         os.remove(draft)
 
-        # ...and the medusa bundle
-        shutil.rmtree('medusa_scripts')
-        os.remove('medusa.jar')
+        # ...and the link to the medusa bundle
+        os.remove('medusa_scripts')
     except:pass
+    # The inputs blobs can go, once no other job links them
+    release_job_blobs(req_id)
     
     # Return back to the original directory
     os.chdir(sdir)
+    stages.stop()
 
     return d
 
+def process_job(req_id, wdir, dname, genomes):
+    """
+    Run a whole job, keeping track of its status
+    Errors are stored with the job, not raised
+    The time and resources taken by each stage are kept with
+    the job and added to the metrics
+    """
+    sdir = os.getcwd()
+    stages = Stages()
+
+    update_job_fields(req_id, {'status': 'Job starting',
+                               'started': time.time()})
+    try:
+        result = run_medusa(req_id, wdir, dname, genomes, stages)
+        f = open(os.path.join(wdir, 'result.json'), 'w')
+        json.dump(result, f)
+        f.close()
+        update_job_fields(req_id, {'status': 'Job done',
+                                   'manifest': json.dumps(
+                                       artifacts_manifest(wdir))})
+        try:
+            # Teach the runtime model (single runs only)
+            if 'runs' not in result:
+                record(features(result['draft'], result['targets']),
+                       stages.total())
+        except Exception as e:
+            sys.stderr.write('Could not update the runtime model: %s\n' % e)
+        # Identical submissions will get these results
+        fingerprint = retrieve_job(req_id).get('fingerprint')
+        if fingerprint:
+            cache_result(fingerprint, req_id)
+    except Exception as e:
+        update_job_fields(req_id, {'status': 'Job failed',
+                                   'error': str(e),
+                                   'manifest': json.dumps(
+                                       artifacts_manifest(wdir))})
+    finally:
+        # Long lived workers run many jobs
+        os.chdir(sdir)
+        stages.stop()
+        try:
+            record_stages(req_id, stages)
+            # What the retention will reclaim
+            set_job_disk(req_id, disk_usage(wdir))
+        except Exception as e:
+            sys.stderr.write('Could not record the resources used by %s: %s\n'
+                             % (req_id, e))
+
 if __name__ == "__main__":
     req_id = sys.argv[1]
     wdir = sys.argv[2]
     dname = sys.argv[3]
     genomes = sys.argv[4:]
 
-    update_job(req_id, 'status', 'Job starting')
-    try:
-        result = run_medusa(req_id, wdir, dname, genomes)
-        json.dump(result, open(os.path.join(wdir, 'result.json'), 'w'))
-        update_job(req_id, 'status', 'Job done')
-    except Exception as e:
-        update_job(req_id, 'status', 'Job failed')
-        update_job(req_id, 'error', str(e))
+    process_job(req_id, wdir, dname, genomes)
@@ -0,0 +1,103 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import archive
+
+def job(req_id, t=1000.0, status='Job done', **fields):
+    job = {'time': t, 'started': t + 10, 'finished': t + 70,
+           'status': status, 'ip': '1.2.3.4', 'email': 'a@b.c',
+           'draft': 'draft.fa',
+           'inputs': json.dumps({'draft.fa': {'size': 100, 'records': 3},
+                                 'target.fa': {'size': 200, 'records': 1}})}
+    job.update(fields)
+    return 'medusa_%s' % req_id, job
+
+RESULT = {'draft': {'length': 6000, 'contigs': 3, 'N50': 2500.5},
+          'targets': [{'length': 6000}],
+          'scaffold': {'contigs': 1, 'N50': 6000}}
+
+def rows(*ids):
+    return [archive.job_row(*job(req_id, t=float(i)), result=RESULT)
+            for i, req_id in enumerate(ids)]
+
+def test_job_row():
+    row = archive.job_row(*job('ab' * 16), result=RESULT)
+    assert row['id'] == int('ab' * 8, 16)
+    assert row['status'] == archive.STATUSES.index('Job done')
+    assert row['seconds'] == 60
+    assert row['draft_size'] == 100
+    assert row['targets'] == 1
+    assert row['targets_size'] == 200
+    assert row['draft_N50'] == 2500.5
+    assert row['targets_length'] == 6000
+
+    # Failed jobs have no results
+    row = archive.job_row(*job('cd' * 16, status='Job failed'))
+    assert np.isnan(row['draft_N50'])
+    assert row['scaffold_contigs'] == -1
+
+def test_append_and_load(tmpdir):
+    folder = str(tmpdir)
+    assert archive.append(rows('a' * 32, 'b' * 32), folder=folder) == 2
+    assert archive.append(rows('c' * 32), folder=folder) == 1
+
+    a = archive.load(folder=folder)
+    assert sorted(a) == sorted(name for name, dtype in archive.COLUMNS)
+    assert len(a['id']) == 3
+    assert a['draft_N50'][0] == 2500.5
+    assert a['draft_N50'].dtype == np.dtype('<f8')
+
+    a = archive.load(['id'], stop=0.5, folder=folder)
+    assert sorted(a) == ['id']
+    assert len(a['id']) == 2
+
+# Archived ids in the index, or appended since
+@pytest.mark.parametrize('tail', [1, 3, 4096])
+def test_append_skips_archived(tmpdir, monkeypatch, tail):
+    monkeypatch.setattr(archive, 'INDEX_TAIL', tail)
+    folder = str(tmpdir)
+    assert archive.append(rows('b' * 32, 'd' * 32), folder=folder) == 2
+    # Archived already, or twice in the same rows
+    assert archive.append(rows('a' * 32, 'b' * 32, 'c' * 32, 'a' * 32,
+                               'e' * 32), folder=folder) == 3
+    assert archive.append(rows('d' * 32, 'e' * 32), folder=folder) == 0
+
+    ids = archive.load(['id'], folder=folder)['id']
+    assert len(ids) == 5
+    assert len(set(ids)) == 5
+    index = np.fromfile(archive.index_path(folder), dtype='<u8')
+    assert list(index) == sorted(index)
+    assert set(index) <= set(ids)
+    if tail < 3:
+        assert len(index) == 5
+
+def test_append_after_crash(tmpdir, monkeypatch):
+    monkeypatch.setattr(archive, 'INDEX_TAIL', 1)
+    folder = str(tmpdir)
+    archive.append(rows('a' * 32, 'b' * 32), folder=folder)
+
+    # A row half written, and a lost index
+    f = open(archive.column_path('id', folder), 'ab')
+    np.array([7], dtype='<u8').tofile(f)
+    f.close()
+    os.remove(archive.index_path(folder))
+
+    assert archive.append(rows('b' * 32, 'c' * 32), folder=folder) == 1
+    a = archive.load(folder=folder)
+    assert len(a['id']) == 3
+    for name, dtype in archive.COLUMNS:
+        assert (os.path.getsize(archive.column_path(name, folder)) ==
+                3 * np.dtype(dtype).itemsize)
+
+def test_runtime_samples(tmpdir, monkeypatch):
+    import settings
+    monkeypatch.setattr(settings, 'ARCHIVE_FOLDER', str(tmpdir))
+    failed = archive.job_row(*job('f' * 32, status='Job failed'))
+    archive.append(rows('a' * 32) + [failed])
+
+    samples = archive.runtime_samples()
+    assert samples.shape == (1, 5)
+    assert list(samples[0]) == [6000, 3, 1, 6000, 60]
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from assembly import CUMULATIVE
+from assembly import Lx
+from assembly import N50
+from assembly import Nx
+from assembly import assembly_stats
+
+def expanded_median(lengths):
+    '''The Broad N50, the old way: each contig repeated its length times'''
+    expanded = sorted(sum([[n] * n for n in lengths], []))
+    half = len(expanded) // 2
+    if len(expanded) % 2:
+        return expanded[half]
+    return (expanded[half - 1] + expanded[half]) / 2.0
+
+@pytest.mark.parametrize('seed', range(20))
+def test_broad_N50(seed):
+    rng = np.random.RandomState(seed)
+    lengths = list(rng.randint(1, 200, rng.randint(1, 30)))
+    assert N50(lengths) == expanded_median(lengths)
+
+def test_Nx():
+    lengths = [2, 3, 4, 5, 6, 7, 8, 9, 10]
+    # 54 bp: half of it is in 10 + 9 + 8
+    assert N50(lengths, CUMULATIVE) == 8
+    assert Lx(lengths, 50) == 3
+    assert Nx(lengths, 90, CUMULATIVE) == 4
+    assert Lx(lengths, 90) == 7
+    assert Lx([5], 90) == 1
+
+    # Between two contigs: their mean
+    assert N50([1, 1]) == 1
+    assert N50([3, 1]) == 3
+    assert N50([2, 2, 4]) == 3.0
+
+    with pytest.raises(ValueError):
+        Nx(lengths, 50, 'other')
+    with pytest.raises(ValueError):
+        N50([])
+
+def test_assembly_stats():
+    s = assembly_stats([100, 300, 200])
+    assert s == {'length': 600, 'contigs': 3, 'min': 100, 'max': 300,
+                 'mean': 200.0, 'N50': 250.0, 'N90': 100.0, 'L50': 1,
+                 'L90': 3}
+    assert assembly_stats([100, 300, 200], CUMULATIVE)['N50'] == 300
+
+    # Linear in the contigs, not in their length
+    s = assembly_stats([10 ** 9] * 10 + [1])
+    assert s['N50'] == 10 ** 9
+    assert s['length'] == 10 ** 10 + 1
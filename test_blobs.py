@@ -0,0 +1,90 @@
+import errno
+import gzip
+import os
+import time
+from StringIO import StringIO
+
+import pytest
+
+import blobs
+import settings
+import utils
+from store import release_blobs
+
+CONTENT = '>contig1\nACGTACGT\nACGT\n>contig2\nGGCC\n'
+
+class Upload(object):
+    def __init__(self, data):
+        self.stream = StringIO(data)
+
+def gzipped(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+@pytest.fixture
+def folders(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'BLOBS_FOLDER', str(tmpdir.join('blobs')))
+    return tmpdir.mkdir('a'), tmpdir.mkdir('b')
+
+def test_save_blob(r, folders, monkeypatch):
+    # Each upload is read (and decompressed) once
+    passes = []
+    save_upload = utils.save_upload
+    def counted(*args, **kwargs):
+        passes.append(args)
+        return save_upload(*args, **kwargs)
+    monkeypatch.setattr(blobs, 'save_upload', counted)
+
+    a, b = folders
+    name, info = blobs.save_blob(Upload(gzipped(CONTENT)), str(a), 'g.fa.gz')
+    assert name == 'g.fa'
+    assert info['size'] == len(CONTENT)
+    assert info['records'] == 2
+    h = info['sha256']
+    assert a.join('g.fa').read() == CONTENT
+    assert r.hget('medusablobs', h) == '1'
+
+    # The same content again: a link to the same blob
+    name, info = blobs.save_blob(Upload(CONTENT), str(b), 'other.fa')
+    assert info['sha256'] == h
+    assert r.hget('medusablobs', h) == '2'
+    blob = blobs.blob_path(h)
+    assert os.stat(blob).st_ino == os.stat(str(b.join('other.fa'))).st_ino
+    assert os.stat(blob).st_nlink == 3
+    assert len(passes) == 2
+    # Nothing left behind
+    assert os.listdir(os.path.join(blobs.blobs_folder(), 'tmp')) == []
+
+def test_save_blob_failure_releases(r, folders, monkeypatch):
+    a, b = folders
+    def link(blob, dest):
+        raise OSError(errno.EACCES, 'Permission denied')
+    monkeypatch.setattr(blobs, '_link', link)
+
+    with pytest.raises(OSError):
+        blobs.save_blob(Upload(CONTENT), str(a), 'g.fa')
+    assert r.hgetall('medusablobs') == {}
+    assert r.zcard('medusablobs_unused') == 1
+
+def test_collect_blobs(r, folders):
+    a, b = folders
+    name, info = blobs.save_blob(Upload(CONTENT), str(a), 'g.fa')
+    h = info['sha256']
+    blobs.link_blob(h, str(b.join('g.fa')))
+
+    release_blobs([h])
+    assert blobs.collect_blobs(grace=0) == (0, 0)
+
+    release_blobs([h])
+    # Still in its grace period
+    assert blobs.collect_blobs(grace=3600) == (0, 0)
+    time.sleep(0.01)
+    removed, reclaimed = blobs.collect_blobs(grace=0)
+    assert removed == 1
+    # The jobs still link it
+    assert reclaimed == 0
+    assert not os.path.exists(blobs.blob_path(h))
+    assert a.join('g.fa').read() == CONTENT
@@ -0,0 +1,136 @@
+import bz2
+import gzip
+import re
+
+import numpy as np
+import pytest
+
+from fasta import FastaScanner
+from fasta import FormatError
+from fasta import Preflight
+from fasta import scan_fasta
+
+def random_fasta(seed, records=20):
+    '''A FASTA text with gaps, lower case and varying line widths'''
+    rng = np.random.RandomState(seed)
+    out = []
+    for i in range(records):
+        seq = ''.join(rng.choice(list('ACGTacgtNn'), rng.randint(1, 500),
+                                 p=[.2, .2, .2, .2, .04, .04, .04, .04,
+                                    .02, .02]))
+        width = rng.randint(1, 80)
+        out.append('>contig%d some description\n' % i)
+        out.extend(seq[j:j + width] + '\n'
+                   for j in range(0, len(seq), width))
+    return ''.join(out)
+
+def naive(text):
+    '''The expected statistics, the slow way'''
+    seqs = [''.join(r.split('\n')[1:]) for r in text.split('>')[1:]]
+    whole = 'X'.join(seqs)
+    return {'lengths': [len(s) for s in seqs],
+            'gc': sum(whole.count(c) for c in 'GCgc'),
+            'n': sum(whole.count(c) for c in 'Nn'),
+            'gaps': len(re.findall('[Nn]+', whole))}
+
+def scan(text, chunk):
+    scanner = FastaScanner()
+    for i in range(0, len(text), chunk):
+        scanner.feed(text[i:i + chunk])
+    scanner.close()
+    return scanner
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('chunk', [1, 7, 64, 10 ** 6])
+def test_any_chunks(seed, chunk):
+    text = random_fasta(seed)
+    scanner = scan(text, chunk)
+    expected = naive(text)
+    assert scanner.lengths == expected['lengths']
+    assert scanner.gc == expected['gc']
+    assert scanner.n == expected['n']
+    assert scanner.gaps == expected['gaps']
+    assert scanner.errors == []
+
+def test_line_endings_and_gc():
+    scanner = scan('>a\r\nGGCCNN\r\nNNAT\r\n>b\nAC GT\n', 3)
+    assert scanner.lengths == [10, 4]
+    assert scanner.n == 4
+    assert scanner.gaps == 1
+    # GC of the bases that are not Ns
+    assert scanner.gc_content() == 60.0
+
+def test_no_final_newline():
+    assert scan('>a\nACGT\n>b', 2).lengths == [4, 0]
+    assert scan('>a\nACGT', 2).lengths == [4]
+
+@pytest.mark.parametrize('text, error', [
+    ('ACGT\n>a\nACGT\n', 'before the first header'),
+    ('>a\nACGTQ\n', 'Invalid characters in record "a"'),
+    ('>a\n>b\nACGT\n', 'Empty sequence for record "a"'),
+    ('>\nACGT\n', 'Empty header line'),
+    ('', 'No FASTA records found'),
+])
+def test_errors(text, error):
+    errors = scan(text, 5).errors
+    assert len(errors) == 1
+    assert error in errors[0]
+
+def test_errors_bounded():
+    scanner = scan('>a\n' * 100, 10)
+    assert len(scanner.errors) == 10
+
+@pytest.mark.parametrize('opener', [open, gzip.open, bz2.BZ2File])
+def test_scan_fasta(tmpdir, opener):
+    text = random_fasta(1)
+    # The compression is found from the content, not the name
+    path = str(tmpdir.join('genome.fa'))
+    f = opener(path, 'wb')
+    f.write(text)
+    f.close()
+
+    scanner = scan_fasta(path, chunk_size=100)
+    assert scanner.lengths == naive(text)['lengths']
+
+def preflight(text, chunk, prefix=16):
+    checks = Preflight(prefix)
+    for i in range(0, len(text), chunk):
+        checks.feed(text[i:i + chunk])
+    checks.close()
+    return checks
+
+@pytest.mark.parametrize('chunk', [1, 5, 1000])
+def test_preflight(chunk):
+    text = random_fasta(0)
+    checks = preflight(text, chunk)
+    assert checks.size == len(text)
+    assert checks.records == 20
+    assert preflight('>a\r\nACGT\r\n>b x\r\nAC', chunk).records == 2
+
+@pytest.mark.parametrize('text, error', [
+    ('', 'The file is empty'),
+    ('\n  \n', 'The file is empty'),
+    ('>a\nAC\0GT\n', 'binary file'),
+    ('LOCUS       AB000001\n', 'GenBank'),
+    ('ID   X56734; SV 1;\n', 'EMBL'),
+    ('@read1\nACGT\n+\nIIII\n', 'FASTQ'),
+    ('>p\nMKVLAAGIVALLLAAG\n', 'protein sequences'),
+    ('>a\nACGT1\n', 'Invalid characters in record "a"'),
+    ('ACGT\n>a\nACGT\n', 'before the first header'),
+    # Past the prefix, only the headers are checked
+    ('>a\nACGTACGTACGTACGT\n>b\nACGT\n>a\nACGT\n',
+     'Duplicate record id "a"'),
+    ('>a\nACGTACGTACGTACGT\n>b\n>c\nACGT\n', 'Empty sequence for record "b"'),
+    ('>a\nACGTACGTACGTACGT\n>\nACGT\n', 'Empty header line'),
+    ('>a\nACGTACGTACGTACGT\n>' + 'x' * 70000 + '\nACGT\n',
+     'Header line too long'),
+])
+@pytest.mark.parametrize('chunk', [1, 5, 1000])
+def test_preflight_errors(text, error, chunk):
+    with pytest.raises(FormatError) as e:
+        preflight(text, chunk)
+    assert error in str(e.value)
+
+def test_preflight_prefix_only():
+    # Odd characters past the prefix are left to the worker
+    assert preflight('>a\nACGTACGTACGTACGT\nXXXX\n', 5).records == 1
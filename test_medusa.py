@@ -0,0 +1,454 @@
+import gzip
+import json
+import os
+import time
+from StringIO import StringIO
+from datetime import date, timedelta
+
+import pytest
+
+import medusa
+import settings
+import tasks
+from conftest import write_fasta
+from store import dequeue_job
+from store import retrieve_job
+from store import update_job_fields
+from store import stats_cache_counters
+
+@pytest.fixture
+def client(tmpdir, monkeypatch):
+    uploads = str(tmpdir.mkdir('uploads'))
+    monkeypatch.setattr(settings, 'UPLOAD_FOLDER', uploads)
+    monkeypatch.setitem(medusa.app.config, 'UPLOAD_FOLDER', uploads)
+    monkeypatch.setitem(medusa.app.config, 'UPLOADS_MIN_FREE', None)
+    monkeypatch.setitem(medusa.app.config, 'SUBMISSIONS_PER_HOUR', None)
+    return medusa.app.test_client()
+
+@pytest.fixture
+def genomes(tmpdir):
+    return (write_fasta(tmpdir.join('draft.fa'), [3000, 2000, 1000]),
+            write_fasta(tmpdir.join('target.fa'), [6000]))
+
+def submit(client, draft, target, **extra):
+    data = {'draft': draft, 'genomes': [target],
+            'email': 'a@b.c', 'passphrase': ''}
+    data.update(extra)
+    return client.post('/run', data=data,
+                       environ_base={'REMOTE_ADDR': '1.2.3.4'})
+
+def job_dirs():
+    uploads = settings.UPLOAD_FOLDER
+    return [os.path.join(h2c, d)
+            for h2c in os.listdir(uploads) if h2c != 'blobs'
+            for d in os.listdir(os.path.join(uploads, h2c))]
+
+def run_next_job():
+    req_id = dequeue_job('slot', timeout=1)
+    job = retrieve_job(req_id)
+    tasks.process_job(req_id, job['wdir'], job['draft'],
+                      json.loads(job['targets']))
+    return req_id, job['wdir']
+
+def test_submit(client, genomes):
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    assert response.status_code == 302
+    req_id = response.location.rsplit('/', 1)[-1]
+    job = retrieve_job(req_id)
+    assert job['status'] == 'Job queued'
+    assert len(job_dirs()) == 1
+
+@pytest.mark.parametrize('draft, target', [
+    # Not FASTA, then a broken gzip file
+    ((StringIO('LOCUS       AB000001\n'), 'draft.gb'), None),
+    (None, (StringIO('\x1f\x8b\x08\x00broken'), 'target.fa.gz')),
+])
+def test_bad_inputs_leave_nothing(client, genomes, r, draft, target):
+    response = submit(client, draft or (open(genomes[0]), 'draft.fa'),
+                      target or (open(genomes[1]), 'target.fa'))
+    assert response.status_code == 302
+    assert response.location.endswith('/')
+    assert job_dirs() == []
+    # No blob is held
+    assert not r.hgetall('medusablobs')
+
+def test_failed_submission_leaves_nothing(client, genomes, r, monkeypatch):
+    def add_job(*args, **kwargs):
+        raise Exception('redis is down')
+    monkeypatch.setattr(medusa, 'add_job', add_job)
+
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    assert response.status_code == 302
+    assert job_dirs() == []
+    assert not r.hgetall('medusablobs')
+
+def test_failed_enqueue_leaves_nothing(client, genomes, r, monkeypatch):
+    def enqueue_job(*args, **kwargs):
+        raise Exception('redis is down')
+    monkeypatch.setattr(medusa, 'enqueue_job', enqueue_job)
+
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    assert response.status_code == 302
+    assert job_dirs() == []
+    assert not r.hgetall('medusablobs')
+    job = retrieve_job(r.zrange('medusajobs', 0, 0)[0][len('medusa_'):])
+    assert job['status'] == 'Job failed'
+
+def test_batch(client, genomes, tmpdir, r, medusa):
+    other = write_fasta(tmpdir.join('other.fa'), [100] * 50)
+    response = client.post('/batch', data={
+        'drafts': [(open(other), 'big.fa'), (open(genomes[0]), 'draft.fa')],
+        'genomes': [(open(genomes[1]), 'target.fa')],
+        'email': 'a@b.c', 'passphrase': ''},
+        environ_base={'REMOTE_ADDR': '1.2.3.4'})
+    assert response.status_code == 302
+    batch_id = response.location.rsplit('/', 1)[-1]
+    batch = r.hgetall('medusabatch_%s' % batch_id)
+    assert json.loads(batch['targets']) == ['target.fa']
+    # The targets are analysed by the jobs, not the request
+    assert not r.hgetall('medusacache_stats')
+
+    # The first job (the biggest draft here) goes first
+    req_ids = json.loads(batch['jobs'])
+    assert r.zrange('medusaqueue', 0, -1) == req_ids
+
+    page = client.get('/batch/%s' % batch_id).data
+    assert 'target' in page
+
+    for i, req_id in enumerate(req_ids):
+        assert dequeue_job('slot', timeout=1) == req_id
+        job = retrieve_job(req_id)
+        tasks.process_job(req_id, job['wdir'], job['draft'],
+                          json.loads(job['targets']))
+        assert retrieve_job(req_id)['status'] == 'Job done'
+        if i == 0:
+            misses = stats_cache_counters()['misses']
+    # The next job found the targets stats
+    assert stats_cache_counters()['misses'] == misses + 1
+
+    page = client.get('/batch/%s' % batch_id).data
+    assert '<td>6000</td>' in page
+
+def test_shorter_jobs_first(client, tmpdir, r):
+    from runtime import fit
+    from store import set_runtime_model
+    # Run times proportional to the draft length
+    set_runtime_model(fit([[n, 1, 1, 1000, n / 10.0]
+                           for n in range(1000, 100000, 1000)]))
+
+    long = write_fasta(tmpdir.join('long.fa'), [50000])
+    short = write_fasta(tmpdir.join('short.fa'), [5000])
+    target = write_fasta(tmpdir.join('target.fa'), [1000])
+    req_ids = []
+    for draft in (long, short):
+        response = submit(client, (open(draft), 'draft.fa'),
+                          (open(target), 'target.fa'))
+        req_ids.append(response.location.rsplit('/', 1)[-1])
+
+    # Submitted later, run first
+    assert r.zrange('medusaqueue', 0, -1) == req_ids[::-1]
+    assert 4000 < (r.zscore('medusaqueue', req_ids[0]) -
+                   r.zscore('medusaqueue', req_ids[1])) < 5000
+
+def test_stats_range(client, r, monkeypatch):
+    from store import add_job
+    add_job('a' * 32, '1.2.3.4', 'a@b.c')
+    today = time.asctime(date.today().timetuple())
+
+    # Clamped to the recorded days
+    response = client.get('/stats/jobs?from=1900-01-01&to=9999-12-31')
+    assert json.loads(response.data) == [{'date': today, 'jobs': 1}]
+
+    for query in ['from=2000-13-01', 'bucket=0', 'to=2000-01-01',
+                  'from=9999-01-01']:
+        assert client.get('/stats/jobs?' + query).status_code == 400
+
+    monkeypatch.setitem(medusa.app.config, 'STATS_MAX_DAYS', 10)
+    r.hset('medusastats_jobs', (date.today() - timedelta(days=10))
+           .strftime('%Y%m%d'), 1)
+    assert client.get('/stats/ips').status_code == 400
+    start = (date.today() - timedelta(days=9)).isoformat()
+    response = client.get('/stats/jobs?from=' + start)
+    assert len(json.loads(response.data)) == 10
+
+def test_metrics(client):
+    assert client.get('/stats').status_code == 200
+    # Pollers are not timed
+    assert client.get('/status/%s' % ('a' * 32)).status_code == 403
+    assert client.get('/static/nothing.js').status_code == 404
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    lines = response.data.splitlines()
+    assert 'medusa_queue_length 0' in lines
+    assert 'medusa_request_seconds_count{route="/stats"} 1' in lines
+    assert not [l for l in lines if 'status' in l or 'static' in l]
+
+def test_resubmission_from_cache(client, genomes, tmpdir, r, medusa):
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    first, wdir = run_next_job()
+    assert retrieve_job(first)['status'] == 'Job done'
+
+    # The same inputs, under other names
+    response = submit(client, (open(genomes[0]), 'again.fa'),
+                      (open(genomes[1]), 'other.fa'))
+    req_id = response.location.rsplit('/', 1)[-1]
+    job = retrieve_job(req_id)
+    assert job['status'] == 'Job done'
+    assert job['cached'] == first
+    assert r.zcard('medusaqueue') == 0
+    again = os.path.join(settings.UPLOAD_FOLDER, req_id[:2], req_id)
+    result = json.load(open(os.path.join(again, 'result.json')))
+    assert result['draft']['name'] == 'again.fa'
+    assert [t['name'] for t in result['targets']] == ['other.fa']
+    assert os.stat(os.path.join(again, 'scaffold.fasta.gz')).st_ino == \
+        os.stat(os.path.join(wdir, 'scaffold.fasta.gz')).st_ino
+
+    # Unless asked not to
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'), nocache='1')
+    req_id = response.location.rsplit('/', 1)[-1]
+    assert retrieve_job(req_id)['status'] == 'Job queued'
+
+def test_status(client, genomes):
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    req_id = response.location.rsplit('/', 1)[-1]
+
+    response = client.get('/status/%s' % req_id)
+    assert json.loads(response.data) == {'status': 'Job queued',
+                                         'position': 1}
+    etag = response.headers['ETag']
+    # Nothing new
+    response = client.get('/status/%s' % req_id,
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == ''
+
+    assert dequeue_job('slot', timeout=1) == req_id
+    update_job_fields(req_id, {'status': 'Running Medusa'})
+    response = client.get('/status/%s' % req_id,
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert json.loads(response.data) == {'status': 'Running Medusa'}
+
+    # Only for the submitter
+    assert client.get('/status/%s' % ('a' * 32)).status_code == 403
+
+def test_events(client, genomes, monkeypatch):
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    req_id = response.location.rsplit('/', 1)[-1]
+    # Off by default
+    assert client.get('/events/%s' % req_id).status_code == 404
+
+    monkeypatch.setitem(medusa.app.config, 'SSE_ENABLED', True)
+    response = client.get('/events/%s' % req_id, buffered=False)
+    assert response.mimetype == 'text/event-stream'
+    events = iter(response.response)
+    assert next(events) == 'retry: 5000\n\n'
+    event = next(events)
+    assert event.startswith('data: ') and event.endswith('\n\n')
+    assert json.loads(event[6:]) == {'status': 'Job queued', 'position': 1}
+
+    assert dequeue_job('slot', timeout=1) == req_id
+    update_job_fields(req_id, {'status': 'Job done'})
+    # The stream ends with the job (keep-alive comments aside)
+    assert [e for e in events if not e.startswith(':')] == \
+        ['data: {"status": "Job done"}\n\n']
+
+def test_log(client, genomes):
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    req_id = response.location.rsplit('/', 1)[-1]
+    log = 'one\ntwo\nthree\n'
+    wdir = os.path.join(settings.UPLOAD_FOLDER, job_dirs()[0])
+    with open(os.path.join(wdir, 'log.txt'), 'w') as f:
+        f.write(log)
+
+    response = client.get('/log/%s' % req_id)
+    assert response.data == log
+    assert response.headers['X-Log-Size'] == str(len(log))
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+    response = client.get('/log/%s' % req_id, headers={'Range': 'bytes=4-6'})
+    assert response.status_code == 206
+    assert response.data == 'two'
+    assert response.headers['Content-Range'] == 'bytes 4-6/%d' % len(log)
+    response = client.get('/log/%s' % req_id,
+                          headers={'Range': 'bytes=100-'})
+    assert response.status_code == 416
+
+    for tail, data in [(0, ''), (2, 'two\nthree\n'), (10, log)]:
+        response = client.get('/log/%s?tail=%d' % (req_id, tail))
+        assert response.data == data
+        assert response.headers['Content-Length'] == str(len(data))
+
+    # Following a running job
+    response = client.get('/log/%s?since=4' % req_id)
+    assert response.data == 'two\nthree\n'
+    assert client.get('/log/%s?since=100' % req_id).data == ''
+
+    # No stderr yet
+    response = client.get('/err/%s' % req_id)
+    assert 'Could not retrieve the log.err file' in response.data
+
+def test_scaffold(client, genomes, monkeypatch):
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    req_id = response.location.rsplit('/', 1)[-1]
+    wdir = os.path.join(settings.UPLOAD_FOLDER, job_dirs()[0])
+    scaffold = '>scaffold1\n' + 'ACGT' * 100 + '\n'
+    f = gzip.open(os.path.join(wdir, 'scaffold.fasta.gz'), 'wb')
+    f.write(scaffold)
+    f.close()
+    with open(os.path.join(wdir, 'scaffold.fasta.gz'), 'rb') as f:
+        stored = f.read()
+
+    gz = {'Accept-Encoding': 'gzip'}
+    response = client.get('/scaffold/%s' % req_id, headers=gz)
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.headers['Content-Disposition'] == \
+        'attachment; filename=scaffold.fasta'
+    assert response.data == stored
+    etag = response.headers['ETag']
+
+    headers = dict(gz, Range='bytes=0-9')
+    response = client.get('/scaffold/%s' % req_id, headers=headers)
+    assert response.status_code == 206
+    assert response.data == stored[:10]
+    assert response.headers['Content-Range'] == \
+        'bytes 0-9/%d' % len(stored)
+
+    headers = dict(gz, **{'If-None-Match': etag})
+    response = client.get('/scaffold/%s' % req_id, headers=headers)
+    assert response.status_code == 304
+    assert response.data == ''
+
+    # Decompressed for the clients that can't
+    response = client.get('/scaffold/%s' % req_id)
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == scaffold
+
+    # Or left to the front-end server
+    monkeypatch.setattr(medusa.app, 'use_x_sendfile', True)
+    response = client.get('/scaffold/%s' % req_id, headers=gz)
+    assert response.headers['X-Sendfile'] == \
+        os.path.join(wdir, 'scaffold.fasta.gz')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.data == ''
+
+@pytest.mark.usefixtures('medusa')
+def test_job(client, genomes, monkeypatch):
+    submit(client, (open(genomes[0]), 'draft.fa'),
+           (open(genomes[1]), 'target.fa'))
+    req_id, wdir = run_next_job()
+
+    calls = []
+    def retrieve(req_id):
+        calls.append(req_id)
+        return retrieve_job(req_id)
+    monkeypatch.setattr(medusa, 'retrieve_job', retrieve)
+    with medusa.app.test_request_context():
+        job = medusa.load_job(req_id)
+        assert medusa.load_job(req_id) is job
+        assert medusa.load_job('a' * 32) is None
+        assert calls == [req_id, 'a' * 32]
+
+        # Written by the worker, the files are not looked for
+        assert 'scaffold.fasta.gz' in job.manifest
+        def exists(path):
+            raise AssertionError(path)
+        with monkeypatch.context() as m:
+            m.setattr(os.path, 'exists', exists)
+            assert job.exists()
+            assert job.has('scaffold.fasta.gz')
+            assert not job.has('scaffold.fasta')
+
+    # result.json is parsed once per version
+    with medusa.app.test_request_context():
+        result = medusa.load_job(req_id).result()
+    path = os.path.join(wdir, 'result.json')
+    st = os.stat(path)
+    with open(path, 'w') as f:
+        f.write('{}')
+    os.utime(path, (st.st_atime, st.st_mtime))
+    with medusa.app.test_request_context():
+        assert medusa.load_job(req_id).result() is result
+
+    # Jobs without a manifest (running, or older) are probed
+    update_job_fields(req_id, {'manifest': ''})
+    with medusa.app.test_request_context():
+        job = medusa.load_job(req_id)
+        assert job.manifest is None
+        assert job.has('scaffold.fasta.gz')
+        assert not job.has('scaffold.fasta')
+
+def test_admission(client, genomes, r, monkeypatch):
+    def post(ip, email='a@b.c'):
+        return client.post('/run', data={
+            'draft': (open(genomes[0]), 'draft.fa'),
+            'genomes': [(open(genomes[1]), 'target.fa')],
+            'email': email, 'passphrase': ''},
+            environ_base={'REMOTE_ADDR': ip})
+
+    monkeypatch.setitem(medusa.app.config, 'SUBMISSIONS_PER_HOUR', 60)
+    monkeypatch.setitem(medusa.app.config, 'SUBMISSIONS_BURST', 1)
+    assert post('1.2.3.4').status_code == 302
+    # The address, then the email, are over their rate
+    response = post('1.2.3.4', 'x@y.z')
+    assert response.status_code == 429
+    assert 55 < int(response.headers['Retry-After']) <= 60
+    assert 'Too many submissions from your address' in response.data
+    response = post('5.6.7.8')
+    assert response.status_code == 429
+    assert 'Too many submissions from your email' in response.data
+
+    monkeypatch.setitem(medusa.app.config, 'SUBMISSIONS_PER_HOUR', None)
+    monkeypatch.setitem(medusa.app.config, 'QUEUE_MAX_LENGTH', 1)
+    monkeypatch.setitem(medusa.app.config, 'ADMISSION_RETRY_AFTER', 30)
+    response = post('1.2.3.4')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '30'
+    assert 'too busy' in response.data
+
+    monkeypatch.setitem(medusa.app.config, 'QUEUE_MAX_LENGTH', None)
+    monkeypatch.setitem(medusa.app.config, 'UPLOADS_MIN_FREE', 1024)
+    monkeypatch.setattr(medusa, 'free_space', lambda path: 1024)
+    response = post('1.2.3.4')
+    assert response.status_code == 503
+    assert 'running out of disk space' in response.data
+
+    # Nothing was saved, or queued, for them
+    assert len(job_dirs()) == 1
+    assert r.zcard('medusaqueue') == 1
+    assert medusa.rejection_counters() == {'ip': 1, 'email': 1,
+                                           'queue': 1, 'disk': 1}
+    lines = client.get('/metrics').data.splitlines()
+    assert 'medusa_rejected_submissions_total{reason="disk"} 1' in lines
+
+def test_preflight(client, genomes, tmpdir):
+    duplicated = tmpdir.join('dup.fa')
+    duplicated.write('>a\nACGT\n>b\nACGT\n>a\nACGT\n')
+    response = submit(client, (open(str(duplicated)), 'dup.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    assert response.location.endswith('/')
+    with client.session_transaction() as session:
+        assert session['_flashes'] == [('danger',
+            u'There is a problem with your draft genome ' +
+            u'(dup.fa: Duplicate record id "a")')]
+    assert job_dirs() == []
+
+    # The sizes and contigs are kept with the job
+    response = submit(client, (open(genomes[0]), 'draft.fa'),
+                      (open(genomes[1]), 'target.fa'))
+    req_id = response.location.rsplit('/', 1)[-1]
+    inputs = json.loads(retrieve_job(req_id)['inputs'])
+    assert inputs == {
+        'draft.fa': {'size': os.path.getsize(genomes[0]), 'records': 3},
+        'target.fa': {'size': os.path.getsize(genomes[1]), 'records': 1}}
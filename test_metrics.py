@@ -0,0 +1,53 @@
+import sys
+import time
+
+import metrics
+import tasks
+from metrics import Stages
+
+MB = 1024 * 1024
+
+def test_stages(tmpdir):
+    stages = Stages()
+    stages.start('sleep')
+    time.sleep(0.05)
+    # A big child process, a big stage in this process, a small one
+    stages.start('big')
+    assert tasks.run_cmd('%s -c "x = \'a\' * (300 * 1024 * 1024)"'
+                         % sys.executable, stages=stages, cwd=str(tmpdir))
+    stages.start('own')
+    x = 'a' * (300 * MB)
+    del x
+    stages.start('small')
+    assert tasks.run_cmd('true', stages=stages, cwd=str(tmpdir))
+    stages.stop()
+
+    names = [s[0] for s in stages.compact()]
+    assert names == ['sleep', 'big', 'own', 'small']
+    sleep, big, own, small = stages.stages
+    assert 0.05 <= sleep[1] < 1
+    assert sleep[2] < 0.05
+    # Each stage gets its own peak, not the largest so far
+    assert big[3] >= 300 * MB
+    assert own[3] >= 300 * MB
+    assert small[3] < 300 * MB
+    assert stages.total() == sum(s[1] for s in stages.stages)
+
+def test_observe(r):
+    stages = Stages()
+    stages.stages = [('Running Medusa', 3.0, 2.5, 20 * MB)]
+    stages.observe(r)
+    text = metrics.exposition(r, gauges={'medusa_queue_length':
+                                             ('Queued', 2)})
+    lines = text.splitlines()
+    assert '# TYPE medusa_queue_length gauge' in lines
+    assert 'medusa_queue_length 2' in lines
+    assert 'medusa_stage_seconds_bucket{stage="Running Medusa",' \
+        'le="2.5"} 0' in lines
+    assert 'medusa_stage_seconds_bucket{stage="Running Medusa",' \
+        'le="5"} 1' in lines
+    assert 'medusa_stage_seconds_bucket{stage="Running Medusa",' \
+        'le="+Inf"} 1' in lines
+    assert 'medusa_stage_seconds_sum{stage="Running Medusa"} 3' in lines
+    assert 'medusa_stage_rss_bytes_count{stage="Running Medusa"} 1' in lines
+    assert 'medusa_job_seconds_count 1' in lines
@@ -0,0 +1,122 @@
+import os
+import time
+
+import pytest
+
+import archive
+import retention
+import settings
+from store import add_job
+from store import acquire_blob
+from store import disk_counters
+from store import retrieve_job
+from store import set_job_disk
+from store import update_job_fields
+
+DAY = 24 * 3600
+
+@pytest.fixture
+def uploads(tmpdir, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOAD_FOLDER', str(tmpdir.mkdir('up')))
+    monkeypatch.setattr(settings, 'ARCHIVE_FOLDER', str(tmpdir.join('ar')))
+    monkeypatch.setattr(settings, 'UPLOADS_RETENTION', 7 * DAY)
+    monkeypatch.setattr(settings, 'UPLOADS_DISK_BUDGET', None)
+    return tmpdir.join('up')
+
+def new_job(r, uploads, req_id, age, status, size=1000, blobs='',
+            runtime=60):
+    '''A job submitted age days ago, finished runtime seconds later'''
+    wdir = uploads.mkdir(req_id)
+    wdir.join('scaffold.fasta.gz').write('x' * size)
+    add_job(req_id, '1.2.3.4', 'a@b.c', wdir=str(wdir), blobs=blobs)
+    t = time.time() - age * DAY
+    r.zadd('medusajobs', 'medusa_%s' % req_id, t)
+    update_job_fields(req_id, {'status': status, 'time': t})
+    if status in ('Job done', 'Job failed'):
+        set_job_disk(req_id, size, t + runtime)
+    return str(wdir)
+
+def test_collect_old_jobs(r, uploads):
+    old = new_job(r, uploads, 'a' * 32, 10, 'Job done')
+    failed = new_job(r, uploads, 'b' * 32, 9, 'Job failed', blobs='h1')
+    acquire_blob('h1')
+    young = new_job(r, uploads, 'c' * 32, 1, 'Job done')
+    assert disk_counters()['used'] == 3000
+
+    assert retention.collect(pause=0) == (2, 2000)
+    assert not os.path.exists(old)
+    assert not os.path.exists(failed)
+    assert os.path.exists(young)
+    assert retrieve_job('a' * 32)['status'] == 'Job expired'
+    assert retrieve_job('c' * 32)['status'] == 'Job done'
+    assert disk_counters()['used'] == 1000
+    # The failed job held its input
+    assert r.zscore('medusablobs_unused', 'h1') is not None
+
+    a = archive.load(['id', 'status'])
+    assert sorted(a['id']) == [int('a' * 16, 16), int('b' * 16, 16)]
+
+    # Only once
+    assert retention.collect(pause=0) == (0, 0)
+
+def test_collect_skips_queued_and_running(r, uploads):
+    queued = new_job(r, uploads, 'a' * 32, 10, 'Job queued')
+    running = new_job(r, uploads, 'b' * 32, 10, 'Running Medusa')
+    assert retention.collect(pause=0) == (0, 0)
+    assert os.path.exists(queued)
+    assert os.path.exists(running)
+
+def test_collect_over_budget(r, uploads, monkeypatch):
+    monkeypatch.setattr(settings, 'UPLOADS_DISK_BUDGET', 1500)
+    new_job(r, uploads, 'a' * 32, 2, 'Job done')
+    new_job(r, uploads, 'b' * 32, 1, 'Job done')
+    assert retention.collect(pause=0) == (1, 1000)
+    assert retrieve_job('a' * 32)['status'] == 'Job expired'
+
+def test_collect_by_finish_time(r, uploads, monkeypatch):
+    # Submitted long ago, finished yesterday: kept
+    new_job(r, uploads, 'a' * 32, 10, 'Job done', runtime=9 * DAY)
+    new_job(r, uploads, 'b' * 32, 9, 'Job done')
+    assert retention.collect(pause=0) == (1, 1000)
+    assert retrieve_job('a' * 32)['status'] == 'Job done'
+    assert retrieve_job('b' * 32)['status'] == 'Job expired'
+
+    # Over the budget, the earliest finished goes first
+    monkeypatch.setattr(settings, 'UPLOADS_DISK_BUDGET', 1500)
+    new_job(r, uploads, 'c' * 32, 2, 'Job done')
+    assert retention.collect(pause=0) == (1, 1000)
+    assert retrieve_job('a' * 32)['status'] == 'Job done'
+    assert retrieve_job('c' * 32)['status'] == 'Job expired'
+    assert r.zrange('medusajobs_finished', 0, -1) == ['medusa_' + 'a' * 32]
+
+def test_reindex(r, uploads):
+    # Finished before the upgrade: not in the finished jobs index
+    old = new_job(r, uploads, 'a' * 32, 10, 'Job done')
+    new_job(r, uploads, 'b' * 32, 10, 'Job failed')
+    r.delete('medusajobs_finished')
+    assert retention.reindex(pause=0) == 2
+    assert r.zcard('medusajobs_finished') == 2
+    assert disk_counters()['used'] == 2000
+
+    # Not reindexed: still removed, by submission time
+    r.delete('medusajobs_finished')
+    assert retention.collect(pause=0) == (2, 2000)
+    assert not os.path.exists(old)
+
+def test_collect_never_queued(r, uploads, monkeypatch):
+    # Their submission failed half-way: aged out, never by the budget
+    monkeypatch.setattr(settings, 'UPLOADS_DISK_BUDGET', 0)
+    old = new_job(r, uploads, 'a' * 32, 10, 'Job not started')
+    young = new_job(r, uploads, 'b' * 32, 0, 'Job not started')
+
+    assert retention.collect(pause=0)[0] == 1
+    assert not os.path.exists(old)
+    assert os.path.exists(young)
+    assert retrieve_job('a' * 32)['status'] == 'Job expired'
+    assert retrieve_job('b' * 32)['status'] == 'Job not started'
+
+def test_dry_run(r, uploads):
+    old = new_job(r, uploads, 'a' * 32, 10, 'Job done')
+    assert retention.collect(dry_run=True, pause=0) == (1, 1000)
+    assert os.path.exists(old)
+    assert retrieve_job('a' * 32)['status'] == 'Job done'
@@ -0,0 +1,61 @@
+import math
+
+import numpy as np
+import pytest
+
+import runtime
+import settings
+import tasks
+
+def samples(n=50, seed=1):
+    '''Jobs whose time grows as the draft length, within 10%'''
+    rng = np.random.RandomState(seed)
+    x = np.column_stack([rng.randint(1e5, 1e7, n), rng.randint(10, 1000, n),
+                         rng.randint(1, 5, n), rng.randint(1e6, 1e7, n)])
+    seconds = x[:, 0] / 1e4 * rng.uniform(0.9, 1.1, n)
+    return np.column_stack([x, seconds])
+
+def test_fit_predict():
+    model = runtime.fit(samples())
+    assert model['n'] == 50
+    assert model['sigma'] < 0.1
+    assert abs(model['coef'][1] - 1) < 0.05
+    assert 450 < runtime.predict(model, [5e6, 100, 2, 5e6]) < 550
+
+def test_limits(monkeypatch):
+    monkeypatch.setattr(settings, 'RUNTIME_TIMEOUT_MIN', 60)
+    model = runtime.fit(samples())
+    expected, late, timeout = runtime.limits(model, [5e6, 100, 2, 5e6])
+    assert expected < late < timeout
+    assert timeout == int(expected * math.exp(3 * model['sigma']))
+
+    # Never below the minimum
+    expected, late, timeout = runtime.limits(model, [1e3, 1, 1, 1e3])
+    assert timeout == 60
+    assert late == 30
+
+    assert runtime.limits(None, [1e3, 1, 1, 1e3]) == \
+        (None, runtime.DEFAULT_LATE, runtime.DEFAULT_TIMEOUT)
+
+def test_refit_and_job_limits(monkeypatch):
+    monkeypatch.setattr(settings, 'RUNTIME_MIN_SAMPLES', 20)
+    monkeypatch.setattr(settings, 'RUNTIME_REFIT_EVERY', 1000)
+    x = [5e6, 100, 2, 5e6]
+    assert 'predicted' not in runtime.job_limits(x)
+
+    for sample in samples(19):
+        assert runtime.record(sample[:4], sample[4]) is None
+    assert runtime.record(samples(1, seed=2)[0][:4], 400) is not None
+
+    single = runtime.job_limits(x)
+    assert 450 < single['predicted'] < 550
+
+    # Multiple runs, more than cores: one after the other
+    multi = runtime.job_limits(x, 2)
+    assert multi == dict((k, v * 2) for k, v in single.items())
+
+@pytest.mark.parametrize('runs, cores, waves', [
+    (4, 1, 4), (4, 2, 2), (4, 3, 2), (4, 4, 1), (4, 8, 1), (1, 2, 1)])
+def test_multi_waves(monkeypatch, runs, cores, waves):
+    monkeypatch.setattr(settings, 'MEDUSA_MULTI_CORES', cores)
+    assert tasks.multi_waves(['-random 5'] * runs) == waves
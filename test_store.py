@@ -0,0 +1,193 @@
+import time
+from datetime import date, timedelta
+
+import store
+from conftest import server
+from store import add_job
+from store import backfill_stats
+from store import cumulative_jobs
+from store import unique_emails
+from store import unique_ips
+
+DAY = 24 * 3600
+
+def submit(r, req_id, ip, email, days_ago=0):
+    '''A job submitted some days ago'''
+    t = time.time() - days_ago * DAY
+    add_job(req_id, ip, email)
+    # As if add_job had run back then
+    r.zadd('medusajobs', 'medusa_%s' % req_id, t)
+    return t
+
+def series(points):
+    return [value for value, day in points]
+
+def test_rollups(r):
+    add_job('a' * 32, '1.1.1.1', 'a@b.c')
+    add_job('b' * 32, '1.1.1.1', 'b@b.c')
+    add_job('c' * 32, '2.2.2.2', 'a@b.c')
+
+    today = store.day_bucket(time.time())
+    assert r.hgetall('medusastats_jobs') == {today: '3'}
+    assert r.hgetall('medusastats_ips_daily') == {today: '2'}
+    assert r.hgetall('medusastats_emails_daily') == {today: '2'}
+
+    assert series(cumulative_jobs()) == [3]
+    assert series(unique_ips()) == [2]
+    assert series(unique_emails()) == [2]
+
+def test_series_buckets(r):
+    today = date.today()
+    r.hmset('medusastats_jobs',
+            dict(((today - timedelta(days=d)).strftime('%Y%m%d'), 1)
+                 for d in (0, 2, 3, 9)))
+
+    assert series(cumulative_jobs()) == \
+        [1, 1, 1, 1, 1, 1, 2, 3, 3, 4]
+    # Everything before the start is carried over
+    assert series(cumulative_jobs(start=today - timedelta(days=3))) == \
+        [2, 3, 3, 4]
+    # Whole buckets, then the last (partial) one
+    assert series(cumulative_jobs(bucket=4)) == [1, 3, 4]
+    assert series(cumulative_jobs(size=2)) == [1, 4]
+    assert list(cumulative_jobs(start=today, stop=today -
+                                timedelta(days=1))) == []
+
+    # Unique counts are running maxima, not sums
+    r.hmset('medusastats_ips_daily',
+            {(today - timedelta(days=2)).strftime('%Y%m%d'): 3,
+             today.strftime('%Y%m%d'): 5})
+    assert series(unique_ips()) == [3, 3, 5]
+
+def test_backfill_stats(r, tmpdir, monkeypatch):
+    import settings
+    monkeypatch.setattr(settings, 'ARCHIVE_FOLDER', str(tmpdir))
+
+    submit(r, 'a' * 32, '1.1.1.1', 'a@b.c', days_ago=3)
+    submit(r, 'b' * 32, '2.2.2.2', 'a@b.c', days_ago=3)
+    submit(r, 'c' * 32, '1.1.1.1', 'b@b.c', days_ago=1)
+    submit(r, 'd' * 32, '3.3.3.3', 'c@b.c')
+    # Counted on the day add_job ran, not the submission day
+    assert series(cumulative_jobs()) == [4]
+
+    assert backfill_stats(batch=3) == 4
+    assert series(cumulative_jobs()) == [2, 2, 3, 4]
+    assert series(unique_ips()) == [2, 2, 2, 3]
+    assert series(unique_emails()) == [1, 1, 2, 3]
+
+def test_backfill_stats_archive(r, tmpdir, monkeypatch):
+    import archive
+    import settings
+    monkeypatch.setattr(settings, 'ARCHIVE_FOLDER', str(tmpdir))
+
+    t = time.time() - 2 * DAY
+    archive.append([archive.job_row('medusa_%s' % ('e' * 32),
+                                    {'time': t, 'ip': '1.1.1.1',
+                                     'email': 'a@b.c'})])
+    submit(r, 'a' * 32, '1.1.1.1', 'b@b.c')
+
+    assert backfill_stats() == 2
+    assert series(cumulative_jobs()) == [1, 1, 2]
+    assert series(unique_ips()) == [1, 1, 1]
+    assert series(unique_emails()) == [1, 1, 2]
+
+def test_jobs(r):
+    add_job('a' * 32, '1.1.1.1', 'a@b.c', 'hash', draft='draft.fa')
+    job = store.retrieve_job('a' * 32)
+    assert job['status'] == 'Job not started'
+    assert job['passphrase'] == 'hash'
+    assert job['draft'] == 'draft.fa'
+    assert r.zscore('medusajobs', 'medusa_%s' % ('a' * 32)) == \
+        float(job['time'])
+
+    add_job('b' * 32, '1.1.1.1', 'a@b.c')
+    assert 'passphrase' not in store.retrieve_job('b' * 32)
+    assert [j.get('draft') for j in
+            store.retrieve_jobs(['a' * 32, 'b' * 32, 'c' * 32])] == \
+        ['draft.fa', None, None]
+    assert store.jobs_status(['a' * 32, 'c' * 32]) == \
+        ['Job not started', None]
+
+def test_add_job_roundtrips(r, monkeypatch):
+    sent = []
+    send = store.redis.Connection.send_packed_command
+    def counted(self, command):
+        sent.append(command)
+        return send(self, command)
+    monkeypatch.setattr(store.redis.Connection, 'send_packed_command',
+                        counted)
+
+    # A server that never saw the script: the rollup loads it
+    monkeypatch.setattr(server, 'script_cache', {})
+    add_job('a' * 32, '1.1.1.1', 'a@b.c')
+    del sent[:]
+    add_job('b' * 32, '2.2.2.2', 'a@b.c')
+    assert len(sent) == 1
+    assert series(cumulative_jobs()) == [2]
+    assert series(unique_ips()) == [2]
+
+def test_status_events(r):
+    add_job('a' * 32, '1.1.1.1', 'a@b.c')
+    pubsub = store.subscribe_job('a' * 32)
+
+    store.update_job_fields('a' * 32, {'status': 'Job queued',
+                                       'priority': 1})
+    # No status change, no event
+    store.update_job('a' * 32, 'wdir', '/tmp')
+    store.update_job('a' * 32, 'status', 'Job done')
+
+    messages = []
+    for i in range(10):
+        m = pubsub.get_message()
+        if m:
+            messages.append(m['data'])
+    assert messages == ['{"status": "Job queued"}', '{"status": "Job done"}']
+    assert store.retrieve_job('a' * 32)['wdir'] == '/tmp'
+
+def test_roundtrips_counted(monkeypatch):
+    monkeypatch.setattr(store.redis.Connection, 'send_packed_command',
+                        lambda self, command: None)
+    connection = store.CountingConnection()
+    store.reset_roundtrips()
+    # A whole pipeline is a single packed command
+    connection.send_packed_command(['SET a 1', 'SET b 2'])
+    connection.send_packed_command('GET a')
+    assert store.roundtrips() == 2
+    assert store.redis_seconds() >= 0
+    store.reset_roundtrips()
+    assert store.roundtrips() == 0
+
+def test_stats_cache_lru(r):
+    store.cache_stats({'h1': {'length': 1}, 'h2': {'length': 2}}, size=2)
+    # h1 is used again, h2 is the least recently used
+    assert store.get_cached_stats(['h1', None, 'h3']) == \
+        {'h1': {'length': 1}}
+    store.cache_stats({'h3': {'length': 3}}, size=2)
+    assert sorted(store.get_cached_stats(['h1', 'h2', 'h3'])) == \
+        ['h1', 'h3']
+    assert store.stats_cache_counters() == {'hits': 3, 'misses': 2}
+
+def test_admit(r, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    # One a second, two in a row
+    assert store.admit('ip', 1.0, 2) == 0
+    assert store.admit('ip', 1.0, 2) == 0
+    assert store.admit('ip', 1.0, 2) == 1.0
+    now[0] += 0.5
+    assert store.admit('ip', 1.0, 2) == 0.5
+    now[0] += 0.5
+    assert store.admit('ip', 1.0, 2) == 0
+    # Never more than the burst
+    now[0] += 100
+    assert store.admit('ip', 1.0, 2, cost=5) == 0
+    assert store.admit('ip', 1.0, 2) == 1.0
+    # Buckets are apart
+    assert store.admit('other', 1.0, 2) == 0
+    assert store.admit('other', None, 2) == 0
+
+    # Nothing taken while the queue is full
+    r.zadd('medusaqueue', 'a', 1, 'b', 2)
+    assert store.admit('new', 1.0, 1, max_queue=2) == -1
+    assert store.admit('new', None, 1, max_queue=2) == -1
+    assert store.admit('new', 1.0, 1, max_queue=3) == 0
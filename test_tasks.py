@@ -0,0 +1,46 @@
+import pytest
+
+import tasks
+from conftest import write_fasta
+
+@pytest.fixture
+def files(tmpdir):
+    return [write_fasta(tmpdir.join('g%d.fa' % i), [1000 * (i + 1), 500])
+            for i in range(4)]
+
+def test_files_stats_pool(files):
+    serial = tasks.files_stats(files, processes=1)
+    assert [s['name'] for s in serial] == ['g0.fa', 'g1.fa', 'g2.fa', 'g3.fa']
+    assert [s['length'] for s in serial] == [1500, 2500, 3500, 4500]
+    assert tasks.files_stats(files, processes=3) == serial
+
+def test_files_stats_first_error(files, tmpdir):
+    bad = [str(tmpdir.join('bad%d.fa' % i)) for i in range(2)]
+    for path in bad:
+        open(path, 'w').write('not a fasta file\n')
+    with pytest.raises(Exception) as e:
+        tasks.files_stats(files[:1] + bad + files[1:], processes=3)
+    assert 'bad0.fa' in str(e.value)
+
+def test_files_stats_cache(files, monkeypatch):
+    from store import stats_cache_counters
+    hashes = dict(('g%d.fa' % i, 'h%d' % i) for i in range(4))
+    first = tasks.files_stats(files[:2], hashes, processes=1)
+    assert stats_cache_counters() == {'hits': 0, 'misses': 2}
+
+    # Cached ones are not read again (and keep their new name)
+    computed = []
+    single = tasks.single_genome_stats
+    def counted(fname):
+        computed.append(fname)
+        return single(fname)
+    monkeypatch.setattr(tasks, 'single_genome_stats', counted)
+    hashes['renamed.fa'] = 'h0'
+    stats = tasks.files_stats([files[1], files[2],
+                               files[0].replace('g0.fa', 'renamed.fa')],
+                              hashes, processes=1)
+    assert computed == [files[2]]
+    assert stats[0] == first[1]
+    assert stats[2]['name'] == 'renamed.fa'
+    assert stats[2]['length'] == first[0]['length']
+    assert stats_cache_counters() == {'hits': 2, 'misses': 3}
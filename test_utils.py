@@ -0,0 +1,104 @@
+import bz2
+import gzip
+import hashlib
+from StringIO import StringIO
+
+import pytest
+
+import utils
+from fasta import FormatError
+
+CONTENT = '>contig1\nACGTACGT\nACGT\n>contig2\nGGCC\n'
+
+class Upload(object):
+    def __init__(self, data):
+        self.stream = StringIO(data)
+
+def gzipped(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+@pytest.mark.parametrize('name, data, saved', [
+    ('g.fa', CONTENT, 'g.fa'),
+    ('g.fa.gz', gzipped(CONTENT), 'g.fa'),
+    ('g.fa.bz2', bz2.compress(CONTENT), 'g.fa'),
+    # Found from the content, not the name
+    ('g.fa', gzipped(CONTENT), 'g.fa'),
+    ('g.gz', CONTENT, 'g.gz'),
+    # Two gzip members (as bgzip writes them)
+    ('g.fa.gz', gzipped(CONTENT[:20]) + gzipped(CONTENT[20:]), 'g.fa'),
+])
+@pytest.mark.parametrize('chunk_size', [3, 1024])
+def test_save_upload(tmpdir, name, data, saved, chunk_size):
+    filename, info = utils.save_upload(Upload(data), str(tmpdir), name,
+                                       chunk_size=chunk_size)
+    assert filename == saved
+    assert tmpdir.join(saved).read() == CONTENT
+    assert info == {'sha256': hashlib.sha256(CONTENT).hexdigest(),
+                    'size': len(CONTENT), 'records': 2}
+
+def test_save_upload_not_saved():
+    # Only looked at
+    filename, info = utils.save_upload(Upload(bz2.compress(CONTENT)),
+                                       None, 'g.fa.bz2')
+    assert filename == 'g.fa'
+    assert info['records'] == 2
+
+def test_save_upload_bad_content(tmpdir):
+    with pytest.raises(FormatError) as e:
+        utils.save_upload(Upload(gzipped('LOCUS       AB000001\n')),
+                          str(tmpdir), 'g.gb.gz')
+    assert str(e.value).startswith('g.gb: ')
+
+def test_decompressor():
+    data = gzipped(CONTENT)
+    d = utils.Decompressor(data[:2])
+    assert d.compressed
+    assert ''.join(d.decompress(data[i:i + 5])
+                   for i in range(0, len(data), 5)) == CONTENT
+    assert not utils.Decompressor(CONTENT).compressed
+
+@pytest.mark.parametrize('data, lines, offset', [
+    ('one\ntwo\nthree\n', 0, 14),
+    ('one\ntwo\nthree\n', 1, 8),
+    ('one\ntwo\nthree\n', 2, 4),
+    ('one\ntwo\nthree\n', 3, 0),
+    ('one\ntwo\nthree\n', 4, 0),
+    # No trailing newline
+    ('one\ntwo\nthree', 1, 8),
+    ('', 1, 0),
+])
+@pytest.mark.parametrize('chunk_size', [1, 3, 1024])
+def test_tail_offset(tmpdir, data, lines, offset, chunk_size):
+    path = tmpdir.join('log.txt')
+    path.write(data)
+    assert utils.tail_offset(str(path), lines, chunk_size=chunk_size) == offset
+
+def test_read_file(tmpdir):
+    path = tmpdir.join('f')
+    path.write(CONTENT)
+    assert list(utils.read_file(str(path), chunk_size=16)) == \
+        [CONTENT[:16], CONTENT[16:32], CONTENT[32:]]
+    assert ''.join(utils.read_file(str(path), 3, 10, chunk_size=4)) == \
+        CONTENT[3:10]
+    # Past the end of the file
+    assert ''.join(utils.read_file(str(path), 30, 100)) == CONTENT[30:]
+
+def test_lru_cache():
+    cache = utils.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    # b is now the least recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('b', 0) == 0
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    cache.put('a', 4)
+    cache.put('d', 5)
+    assert cache.get('c') is None
+    assert cache.get('a') == 4
@@ -0,0 +1,123 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import settings
+import tasks
+from conftest import write_fasta
+from store import add_job
+from store import dequeue_job
+from store import enqueue_job
+from store import finish_job
+from store import heartbeat
+from store import requeue_dead_jobs
+from store import retrieve_job
+
+def new_job(tmpdir, req_id, mode=None):
+    wdir = tmpdir.mkdir(req_id)
+    write_fasta(wdir.join('draft.fa'), [3000, 2000, 1000])
+    wdir.mkdir('drafts')
+    write_fasta(wdir.join('drafts', 'target.fa'), [6000])
+    fields = {'wdir': str(wdir), 'draft': 'draft.fa',
+              'targets': json.dumps(['target.fa'])}
+    if mode is not None:
+        fields['mode'] = mode
+    add_job(req_id, '1.2.3.4', 'a@b.c', **fields)
+    enqueue_job(req_id)
+    return str(wdir)
+
+def wait_for(test, timeout=30):
+    deadline = time.time() + timeout
+    while not test():
+        assert time.time() < deadline
+        time.sleep(0.1)
+
+@pytest.mark.parametrize('mode', [None, tasks.MULTI])
+def test_requeued_job_runs_again(r, tmpdir, monkeypatch, medusa, mode):
+    monkeypatch.setattr(settings, 'MEDUSA_MULTI_OPTIONS', ['-random 1'] * 2,
+                        raising=False)
+    monkeypatch.setattr(settings, 'MEDUSA_MULTI_CORES', 2)
+    monkeypatch.setattr(settings, 'WORKER_RETRIES', 1)
+    wdir = new_job(tmpdir, 'a' * 32, mode)
+    sdir = os.getcwd()
+
+    # A slot (with no heartbeat) starts the job, and hangs in Medusa
+    monkeypatch.setenv('FAKE_SLEEP', '60')
+    slot = '%s:%d' % (socket.gethostname(), 1)
+    req_id = dequeue_job(slot, timeout=1)
+    assert req_id == 'a' * 32
+
+    def attempt():
+        try:
+            tasks.run_medusa(req_id, wdir, 'draft.fa', ['target.fa'])
+        except Exception:
+            pass
+        finally:
+            os.chdir(sdir)
+    t = threading.Thread(target=attempt)
+    t.start()
+    expected = 2 if mode == tasks.MULTI else 1
+    wait_for(lambda: len(retrieve_job(req_id).get('pgids', '').split())
+                     == expected)
+    pgids = [int(p) for p in retrieve_job(req_id)['pgids'].split()]
+
+    # The dead slot's Medusa is killed and its job queued again
+    assert requeue_dead_jobs() == [req_id]
+    t.join(30)
+    assert not t.is_alive()
+    for pgid in pgids:
+        def gone():
+            try:
+                os.killpg(pgid, 0)
+            except OSError:
+                return True
+            return False
+        wait_for(gone)
+    # (the status is left to the attempt, which here is not dead)
+    assert r.zscore('medusaqueue', req_id) is not None
+    job = retrieve_job(req_id)
+    assert job['deaths'] == '1'
+    assert 'pgids' not in job
+
+    # Another slot runs it again, in the same directory
+    monkeypatch.setenv('FAKE_SLEEP', '0')
+    assert dequeue_job('%s:%d' % (socket.gethostname(), 2), timeout=1) \
+        == req_id
+    tasks.process_job(req_id, wdir, 'draft.fa', ['target.fa'])
+    finish_job(req_id)
+    assert os.getcwd() == sdir
+
+    job = retrieve_job(req_id)
+    assert job['status'] == 'Job done', job.get('error')
+    assert os.path.exists(os.path.join(wdir, 'scaffold.fasta.gz'))
+    result = json.load(open(os.path.join(wdir, 'result.json')))
+    assert result['scaffold']['contigs'] == 3
+
+def test_dead_slot_on_another_host(r):
+    add_job('b' * 32, '1.2.3.4', 'a@b.c')
+    enqueue_job('b' * 32)
+    assert dequeue_job('elsewhere:1', timeout=1) == 'b' * 32
+
+    # Its host is still up: its own workers requeue the job
+    heartbeat('elsewhere:2')
+    assert requeue_dead_jobs() == []
+    assert r.smembers('medusaslots_elsewhere') == set(['elsewhere:2'])
+
+    # The whole host is gone
+    r.delete('medusaslot_elsewhere:2')
+    assert requeue_dead_jobs() == ['b' * 32]
+    assert r.smembers('medusaslots_elsewhere') == set()
+
+def test_too_many_deaths(r, monkeypatch):
+    monkeypatch.setattr(settings, 'WORKER_RETRIES', 0)
+    add_job('c' * 32, '1.2.3.4', 'a@b.c')
+    enqueue_job('c' * 32)
+    assert dequeue_job('%s:1' % socket.gethostname(), timeout=1) == 'c' * 32
+
+    assert requeue_dead_jobs() == []
+    job = retrieve_job('c' * 32)
+    assert job['status'] == 'Job failed'
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import os
+
 def generate_time_hash(data):
     '''Return a sha256 hash
     
@@ -24,7 +26,246 @@ def generate_hash(data):
     return hashlib.sha256("salegrosso" +
              data).hexdigest()
 
-# TODO: add credits
+def client_id(data):
+    '''Return a 64 bits integer id of the client data
+
+    Derived from its salted hash, as anonymous
+    '''
+    return int(generate_hash(data)[:16], 16)
+
+class Decompressor(object):
+    '''Streaming decompression of gzip/bzip2 data
+
+    The format is detected from the first bytes; plain data goes
+    through untouched. Multi-member files (e.g. bgzip) are supported
+    '''
+    def __init__(self, head):
+        import bz2
+        import zlib
+
+        if head[:2] == b'\x1f\x8b':
+            self.compressed = True
+            self._new = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif head[:3] == b'BZh':
+            self.compressed = True
+            self._new = bz2.BZ2Decompressor
+        else:
+            self.compressed = False
+            self._new = None
+        self._d = self._new() if self.compressed else None
+
+    def decompress(self, data):
+        if not self.compressed:
+            return data
+
+        out = []
+        while data:
+            out.append(self._d.decompress(data))
+            # Another member starts here
+            data = self._d.unused_data
+            if data:
+                self._d = self._new()
+        return b''.join(out)
+
+def save_upload(storage, dirname, filename, chunk_size=1024 * 1024):
+    '''Save an uploaded file, streaming it to its final place
+
+    gzip/bzip2 files are decompressed on the fly (and their
+    extension dropped). Returns the saved file name and a dictionary
+    with the content sha256 hash, size and number of FASTA records,
+    computed while the file is written (only computed if dirname
+    is None)
+
+    The content is checked on the way (fasta.Preflight): a
+    fasta.FormatError is raised as soon as it is found wrong
+    '''
+    import hashlib
+    from fasta import FormatError
+    from fasta import Preflight
+
+    head = storage.stream.read(chunk_size)
+    decompressor = Decompressor(head)
+    if decompressor.compressed:
+        base, ext = os.path.splitext(filename)
+        if ext.lower() in ('.gz', '.gzip', '.bz2', '.bz') and base:
+            filename = base
+
+    h = hashlib.sha256()
+    preflight = Preflight()
+    out = None
+    if dirname is not None:
+        out = open(os.path.join(dirname, filename), 'wb')
+    try:
+        chunk = head
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                preflight.feed(data)
+                h.update(data)
+                if out is not None:
+                    out.write(data)
+            chunk = storage.stream.read(chunk_size)
+        preflight.close()
+    except FormatError as e:
+        raise FormatError('%s: %s' % (filename, e))
+    finally:
+        if out is not None:
+            out.close()
+
+    return filename, {'sha256': h.hexdigest(),
+                      'size': preflight.size,
+                      'records': preflight.records}
+
+def read_file(path, start=0, stop=None, chunk_size=64 * 1024):
+    '''Yield the content of a file between two offsets, in chunks'''
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        left = None if stop is None else stop - start
+        while left is None or left > 0:
+            n = chunk_size if left is None else min(chunk_size, left)
+            chunk = f.read(n)
+            if not chunk:
+                break
+            if left is not None:
+                left -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def tar_stream(files, chunk_size=64 * 1024):
+    '''Return the size and the content (chunks) of an uncompressed
+    tar archive of (name in the archive, path) files
+
+    The archive is built on the fly, never held in memory or on disk
+    '''
+    import tarfile
+
+    members = []
+    size = 0
+    for name, path in files:
+        st = os.stat(path)
+        info = tarfile.TarInfo(name)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.GNU_FORMAT)
+        # Contents are padded to whole blocks
+        pad = -st.st_size % tarfile.BLOCKSIZE
+        members.append((header, path, st.st_size, pad))
+        size += len(header) + st.st_size + pad
+    # Two empty blocks, then up to a whole record
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(size + end) % tarfile.RECORDSIZE
+    size += end
+
+    def stream():
+        for header, path, fsize, pad in members:
+            yield header
+            for chunk in read_file(path, 0, fsize, chunk_size):
+                yield chunk
+            yield tarfile.NUL * pad
+        yield tarfile.NUL * end
+
+    return size, stream()
+
+def tail_offset(path, lines, chunk_size=64 * 1024):
+    '''Return the offset where the last lines of a file start
+
+    The file is read backwards, only as much as needed
+    '''
+    f = open(path, 'rb')
+    try:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        if lines == 0:
+            return pos
+
+        # A trailing newline does not start a new line
+        f.seek(max(pos - 1, 0))
+        if f.read(1) == b'\n':
+            pos -= 1
+
+        while pos > 0:
+            n = min(chunk_size, pos)
+            pos -= n
+            f.seek(pos)
+            chunk = f.read(n)
+            i = len(chunk)
+            while True:
+                i = chunk.rfind(b'\n', 0, i)
+                if i < 0:
+                    break
+                lines -= 1
+                if lines == 0:
+                    return pos + i + 1
+        return 0
+    finally:
+        f.close()
+
+def disk_usage(path):
+    '''Return the disk space taken by a directory tree (bytes)
+
+    Files with many hard links (e.g. reused results) are shared:
+    each link accounts for its part only
+    '''
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            total += st.st_blocks * 512 // max(1, st.st_nlink)
+    return total
+
+def free_space(path):
+    '''Return the disk space available to the users of a file system'''
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+class LRUCache(object):
+    '''A small in-process, thread safe, least recently used cache'''
+    def __init__(self, size=128):
+        import collections
+        import threading
+
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+def get_setting(name, default=None):
+    '''Return a configuration value
+
+    Values in production.py override the ones in settings.py,
+    as for the web app configuration
+    '''
+    try:
+        import production
+        if hasattr(production, name):
+            return getattr(production, name)
+    except ImportError:
+        pass
+
+    import settings
+    return getattr(settings, name, default)
+
 def N50(numlist):
     """
     Abstract: Returns the N50 value of the passed list of numbers.
@@ -32,16 +273,8 @@ def N50(numlist):
 
     Based on the Broad Institute definition:
     https://www.broad.harvard.edu/crd/wiki/index.php/N50
+    See the assembly module for the other statistics
     """
-    numlist.sort()
-    newlist = []
-    for x in numlist :
-        newlist += [x]*x
-        # take the mean of the two middle elements af there are an even number
-        # of elements.  otherwise, take the middle element
-    if len(newlist) % 2 == 0:
-        medianpos = len(newlist)/2
-        return float(newlist[medianpos] + newlist[medianpos-1]) /2
-    else:
-        medianpos = len(newlist)/2
-        return newlist[medianpos]
+    from assembly import N50 as _N50
+
+    return _N50(numlist)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+'''
+Medusa jobs worker
+
+Runs the queued jobs on a number of concurrent slots
+(one process each), replacing dead slots and requeuing
+the jobs of the slots that died, here or on other workers
+
+    python worker.py [slots]
+'''
+
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from store import dequeue_job
+from store import finish_job
+from store import heartbeat
+from store import requeue_dead_jobs
+from store import retrieve_job
+
+from tasks import process_job
+
+from utils import get_setting
+
+def keep_alive(slot, stop, every):
+    while not stop.wait(every):
+        heartbeat(slot)
+
+def run_slot():
+    '''Run queued jobs, one at a time, forever'''
+    # Only the main worker process handles the shutdown
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    slot = '%s:%d' % (socket.gethostname(), os.getpid())
+    every = get_setting('WORKER_HEARTBEAT', 10)
+
+    while True:
+        heartbeat(slot)
+        requeue_dead_jobs()
+
+        req_id = dequeue_job(slot, timeout=every)
+        if req_id is None:
+            continue
+
+        # Keep beating while the job runs
+        stop = threading.Event()
+        t = threading.Thread(target=keep_alive, args=(slot, stop, every))
+        t.daemon = True
+        t.start()
+        try:
+            job = retrieve_job(req_id)
+            process_job(req_id, job['wdir'], job['draft'],
+                        json.loads(job['targets']))
+        finally:
+            stop.set()
+            finish_job(req_id)
+
+def start_slot():
+    # Not a daemon: slots use process pools themselves
+    p = multiprocessing.Process(target=run_slot)
+    p.start()
+    return p
+
+def main(slots):
+    procs = [start_slot() for i in range(slots)]
+
+    def shutdown(signum, frame):
+        for p in procs:
+            p.terminate()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Replace the slots that die
+    while True:
+        time.sleep(1)
+        for i, p in enumerate(procs):
+            if not p.is_alive():
+                sys.stderr.write('Slot %d died (exit code %s), restarting\n'
+                                 % (p.pid, p.exitcode))
+                procs[i] = start_slot()
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        slots = int(sys.argv[1])
+    else:
+        slots = get_setting('WORKER_SLOTS', 1)
+
+    main(slots)